@@ -0,0 +1,331 @@
+import argparse
+import csv
+import json
+import os
+import os.path
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import combinations
+from parseQDPX import read_qdpx_file, Project, BACKENDS
+from compare_pair import ProjectPair, MetaphorComparison
+
+# Levels at which agreement is measured
+LEVELS = ("source_domain", "target_domain", "metaphor_type", "lu", "frame_element")
+# Label used when a coder coded a metaphor but not its domain or type
+MISSING = "(none)"
+# Label used when one of the coders did not code a unit (metaphor, LU or frame element) at all
+UNMATCHED = "(unmatched)"
+
+
+def percent_agreement(pairs):
+    """Returns the share of units on which both coders assigned the same label (None if there are no units)."""
+    if not pairs:
+        return None
+    return sum(1 for first, second in pairs if first == second) / len(pairs)
+
+
+def cohens_kappa(pairs):
+    """Returns Cohen's kappa for a list of (label_first, label_second) tuples (None if undefined)."""
+    if not pairs:
+        return None
+    n = len(pairs)
+    observed = sum(1 for first, second in pairs if first == second) / n
+    counts_first = Counter(first for first, _ in pairs)
+    counts_second = Counter(second for _, second in pairs)
+    expected = sum(counts_first[label] * counts_second[label]
+                   for label in counts_first) / (n * n)
+    if expected == 1:
+        return None
+    return (observed - expected) / (1 - expected)
+
+
+def coincidences(pairs):
+    """Returns the coincidence matrix (as a Counter of label pairs) of two coders' labels."""
+    matrix = Counter()
+    for first, second in pairs:
+        matrix[(first, second)] += 1
+        matrix[(second, first)] += 1
+    return matrix
+
+
+def krippendorffs_alpha(matrix):
+    """Returns nominal Krippendorff's alpha for a coincidence matrix (None if undefined).
+
+    See pooled_coincidences for a matrix of more than two coders.
+    """
+    totals = Counter()
+    for (first, _), count in matrix.items():
+        totals[first] += count
+    n = sum(totals.values())
+    if n <= 1:
+        return None
+    observed = sum(count for (first, second), count in matrix.items() if first != second)
+    expected = (n * n - sum(count * count for count in totals.values())) / (n - 1)
+    if expected == 0:
+        return None
+    return 1 - observed / expected
+
+
+def pooled_coincidences(matrices, coders):
+    """Returns the coincidence matrix of all coders from the matrices of all their pairs.
+
+    In the coincidence matrix of m coders every unit adds each ordered pair of its values with
+    the weight 1 / (m - 1), while the matrices of pairs add them with the weight 1, so their sum
+    is divided by m - 1. This is the exact multi-coder matrix when the units are the same in
+    all pairs; units are matched pair by pair (see ProjectPair), so when they are matched
+    differently in different pairs it is an approximation.
+    """
+    pooled = Counter()
+    for matrix in matrices:
+        pooled.update(matrix)
+    if coders > 2:
+        pooled = Counter({labels: count / (coders - 1) for labels, count in pooled.items()})
+    return pooled
+
+
+def metaphor_label(metaphor, key):
+    code = metaphor.info.get(key)
+    return code.name if code is not None else MISSING
+
+
+def align_lus_by_span(comparison):
+    """Pairs LUs of a MetaphorComparison by their spans only, whatever codes the coders gave them.
+
+    LUs with the same span and code are already aligned by the comparison, the rest is paired
+    here by span (in the `text` mode, by spans mapped into the text of the second coder and
+    differing by at most the tolerance of the comparison).
+
+    Returns:
+        A touple containing a list of (lu_first, lu_second) tuples, and lists of LUs only in the first and only in the second metaphor
+    """
+    if comparison.offset_map is None:
+        def span_first(lu):
+            return lu.start_pos - comparison.offset_first, lu.end_pos - comparison.offset_first
+
+        def span_second(lu):
+            return lu.start_pos - comparison.offset_second, lu.end_pos - comparison.offset_second
+        tolerance = 0
+    else:
+        def span_first(lu):
+            return comparison.offset_map.map_span(lu.start_pos, lu.end_pos)
+
+        def span_second(lu):
+            return lu.start_pos, lu.end_pos
+        tolerance = comparison.tolerance
+    aligned_lus = list(comparison.aligned_elements)
+    lus_only_first = []
+    lus_second = list(comparison.lus_only_second)
+    for lu_first in comparison.lus_only_first:
+        start, end = span_first(lu_first)
+        best = None
+        for lu_second in lus_second:
+            start_second, end_second = span_second(lu_second)
+            distance = max(abs(start_second - start), abs(end_second - end))
+            if distance <= tolerance and (best is None or distance < best[0]):
+                best = (distance, lu_second)
+        if best is None:
+            lus_only_first.append(lu_first)
+        else:
+            aligned_lus.append((lu_first, best[1]))
+            lus_second.remove(best[1])
+    return aligned_lus, lus_only_first, lus_second
+
+
+def pair_units(project_pair):
+    """Collects coded units of a ProjectPair at every level of agreement.
+
+    Unmatched metaphors count as units that the other coder labelled as `(unmatched)`, a domain
+    or type a coder left out of a metaphor is labelled `(none)`. Every metaphor is a unit once:
+    when several first metaphors are matched with the same second one (matching by domains),
+    only the first of them is paired with it and the others count as unmatched, and so does
+    every second metaphor paired with none. LUs are units by their spans
+    (see align_lus_by_span) labelled with the names of their codes, a span coded by only one coder
+    is labelled `(unmatched)` for the other one. Frame elements are units of aligned LUs, one per
+    element name; an element coded by only one coder is labelled `(unmatched)` for the other one.
+
+    Returns:
+        A touple containing a dictionary with levels as keys and lists of (label_first, label_second) tuples as values,
+        and a list of disagreements (dictionaries)
+    """
+    units = {level: [] for level in LEVELS}
+    disagreements = []
+    info_levels = (("source_domain", "Source"), ("target_domain", "Target"), ("metaphor_type", "Type"))
+
+    def add(level, source, span, first, second, text=""):
+        units[level].append((first, second))
+        if first != second:
+            disagreements.append({"source": source.name, "level": level,
+                                  "start": span[0], "end": span[1], "text": text,
+                                  "first": first, "second": second})
+
+    for source, source_data in project_pair.sources.items():
+        paired_second = set()
+        unpaired_first = []
+        for comparison in source_data["common"]:
+            if id(comparison.metaphor_second) in paired_second:
+                unpaired_first.append(comparison.metaphor_first)
+                continue
+            paired_second.add(id(comparison.metaphor_second))
+            for level, key in info_levels:
+                add(level, source, comparison.metaphor_first.span,
+                    metaphor_label(comparison.metaphor_first, key),
+                    metaphor_label(comparison.metaphor_second, key))
+            aligned_lus, lus_only_first, lus_only_second = align_lus_by_span(comparison)
+            for lu_first, lu_second in aligned_lus:
+                span = (lu_first.start_pos, lu_first.end_pos)
+                add("lu", source, span, lu_first.code.name, lu_second.code.name, lu_first.full_text)
+                elements = comparison.aligned_elements.get((lu_first, lu_second)) or \
+                    MetaphorComparison.align_elements(lu_first, lu_second)
+                for name in dict.fromkeys(elements["common_names"]):
+                    add("frame_element", source, span, name, name, lu_first.full_text)
+                for element in elements["first"]:
+                    add("frame_element", source, span, element.name, UNMATCHED, lu_first.full_text)
+                for element in elements["second"]:
+                    add("frame_element", source, span, UNMATCHED, element.name, lu_first.full_text)
+            for lu in lus_only_first:
+                add("lu", source, (lu.start_pos, lu.end_pos), lu.code.name, UNMATCHED, lu.full_text)
+            for lu in lus_only_second:
+                add("lu", source, (lu.start_pos, lu.end_pos), UNMATCHED, lu.code.name, lu.full_text)
+        for metaphor in source_data["first"] + unpaired_first:
+            for level, key in info_levels:
+                add(level, source, metaphor.span, metaphor_label(metaphor, key), UNMATCHED)
+        for metaphor in project_pair.srcs_second[source.name].metaphors:
+            if id(metaphor) in paired_second:
+                continue
+            for level, key in info_levels:
+                add(level, source, metaphor.span, UNMATCHED, metaphor_label(metaphor, key))
+    return units, disagreements
+
+
+def parse_archive(path, lu_code_name, f_code_name, g_code_name, backend):
+    project_xml, sources = read_qdpx_file(path, backend)
+    return Project(project_xml, sources, lu_code_name, f_code_name, g_code_name)
+
+
+# Projects shared by all comparisons run in a worker process, set by init_worker
+_projects = None
+
+
+def init_worker(projects):
+    global _projects
+    _projects = projects
+
+
+def compare_projects(i, j, match):
+    """Compares two parsed projects (by their indices) and returns agreement statistics.
+
+    Returns:
+        A dictionary with indices of the projects, statistics per level, coincidence matrices and disagreements
+    """
+    project_pair = ProjectPair(_projects[i], _projects[j], match)
+    units, disagreements = pair_units(project_pair)
+    levels = {}
+    matrices = {}
+    for level, pairs in units.items():
+        matrix = coincidences(pairs)
+        matrices[level] = matrix
+        levels[level] = {"units": len(pairs),
+                         "agreements": sum(1 for first, second in pairs if first == second),
+                         "percent": percent_agreement(pairs),
+                         "kappa": cohens_kappa(pairs),
+                         "alpha": krippendorffs_alpha(matrix)}
+    return {"first": i, "second": j, "levels": levels,
+            "matrices": matrices, "disagreements": disagreements}
+
+
+def batch_agreement(paths, lu_code_name, f_code_name, g_code_name="Grammar",
+                    backend="stream", match="overlap", workers=None):
+    """Parses N QDPX archives once and compares every pair of them.
+
+    Args:
+        paths: paths to the QDPX archives
+        lu_code_name, f_code_name, g_code_name: names of codes passed to Project
+        backend: parser backend
+        match: how metaphors are matched (see ProjectPair)
+        workers: number of worker processes (defaults to the number of CPUs)
+    Returns:
+        A dictionary with names of the archives, results of pairwise comparisons and summary statistics per level
+    """
+    names = [os.path.basename(path) for path in paths]
+    if len(set(names)) != len(names):
+        names = list(paths)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        projects = list(executor.map(partial(parse_archive, lu_code_name=lu_code_name,
+                                             f_code_name=f_code_name, g_code_name=g_code_name,
+                                             backend=backend), paths))
+    indices = list(combinations(range(len(paths)), 2))
+    # Every worker receives all parsed projects once, comparisons only pass their indices
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(projects,)) as executor:
+        results = list(executor.map(partial(compare_projects, match=match),
+                                    [i for i, _ in indices], [j for _, j in indices]))
+
+    summary = {}
+    for level in LEVELS:
+        pooled = pooled_coincidences([result["matrices"][level] for result in results], len(paths))
+        percents = [r["levels"][level]["percent"] for r in results if r["levels"][level]["percent"] is not None]
+        kappas = [r["levels"][level]["kappa"] for r in results if r["levels"][level]["kappa"] is not None]
+        summary[level] = {"units": sum(r["levels"][level]["units"] for r in results),
+                          "mean_percent": sum(percents) / len(percents) if percents else None,
+                          "mean_kappa": sum(kappas) / len(kappas) if kappas else None,
+                          "alpha": krippendorffs_alpha(pooled)}
+    pairs = []
+    for result in results:
+        pairs.append({"first": names[result["first"]], "second": names[result["second"]],
+                      "levels": result["levels"], "disagreements": result["disagreements"]})
+    return {"archives": names, "pairs": pairs, "summary": summary}
+
+
+def write_agreement(agreement, output_dir):
+    """Writes results of batch_agreement as `agreement.json`, `agreement_matrix.csv` and `disagreements.csv`."""
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "agreement.json"), "w", encoding="utf-8") as f:
+        json.dump(agreement, f, ensure_ascii=False, indent=1)
+
+    names = agreement["archives"]
+    stats = {}
+    for pair in agreement["pairs"]:
+        for level, values in pair["levels"].items():
+            for statistic in ("percent", "kappa", "alpha"):
+                stats[(level, statistic, pair["first"], pair["second"])] = values[statistic]
+                stats[(level, statistic, pair["second"], pair["first"])] = values[statistic]
+    with open(os.path.join(output_dir, "agreement_matrix.csv"), "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["level", "statistic", "archive"] + names)
+        for level in LEVELS:
+            for statistic in ("percent", "kappa", "alpha"):
+                for name in names:
+                    writer.writerow([level, statistic, name] +
+                                    [1.0 if name == other else stats.get((level, statistic, name, other))
+                                     for other in names])
+
+    with open(os.path.join(output_dir, "disagreements.csv"), "w", newline="", encoding="utf-8") as f:
+        fields = ["archive_first", "archive_second", "source", "level", "start", "end", "text", "first", "second"]
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        for pair in agreement["pairs"]:
+            for disagreement in pair["disagreements"]:
+                writer.writerow({"archive_first": pair["first"], "archive_second": pair["second"], **disagreement})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='QDPX agreement',
+        description='Reads and parses N QPDX archives, compares every pair of them\
+             and writes agreement statistics')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--lu_code_name', '-l')
+    parser.add_argument('--f_code_name', '-f')
+    parser.add_argument('--g_code_name', '-g', default="Grammar")
+    parser.add_argument('--backend', '-b', choices=BACKENDS, default="stream")
+    parser.add_argument('--match', '-m', choices=ProjectPair.MATCH_MODES, default="overlap")
+    parser.add_argument('--workers', '-w', type=int)
+    parser.add_argument('--output', '-o', default="agreement")
+    args = parser.parse_args()
+
+    agreement = batch_agreement(args.paths, args.lu_code_name, args.f_code_name,
+                                args.g_code_name, args.backend, args.match, args.workers)
+    write_agreement(agreement, args.output)
+    for level, values in agreement["summary"].items():
+        print(level, values)
@@ -0,0 +1,198 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os.path
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from parseQDPX import read_qdpx_file, Project
+from compare_pair import ProjectPair
+from extract_fragments_files import extract_fragments, make_qdpx_project
+from synthetic_qdpx import make_synthetic_qdpx
+
+# Sizes of the synthetic archives (arguments of make_synthetic_qdpx)
+SIZES = {"small": {"sources": 5, "metaphors": 3},
+         "medium": {"sources": 30, "metaphors": 20},
+         "large": {"sources": 60, "metaphors": 40}}
+# Bumped whenever the layout of the results or the meaning of a stage changes
+RESULTS_VERSION = 1
+LU_CODE_NAME = "LexicalUnit"
+F_CODE_NAME = "Frame"
+# Modules whose import time is measured, each in a fresh interpreter (as every CLI call and srv.py start pays it)
+IMPORTED_MODULES = ("parseQDPX", "compare_pair", "extract_fragments_files", "agreement", "corpus_db", "srv")
+
+
+def measure(function, setup=None, repeat=3, warmup=1):
+    """Times `function` `repeat` times (printed output is discarded) and returns the timings in seconds.
+
+    Args:
+        function: a callable called with the result of `setup` (or without arguments)
+        setup: optional callable preparing fresh input for every run (not timed)
+        repeat: number of runs
+        warmup: number of untimed runs before the timed ones (filling caches, e.g. of templates)
+    """
+    timings = []
+    for run in range(warmup + repeat):
+        args = (setup(),) if setup else ()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function(*args)
+            elapsed = time.perf_counter() - start
+        if run >= warmup:
+            timings.append(elapsed)
+    return timings
+
+
+def pipeline_stages(path_first, path_second):
+    """Returns (name, function, setup) of the benchmarked stages for a pair of archives of two coders."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        read = {backend: read_qdpx_file(path_first, backend) for backend in ("soup", "stream")}
+        project_first = Project(*read_qdpx_file(path_first, "stream"), LU_CODE_NAME, F_CODE_NAME)
+        project_second = Project(*read_qdpx_file(path_second, "stream"), LU_CODE_NAME, F_CODE_NAME)
+        project_pair = ProjectPair(project_first, project_second)
+    # Imported here, so that benchmarks of the parser do not need Flask
+    import srv
+
+    def fresh_soup():
+        # extract_fragments modifies the tree, so every run gets a new one
+        return read_qdpx_file(path_first)
+
+    def fresh_fragments():
+        # Documents and files of extracted fragments are generated while they are written, so only once
+        return extract_fragments(*fresh_soup(), "Fragment", path_first)
+
+    return [
+        ("read_qdpx_file[soup]", lambda: read_qdpx_file(path_first, "soup"), None),
+        ("read_qdpx_file[stream]", lambda: read_qdpx_file(path_first, "stream"), None),
+        ("Project[soup]", lambda: Project(*read["soup"], LU_CODE_NAME, F_CODE_NAME), None),
+        ("Project[stream]", lambda: Project(*read["stream"], LU_CODE_NAME, F_CODE_NAME), None),
+        ("ProjectPair", lambda: ProjectPair(project_first, project_second), None),
+        ("extract_fragments", lambda data: extract_fragments(*data, "Fragment", path_first), fresh_soup),
+        ("make_qdpx_project", lambda fragments: make_qdpx_project(*fragments, io.BytesIO(), None, "user"),
+         fresh_fragments),
+        ("render[preview]", lambda: srv.preview_page(project_first, "key", os.path.basename(path_first)), None),
+        ("render[compare]", lambda: srv.compare_page(project_pair, ("key_first", "key_second"),
+                                                    "first.qdpx", "second.qdpx"), None),
+    ]
+
+
+def import_times(module, repeat=3):
+    """Imports a module in `repeat` fresh interpreters.
+
+    Returns:
+        A list of (wall-clock seconds of the whole interpreter run, seconds of the import reported by `-X importtime`) tuples
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             capture_output=True, text=True, cwd=directory, check=True)
+        wall = time.perf_counter() - start
+        cumulative = None
+        for line in run.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == module:
+                cumulative = int(fields[1]) / 1e6
+        timings.append((wall, cumulative))
+    return timings
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes=("small", "medium", "large"), repeat=3, stages=None, imports=True):
+    """Generates synthetic archives of two coders for every size and times every stage of the pipeline.
+
+    Args:
+        sizes: names of sizes from SIZES
+        repeat: number of runs of every stage
+        stages: names of stages to run (all of them by default)
+        imports: whether import times of IMPORTED_MODULES are measured too (as stages `import[module]` of size `startup`)
+    Returns:
+        A JSON-serializable dictionary with the environment and the best and median timings of every stage
+    """
+    results = []
+    if imports:
+        # Compiled templates are written by the first import of srv, so it is not timed
+        import_times("srv", repeat=1)
+        for module in IMPORTED_MODULES:
+            timings = import_times(module, repeat)
+            walls = [wall for wall, _ in timings]
+            results.append({"size": "startup", "stage": f"import[{module}]",
+                            "best": min(walls), "median": statistics.median(walls),
+                            "import_best": min(cumulative for _, cumulative in timings)})
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            path_first = os.path.join(directory, f"{size}_first.qdpx")
+            path_second = os.path.join(directory, f"{size}_second.qdpx")
+            counts = make_synthetic_qdpx(path_first, **SIZES[size])
+            make_synthetic_qdpx(path_second, coder=1, **SIZES[size])
+            for name, function, setup in pipeline_stages(path_first, path_second):
+                if stages and name not in stages:
+                    continue
+                timings = measure(function, setup, repeat)
+                results.append({"size": size, **counts, "bytes": os.path.getsize(path_first),
+                                 "stage": name, "best": min(timings),
+                                 "median": statistics.median(timings)})
+    return {"version": RESULTS_VERSION,
+            "commit": git_commit(),
+            "created": datetime.datetime.now().replace(microsecond=0).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "results": results}
+
+
+def compare_results(baseline, current, threshold=1.2):
+    """Compares best timings of two benchmark runs.
+
+    Returns:
+        A list of (size, stage, baseline seconds, current seconds, ratio, regressed) tuples for stages found in both runs
+    """
+    before = {(r["size"], r["stage"]): r["best"] for r in baseline["results"]}
+    rows = []
+    for r in current["results"]:
+        key = (r["size"], r["stage"])
+        if key in before:
+            ratio = r["best"] / before[key] if before[key] else float("inf")
+            rows.append((r["size"], r["stage"], before[key], r["best"], ratio, ratio > threshold))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='QDPX benchmark',
+        description='Times parsing, comparing, extracting and rendering of synthetic\
+             QPDX archives and writes the results as JSON')
+    parser.add_argument('--sizes', '-s', nargs='+', choices=SIZES, default=list(SIZES))
+    parser.add_argument('--stages', nargs='+')
+    parser.add_argument('--repeat', '-r', type=int, default=3)
+    parser.add_argument('--no-imports', dest='imports', action='store_false',
+                        help='do not measure import times of the modules')
+    parser.add_argument('--output', '-o', default="benchmark.json")
+    parser.add_argument('--compare', '-c', help='JSON of a previous run to compare with')
+    parser.add_argument('--threshold', '-t', type=float, default=1.2,
+                        help='ratio of timings above which a stage is reported as a regression')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.repeat, args.stages, args.imports)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=1)
+    for r in results["results"]:
+        print(f'{r["size"]:8} {r["stage"]:24} best={r["best"]:.4f}s median={r["median"]:.4f}s')
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        for size, stage, before, after, ratio, regressed in compare_results(baseline, results, args.threshold):
+            print(f'{size:8} {stage:24} {before:.4f}s -> {after:.4f}s x{ratio:.2f}{" REGRESSION" if regressed else ""}')
@@ -0,0 +1,50 @@
+import argparse
+import gc
+import tracemalloc
+from parseQDPX import read_qdpx_file, Project, BACKENDS
+
+
+def retained_memory(path, lu_code_name, f_code_name, g_code_name="Grammar", backend="soup",
+                    copies=1, detach=False):
+    """Parses a QDPX archive `copies` times (like projects of several coders held for a comparison) and measures memory.
+
+    Full texts of all sources are loaded, so that projects parsed with and without detaching hold the same data.
+
+    Returns:
+        A touple containing memory retained by the projects and the peak memory during parsing (in bytes)
+    """
+    gc.collect()
+    tracemalloc.start()
+    projects = []
+    for _ in range(copies):
+        project = Project(*read_qdpx_file(path, backend), lu_code_name, f_code_name, g_code_name,
+                          keep_xml=not detach)
+        if detach:
+            project.detach()
+        else:
+            for source in project.sources:
+                source.full_text
+        projects.append(project)
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='QDPX memory benchmark',
+        description='Measures memory retained by parsed QPDX projects with and without\
+             releasing the XML tree and the archive')
+    parser.add_argument('path')
+    parser.add_argument('--lu_code_name', '-l')
+    parser.add_argument('--f_code_name', '-f')
+    parser.add_argument('--g_code_name', '-g', default="Grammar")
+    parser.add_argument('--copies', '-n', type=int, default=1)
+    args = parser.parse_args()
+
+    for backend in BACKENDS:
+        for detach in (False, True):
+            current, peak = retained_memory(args.path, args.lu_code_name, args.f_code_name,
+                                            args.g_code_name, backend, args.copies, detach)
+            print(f"{backend:8} detach={detach!s:5} retained={current / 2**20:8.1f} MiB peak={peak / 2**20:8.1f} MiB")
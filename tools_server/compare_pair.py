@@ -1,16 +1,29 @@
-from parseQDPX import Project, Metaphor, read_qdpx_file, Code
+from parseQDPX import Project, Metaphor, read_qdpx_file, Code, code_to_dict, lu_to_dict, metaphor_to_dict
 import argparse
-from pprint import pprint, pp, pformat
-import datetime
 from textwrap import indent
+from collections import Counter
+from instrumentation import phase, count
+from text_alignment import TextOffsetMap
+
+# Default number of characters by which boundaries of LUs matched through remapped texts may differ
+TEXT_TOLERANCE = 2
+
+
+def domain_name(metaphor, domain):
+    """Returns the name of the code of a metaphor domain (`Target` or `Source`), None if it is not coded."""
+    code = metaphor.info.get(domain)
+    return code.name if code is not None else None
 
 
 class MetaphorComparison:
-    def __init__(self, aligned_metaphor):
+    def __init__(self, aligned_metaphor, offset_map=None, tolerance=0):
         self.metaphor_first = aligned_metaphor[0]
         self.metaphor_second = aligned_metaphor[1]
         self.offset_first = aligned_metaphor[2]
         self.offset_second = aligned_metaphor[3]
+        # Set in the `text` mode, where LUs are matched through the texts mapped into each other
+        self.offset_map = offset_map
+        self.tolerance = tolerance
 
         self.source_domain = {"first": self.metaphor_first.info["Source"],
                               "second": self.metaphor_second.info["Source"]}
@@ -31,124 +44,257 @@ class MetaphorComparison:
         self.lu_names_first = [lu.code.name for lu in self.metaphor_first.lus]
         self.lu_names_second = [
             lu.code.name for lu in self.metaphor_second.lus]
+        names_second = set(self.lu_names_second)
         self.lu_names_common = [
-            name for name in self.lu_names_first if name in self.lu_names_second]
+            name for name in self.lu_names_first if name in names_second]
+
+        if offset_map is None:
+            aligned_lus, lus_only_first, lus_only_second = self.align_lus_by_offset()
+        else:
+            aligned_lus, lus_only_first, lus_only_second = self.align_lus_by_text(offset_map, tolerance)
+
+        aligned_elements = {}
+        for lu_pair in aligned_lus:
+            aligned_elements[lu_pair] = self.align_elements(*lu_pair)
+        self.aligned_elements = aligned_elements
+        self.lus_only_first = lus_only_first
+        self.lus_only_second = lus_only_second
+
+    def align_lus_by_offset(self):
+        # LUs are matched by code name and position relative to the start of the metaphor
+        lus_second_by_key = {}
+        for lu_second in self.metaphor_second.lus:
+            lus_second_by_key.setdefault(
+                self.lu_key(lu_second, self.offset_second), lu_second)
+        keys_first = set()
         aligned_lus = []
         lus_only_first = []
         lus_only_second = []
-
         for lu_first in self.metaphor_first.lus:
-            for lu_second in self.metaphor_second.lus:
-                if (lu_first.code.name == lu_second.code.name and
-                    lu_first.start_pos - self.offset_first == lu_second.start_pos - self.offset_second and
-                        lu_first.end_pos - self.offset_first == lu_second.end_pos - self.offset_second):
-                    aligned_lus.append((lu_first, lu_second))
-                    break
+            key = self.lu_key(lu_first, self.offset_first)
+            keys_first.add(key)
+            if key in lus_second_by_key:
+                aligned_lus.append((lu_first, lus_second_by_key[key]))
             else:
-                print("Unmatched LU found")
                 lus_only_first.append(lu_first)
         for lu_second in self.metaphor_second.lus:
-            for lu_first in self.metaphor_first.lus:
-                if (lu_first.code.name == lu_second.code.name and
-                    lu_first.start_pos - self.offset_first == lu_second.start_pos - self.offset_second and
-                        lu_first.end_pos - self.offset_first == lu_second.end_pos - self.offset_second):
-                    break
-            else:
-                print("Unmatched LU found")
+            if self.lu_key(lu_second, self.offset_second) not in keys_first:
                 lus_only_second.append(lu_second)
+        return aligned_lus, lus_only_first, lus_only_second
 
-        aligned_elements = {}
-        for lu_pair in aligned_lus:
-            aligned_elements[lu_pair] = {
-                "first": [], "second": [], "common": [], "common_names": []}
-            for element_first in lu_pair[0].Elements:
-                for element_second in lu_pair[1].Elements:
-                    if element_first.name == element_second.name:
-                        aligned_elements[lu_pair]["common"].append(
-                            element_first)
-                        aligned_elements[lu_pair]["common_names"].append(
-                            element_first.name)
-            for element_first in lu_pair[0].Elements:
-                if element_first.name not in aligned_elements[lu_pair]["common_names"]:
-                    aligned_elements[lu_pair]["first"].append(element_first)
-            for element_second in lu_pair[1].Elements:
-                if element_second.name not in aligned_elements[lu_pair]["common_names"]:
-                    aligned_elements[lu_pair]["second"].append(element_second)
-        self.aligned_elements = aligned_elements
-        self.lus_only_first = lus_only_first
-        self.lus_only_second = lus_only_second
+    def align_lus_by_text(self, offset_map, tolerance):
+        """Matches LUs with the same code name whose spans, mapped into the text of the second coder, differ by at most `tolerance` characters.
+
+        Returns:
+            A touple containing a list of (lu_first, lu_second) tuples, and lists of LUs only in the first and only in the second metaphor
+        """
+        lus_second_by_name = {}
+        for lu_second in self.metaphor_second.lus:
+            lus_second_by_name.setdefault(lu_second.code.name, []).append(lu_second)
+        aligned_lus = []
+        lus_only_first = []
+        matched_second = set()
+        for lu_first in self.metaphor_first.lus:
+            start, end = offset_map.map_span(lu_first.start_pos, lu_first.end_pos)
+            best = None
+            for lu_second in lus_second_by_name.get(lu_first.code.name, ()):
+                distance = max(abs(lu_second.start_pos - start), abs(lu_second.end_pos - end))
+                if distance <= tolerance and id(lu_second) not in matched_second and \
+                        (best is None or distance < best[0]):
+                    best = (distance, lu_second)
+            if best is None:
+                lus_only_first.append(lu_first)
+            else:
+                aligned_lus.append((lu_first, best[1]))
+                matched_second.add(id(best[1]))
+        lus_only_second = [lu for lu in self.metaphor_second.lus if id(lu) not in matched_second]
+        return aligned_lus, lus_only_first, lus_only_second
+
+    @staticmethod
+    def lu_key(lu, offset):
+        return (lu.code.name, lu.start_pos - offset, lu.end_pos - offset)
+
+    @staticmethod
+    def align_elements(lu_first, lu_second):
+        """Compares frame elements of two aligned LUs by their names.
+
+        Returns:
+            A dictionary with elements present in both LUs (`common`, `common_names`) and only in one of them (`first`, `second`)
+        """
+        counts_second = Counter(element.name for element in lu_second.Elements)
+        elements = {"first": [], "second": [], "common": [], "common_names": []}
+        for element_first in lu_first.Elements:
+            n_second = counts_second[element_first.name]
+            if n_second:
+                elements["common"].extend([element_first] * n_second)
+                elements["common_names"].extend([element_first.name] * n_second)
+            else:
+                elements["first"].append(element_first)
+        names_first = {element.name for element in lu_first.Elements}
+        for element_second in lu_second.Elements:
+            if element_second.name not in names_first:
+                elements["second"].append(element_second)
+        return elements
 
     def __repr__(self):
         return indent(f'MetaphorComparison(source_domain={self.source_domain}, \ntarget_domain = {self.target_domain}, \nmetaphor_type = {self.metaphor_type}, \nelements = {self.aligned_elements})', "\t")
 
 
 class ProjectPair:
-    def __init__(self, project_first, project_second):
+    """Comparison of two projects coding the same sources.
+
+    Attributes:
+        project_first: the first Project
+        project_second: the second Project
+        match: how metaphors are matched, `domain` (first metaphor with the same target or source domain), `overlap` (metaphor with the largest overlapping span)
+            or `text` (as `overlap`, but spans of the first project are mapped into the text of the second one, see TextOffsetMap, and so are LUs)
+        tolerance: number of characters by which boundaries of LUs may differ in the `text` mode
+        sources: dictionary with Source objects (of the first project) as keys and dictionaries with `common` (MetaphorComparison objects), `first` and `second` (unmatched Metaphor objects) as values
+
+    The optional `progress` callable is called with the number of compared sources and the number of all sources after each source.
+    """
+
+    MATCH_MODES = ("domain", "overlap", "text")
+
+    def __init__(self, project_first, project_second, match="domain", progress=None, tolerance=TEXT_TOLERANCE):
+        if match not in self.MATCH_MODES:
+            raise ValueError(f"Unknown matching mode: {match}")
         self.project_first = project_first
         self.project_second = project_second
+        self.match = match
+        self.tolerance = tolerance
         self.sources = {}
         self.align_projects()
-        self.align_sources()
+        self.align_sources(progress)
 
+    @phase("align_projects")
     def align_projects(self):
-        srcs_names_first = [
-            source.name for source in self.project_first.sources]
-        srcs_names_second = [
-            source.name for source in self.project_second.sources]
+        # When names repeat, the first source with a given name is used
+        self.srcs_first = {}
+        for source in self.project_first.sources:
+            self.srcs_first.setdefault(source.name, source)
+        self.srcs_second = {}
+        for source in self.project_second.sources:
+            self.srcs_second.setdefault(source.name, source)
         self.srcs_common = [
-            name for name in srcs_names_first if name in srcs_names_second]
+            name for name in self.srcs_first if name in self.srcs_second]
         srcs_only_first = [
-            name for name in srcs_names_first if name not in srcs_names_second]
+            name for name in self.srcs_first if name not in self.srcs_second]
         srcs_only_second = [
-            name for name in srcs_names_second if name not in srcs_names_first]
+            name for name in self.srcs_second if name not in self.srcs_first]
         if len(srcs_only_first) != 0 or len(srcs_only_second) != 0:
             raise Exception("Some documents are present only in one file!")
 
-    def align_sources(self):
-        for name in self.srcs_common:
-            src_first = [
-                source for source in self.project_first.sources if source.name == name][0]
-            src_second = [
-                source for source in self.project_second.sources if source.name == name][0]
+    @phase("align_sources")
+    def align_sources(self, progress=None):
+        for n, name in enumerate(self.srcs_common, start=1):
+            src_first = self.srcs_first[name]
+            src_second = self.srcs_second[name]
+            offset_map = self.align_texts(src_first, src_second) if self.match == "text" else None
             aligned_metaphors, metaphors_first, metaphors_second = self.find_matching_metaphors(
-                src_first, src_second)
+                src_first, src_second, offset_map)
             self.sources[src_first] = {
-                "common": [], "first": [],  "second": []}
-            for aligned_metaphor in aligned_metaphors:
-                self.sources[src_first]["common"].append(
-                    MetaphorComparison(aligned_metaphor))
-            for metaphor in metaphors_first:
-                self.sources[src_first]["first"].append(metaphor)
-            for metaphor in metaphors_second:
-                self.sources[src_first]["second"].append(metaphor)
-
-    def find_matching_metaphors(self, src_first, src_second):
+                "common": [MetaphorComparison(aligned_metaphor, offset_map, self.tolerance)
+                           for aligned_metaphor in aligned_metaphors],
+                "first": list(metaphors_first),
+                "second": list(metaphors_second)}
+            count("metaphors_matched", len(aligned_metaphors))
+            count("metaphors_unmatched", len(metaphors_first) + len(metaphors_second))
+            if progress:
+                progress(n, len(self.srcs_common))
+
+    @staticmethod
+    def align_texts(src_first, src_second):
+        with phase("align_texts"):
+            offset_map = TextOffsetMap(src_first.full_text, src_second.full_text)
+        if not offset_map.identical:
+            count("texts_realigned")
+        return offset_map
+
+    def find_matching_metaphors(self, src_first, src_second, offset_map=None):
+        if offset_map is not None:
+            pairs = self.match_by_overlap(src_first.metaphors, src_second.metaphors,
+                                          lambda m: offset_map.map_span(*m.span))
+        elif self.match == "overlap":
+            pairs = self.match_by_overlap(src_first.metaphors, src_second.metaphors)
+        else:
+            pairs = self.match_by_domain(src_first.metaphors, src_second.metaphors)
         aligned_metaphors = []
         metaphors_first = []
-        metaphors_second = []
-        for metaphor_first in src_first.metaphors:
-            for metaphor_second in src_second.metaphors:
-                if (metaphor_first.info["Target"].name == metaphor_second.info["Target"].name or
-                        metaphor_first.info["Source"].name == metaphor_second.info["Source"].name):
-                    offset_first, offset_second = self.get_offsets(
-                        metaphor_first, metaphor_second)
-                    aligned_metaphors.append(
-                        (metaphor_first, metaphor_second, offset_first, offset_second))
-                    print("Found matching pair of metaphors!")
-                    break
-            else:
+        matched_second = set()
+        for metaphor_first, metaphor_second in pairs:
+            if metaphor_second is None:
                 metaphors_first.append(metaphor_first)
+                continue
+            matched_second.add(id(metaphor_second))
+            offset_first, offset_second = self.get_offsets(
+                metaphor_first, metaphor_second)
+            aligned_metaphors.append(
+                (metaphor_first, metaphor_second, offset_first, offset_second))
+        if self.match in ("overlap", "text"):
+            metaphors_second = [metaphor for metaphor in src_second.metaphors
+                                if id(metaphor) not in matched_second]
+        else:
+            # A second metaphor is unmatched only when no first metaphor shares either domain with it
+            targets_first = {domain_name(metaphor, "Target") for metaphor in src_first.metaphors}
+            sources_first = {domain_name(metaphor, "Source") for metaphor in src_first.metaphors}
+            targets_first.discard(None)
+            sources_first.discard(None)
+            metaphors_second = [metaphor for metaphor in src_second.metaphors
+                                if domain_name(metaphor, "Target") not in targets_first and
+                                domain_name(metaphor, "Source") not in sources_first]
+        return aligned_metaphors, metaphors_first, metaphors_second
 
-        for metaphor_second in src_second.metaphors:
-            for metaphor_first in src_first.metaphors:
-                if (metaphor_first.info["Target"].name == metaphor_second.info["Target"].name or
-                        metaphor_first.info["Source"].name == metaphor_second.info["Source"].name):
-                    print("Found matching pair of metaphors!")
-                    break
-            else:
-                metaphors_second.append(metaphor_second)
+    @staticmethod
+    def match_by_domain(metaphors_first, metaphors_second):
+        """Pairs every first metaphor with the earliest second metaphor sharing its target or source domain.
 
-        return aligned_metaphors, metaphors_first, metaphors_second
+        Returns:
+            A list of (metaphor_first, metaphor_second) tuples, metaphor_second is None when nothing matches
+        """
+        by_target = {}
+        by_source = {}
+        for n, metaphor in enumerate(metaphors_second):
+            by_target.setdefault(domain_name(metaphor, "Target"), n)
+            by_source.setdefault(domain_name(metaphor, "Source"), n)
+        # Metaphors without a coded domain never match on it
+        by_target.pop(None, None)
+        by_source.pop(None, None)
+        pairs = []
+        for metaphor in metaphors_first:
+            candidates = [n for n in (by_target.get(domain_name(metaphor, "Target")),
+                                      by_source.get(domain_name(metaphor, "Source")))
+                          if n is not None]
+            pairs.append((metaphor, metaphors_second[min(candidates)] if candidates else None))
+        return pairs
+
+    @staticmethod
+    def match_by_overlap(metaphors_first, metaphors_second, span=None):
+        """Pairs every first metaphor with the second metaphor whose span overlaps it the most.
+
+        Both lists are swept once in order of their start positions. `span` optionally returns
+        the span of a first metaphor in the text of the second one (its own span by default).
+
+        Returns:
+            A list of (metaphor_first, metaphor_second) tuples (in the order of metaphors_first), metaphor_second is None when no span overlaps
+        """
+        ordered_second = sorted(metaphors_second, key=lambda m: m.span)
+        best = {}
+        active = []
+        n = 0
+        spans_first = {id(m): span(m) if span else m.span for m in metaphors_first}
+        for metaphor in sorted(metaphors_first, key=lambda m: spans_first[id(m)]):
+            start, end = spans_first[id(metaphor)]
+            while n < len(ordered_second) and ordered_second[n].span[0] < end:
+                active.append(ordered_second[n])
+                n += 1
+            active = [other for other in active if other.span[1] > start]
+            overlaps = [(min(end, other.span[1]) - max(start, other.span[0]), other)
+                        for other in active]
+            overlaps = [(size, other) for size, other in overlaps if size > 0]
+            if overlaps:
+                best[id(metaphor)] = max(overlaps, key=lambda o: o[0])[1]
+        return [(metaphor, best.get(id(metaphor))) for metaphor in metaphors_first]
 
     def get_offsets(self, metaphor_first, metaphor_second):
         return (metaphor_first.span[0], metaphor_second.span[0])
@@ -157,6 +303,41 @@ class ProjectPair:
         return indent(f'ProjectPair(Sources={self.sources})\n', "\t")
 
 
+def comparison_to_dict(comparison):
+    return {"span_first": list(comparison.metaphor_first.span),
+            "span_second": list(comparison.metaphor_second.span),
+            "source_domain": {k: code_to_dict(v) for k, v in comparison.source_domain.items()},
+            "target_domain": {k: code_to_dict(v) for k, v in comparison.target_domain.items()},
+            "metaphor_type": {k: code_to_dict(v) for k, v in comparison.metaphor_type.items()},
+            "lus": [{"first": lu_to_dict(lu_first),
+                     "second": lu_to_dict(lu_second),
+                     "elements": {k: [code_to_dict(element) for element in elements[k]]
+                                  for k in ("first", "second", "common")}}
+                    for (lu_first, lu_second), elements in comparison.aligned_elements.items()],
+            "lus_only_first": [lu_to_dict(lu) for lu in comparison.lus_only_first],
+            "lus_only_second": [lu_to_dict(lu) for lu in comparison.lus_only_second]}
+
+
+def project_pair_to_dict(project_pair, sources=None):
+    """Converts a comparison of two projects into a JSON-serializable dictionary.
+
+    Args:
+        project_pair: a ProjectPair object
+        sources: (source, source_data) items to include (all compared sources by default)
+    Returns:
+        A dictionary with compared sources, each with matched metaphors (`common`) and metaphors found only in one project
+    """
+    if sources is None:
+        sources = project_pair.sources.items()
+    return {"match": project_pair.match,
+            "sources": [{"guid": source.guid,
+                         "name": source.name,
+                         "common": [comparison_to_dict(comparison) for comparison in source_data["common"]],
+                         "first": [metaphor_to_dict(metaphor) for metaphor in source_data["first"]],
+                         "second": [metaphor_to_dict(metaphor) for metaphor in source_data["second"]]}
+                        for source, source_data in sources]}
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         prog='QDPX comparator',
@@ -169,13 +350,16 @@ if __name__ == "__main__":
     parser.add_argument('--g_code_name', '-g')
     parser.add_argument('--table', '-t')
     parser.add_argument('--prefix', '-x')
+    parser.add_argument('--match', '-m', choices=ProjectPair.MATCH_MODES, default="domain")
+    parser.add_argument('--tolerance', type=int, default=TEXT_TOLERANCE,
+                        help='characters by which boundaries of LUs may differ in the `text` mode')
     args = parser.parse_args()
 
     project_first, sources_first = read_qdpx_file(args.path_first)
-    project_second, sources_second = read_qdpx_file(args.path_first)
+    project_second, sources_second = read_qdpx_file(args.path_second)
     project_first = Project(project_first, sources_first, args.lu_code_name,
                             args.f_code_name, args.g_code_name)
     project_second = Project(project_second, sources_second, args.lu_code_name,
                              args.f_code_name, args.g_code_name)
-    project_pair = ProjectPair(project_first, project_second)
+    project_pair = ProjectPair(project_first, project_second, args.match, tolerance=args.tolerance)
     print(project_pair)
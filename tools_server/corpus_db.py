@@ -0,0 +1,368 @@
+import argparse
+import contextlib
+import os.path
+import sqlite3
+import threading
+import time
+from parseQDPX import read_qdpx_file, Project, BACKENDS
+from parse_cache import ParseCache, archive_hash
+from greek_text import fold, fold_words
+from greek_tagging import GreekTagger
+
+# Bumped whenever the schema changes, databases of older versions are recreated (their archives need ingesting again)
+SCHEMA_VERSION = 2
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    key TEXT NOT NULL,
+    ingested REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS codes (
+    archive_id INTEGER NOT NULL REFERENCES archives(id) ON DELETE CASCADE,
+    guid TEXT NOT NULL,
+    name TEXT NOT NULL,
+    parent_guid TEXT,
+    PRIMARY KEY (archive_id, guid)
+);
+CREATE TABLE IF NOT EXISTS sources (
+    archive_id INTEGER NOT NULL REFERENCES archives(id) ON DELETE CASCADE,
+    guid TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (archive_id, guid)
+);
+CREATE TABLE IF NOT EXISTS metaphors (
+    id INTEGER PRIMARY KEY,
+    archive_id INTEGER NOT NULL REFERENCES archives(id) ON DELETE CASCADE,
+    source_guid TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    target TEXT,
+    source_domain TEXT,
+    type TEXT
+);
+CREATE TABLE IF NOT EXISTS lus (
+    id INTEGER PRIMARY KEY,
+    metaphor_id INTEGER NOT NULL REFERENCES metaphors(id) ON DELETE CASCADE,
+    code_guid TEXT NOT NULL,
+    name TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    left_context TEXT NOT NULL,
+    right_context TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS elements (
+    lu_id INTEGER NOT NULL REFERENCES lus(id) ON DELETE CASCADE,
+    code_guid TEXT NOT NULL,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS lu_terms (
+    lu_id INTEGER NOT NULL REFERENCES lus(id) ON DELETE CASCADE,
+    kind TEXT NOT NULL,
+    term TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS metaphors_span ON metaphors(archive_id, source_guid, start, end);
+CREATE INDEX IF NOT EXISTS metaphors_target ON metaphors(target);
+CREATE INDEX IF NOT EXISTS metaphors_source_domain ON metaphors(source_domain);
+CREATE INDEX IF NOT EXISTS metaphors_type ON metaphors(type);
+CREATE INDEX IF NOT EXISTS lus_metaphor ON lus(metaphor_id);
+CREATE INDEX IF NOT EXISTS lus_name ON lus(name);
+CREATE INDEX IF NOT EXISTS elements_lu ON elements(lu_id);
+CREATE INDEX IF NOT EXISTS elements_name ON elements(name);
+CREATE INDEX IF NOT EXISTS lu_terms_term ON lu_terms(kind, term);
+CREATE INDEX IF NOT EXISTS lu_terms_lu ON lu_terms(lu_id);
+"""
+
+# Filters accepted by CorpusDB.metaphors with the columns they are applied to
+METAPHOR_FILTERS = {"archive": "a.name", "source": "s.name", "target": "m.target",
+                    "source_domain": "m.source_domain", "type": "m.type"}
+# Kinds of terms of the concordance: accent-folded words of LUs and accent-folded lemmata of their tokens
+TERM_KINDS = ("form", "lemma")
+# Number of characters of the text stored on both sides of every LU (shown by the concordance)
+CONTEXT = 60
+
+
+def code_name(code):
+    return code.name if code is not None else None
+
+
+class CorpusDB:
+    """Persistent SQLite store of parsed QDPX projects, queried across all archives at once.
+
+    Every archive is stored under its name (e.g. a file name identifying the coder) together with
+    the key of its content and the names of codes used for parsing (see ParseCache.make_key),
+    so ingesting an unchanged archive again does nothing and a changed one replaces the old rows.
+    Words and (if archives are tagged) lemmata of LUs are indexed with their contexts, so the
+    concordance of a term across the corpus is a single indexed query.
+
+    Attributes:
+        path: path to the SQLite database file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            for table in ("lu_terms", "elements", "lus", "metaphors", "sources", "codes", "archives"):
+                self.connection.execute(f"DROP TABLE IF EXISTS {table}")
+        self.connection.executescript(SCHEMA)
+        self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.lock = threading.Lock()
+
+    def archive_key(self, name):
+        with self.lock:
+            row = self.connection.execute("SELECT key FROM archives WHERE name = ?", (name,)).fetchone()
+        return row["key"] if row else None
+
+    def ingest(self, f, name, lu_code_name, f_code_name, g_code_name="Grammar", backend="stream", cache=None,
+               tagger=None):
+        """Parses a QDPX archive and stores it, unless the same content is already stored under the name.
+
+        Args:
+            f: relative or absolute path to the QDPX archive or a file-like object
+            name: name under which the archive is stored
+            lu_code_name, f_code_name, g_code_name: names of codes passed to Project
+            backend: parser backend
+            cache: optional ParseCache used instead of parsing the archive directly
+            tagger: optional GreekTagger whose lemmata of metaphors are indexed
+        Returns:
+            True if the archive was (re)ingested, False if it was unchanged
+        """
+        key = ParseCache.make_key(archive_hash(f), lu_code_name, f_code_name, g_code_name)
+        if tagger is not None:
+            # An archive ingested without lemmata is ingested again when it is tagged
+            key += "-tagged"
+        if self.archive_key(name) == key:
+            return False
+        if cache is not None:
+            project, _ = cache.project(f, lu_code_name, f_code_name, g_code_name, backend, name=name)
+        else:
+            project_xml, sources = read_qdpx_file(f, backend)
+            project = Project(project_xml, sources, lu_code_name, f_code_name, g_code_name)
+        tags = tagger.tag_project(project, "metaphors") if tagger is not None else None
+        self.store(project, name, key, tags)
+        return True
+
+    def store(self, project, name, key, tags=None):
+        """Replaces all rows of the archive `name` with the content of a parsed project.
+
+        Args:
+            project: a Project object
+            name: name under which the archive is stored
+            key: key of the content of the archive
+            tags: optional dictionary with GUIDs of sources as keys and SourceTags as values (see GreekTagger.tag_project)
+        """
+        with self.lock, self.connection:
+            db = self.connection
+            db.execute("DELETE FROM archives WHERE name = ?", (name,))
+            archive_id = db.execute("INSERT INTO archives (name, key, ingested) VALUES (?, ?, ?)",
+                                    (name, key, time.time())).lastrowid
+            db.executemany("INSERT OR REPLACE INTO codes VALUES (?, ?, ?, ?)",
+                           [(archive_id, code.guid, code.name, code.parent.guid if code.parent else None)
+                            for code in project.codes])
+            db.executemany("INSERT OR REPLACE INTO sources VALUES (?, ?, ?)",
+                           [(archive_id, source.guid, source.name) for source in project.sources])
+            for source in project.sources:
+                text = source.full_text
+                for metaphor in source.metaphors:
+                    metaphor_id = db.execute(
+                        "INSERT INTO metaphors (archive_id, source_guid, start, end, target, source_domain, type)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (archive_id, source.guid, metaphor.span[0], metaphor.span[1],
+                         code_name(metaphor.info.get("Target")), code_name(metaphor.info.get("Source")),
+                         code_name(metaphor.info.get("Type")))).lastrowid
+                    for lu in metaphor.lus:
+                        lu_id = db.execute(
+                            "INSERT INTO lus (metaphor_id, code_guid, name, start, end, text, left_context, right_context)"
+                            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (metaphor_id, lu.code.guid, lu.code.name, lu.start_pos, lu.end_pos, lu.full_text,
+                             text[max(0, lu.start_pos - CONTEXT):lu.start_pos],
+                             text[lu.end_pos:lu.end_pos + CONTEXT])).lastrowid
+                        db.executemany("INSERT INTO elements VALUES (?, ?, ?)",
+                                       [(lu_id, element.guid, element.name) for element in lu.Elements])
+                        terms = {("form", word) for word in fold_words(lu.full_text)}
+                        if tags is not None:
+                            terms.update(("lemma", fold(token.lemma)) for token in tags[source.guid].lu_tokens(lu)
+                                         if token.lemma)
+                        db.executemany("INSERT INTO lu_terms VALUES (?, ?, ?)",
+                                       [(lu_id, kind, term) for kind, term in terms])
+
+    def remove(self, name):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM archives WHERE name = ?", (name,))
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(sql, params)]
+
+    def archives(self):
+        """Returns stored archives with numbers of their sources and metaphors."""
+        return self.query(
+            "SELECT a.name, a.key, a.ingested,"
+            " (SELECT COUNT(*) FROM sources s WHERE s.archive_id = a.id) AS sources,"
+            " (SELECT COUNT(*) FROM metaphors m WHERE m.archive_id = a.id) AS metaphors"
+            " FROM archives a ORDER BY a.name")
+
+    def metaphors(self, limit=None, **filters):
+        """Returns metaphors across all archives matching the filters.
+
+        Args:
+            limit: maximal number of metaphors returned (all by default)
+            filters: exact names to match, any of `archive`, `source` (name of the text),
+                `target`, `source_domain` and `type`
+        Returns:
+            A list of dictionaries with the archive, source, span, domains, type and LUs (names joined with ", ")
+        """
+        where = []
+        params = []
+        for field, value in filters.items():
+            if value:
+                where.append(f"{METAPHOR_FILTERS[field]} = ?")
+                params.append(value)
+        sql = ("SELECT m.id, a.name AS archive, s.name AS source, m.start, m.end,"
+               " m.target, m.source_domain, m.type,"
+               " (SELECT GROUP_CONCAT(l.name || ' (' || l.text || ')', ', ') FROM lus l WHERE l.metaphor_id = m.id) AS lus"
+               " FROM metaphors m"
+               " JOIN archives a ON a.id = m.archive_id"
+               " JOIN sources s ON s.archive_id = m.archive_id AND s.guid = m.source_guid")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY a.name, s.name, m.start"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self.query(sql, params)
+
+    def lexical_units(self, name=None, element=None, limit=None):
+        """Returns LUs across all archives with their metaphors, optionally only LUs named `name` or having the element `element`."""
+        where = []
+        params = []
+        if name:
+            where.append("l.name = ?")
+            params.append(name)
+        if element:
+            where.append("EXISTS (SELECT 1 FROM elements e WHERE e.lu_id = l.id AND e.name = ?)")
+            params.append(element)
+        sql = ("SELECT a.name AS archive, s.name AS source, l.name, l.start, l.end, l.text,"
+               " m.target, m.source_domain, m.type,"
+               " (SELECT GROUP_CONCAT(e.name, ', ') FROM elements e WHERE e.lu_id = l.id) AS elements"
+               " FROM lus l"
+               " JOIN metaphors m ON m.id = l.metaphor_id"
+               " JOIN archives a ON a.id = m.archive_id"
+               " JOIN sources s ON s.archive_id = m.archive_id AND s.guid = m.source_guid")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY a.name, s.name, l.start"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self.query(sql, params)
+
+    def concordance(self, term, kind="form", prefix=False, limit=None):
+        """Returns LUs across all archives whose words (or lemmata) match a term, regardless of accents and case.
+
+        Args:
+            term: a word or a lemma (folded before matching, see greek_text.fold)
+            kind: `form` to match words of LUs, `lemma` to match lemmata of their tokens
+            prefix: whether terms starting with `term` match too
+            limit: maximal number of LUs returned (all by default)
+        Returns:
+            A list of dictionaries with the archive, source, span, name, text and contexts of every LU and its metaphor's domains and type
+        """
+        if kind not in TERM_KINDS:
+            raise ValueError(f"Unknown kind of terms: {kind}")
+        term = fold(term).strip()
+        if not term:
+            return []
+        if prefix:
+            # A range of the index instead of LIKE, which cannot use it
+            where = "t.term >= ? AND t.term < ?"
+            params = [kind, term, term + "\U0010ffff"]
+        else:
+            where = "t.term = ?"
+            params = [kind, term]
+        sql = ("SELECT a.name AS archive, s.name AS source, l.name, l.start, l.end, l.text,"
+               " l.left_context, l.right_context, m.target, m.source_domain, m.type"
+               " FROM lus l"
+               " JOIN metaphors m ON m.id = l.metaphor_id"
+               " JOIN archives a ON a.id = m.archive_id"
+               " JOIN sources s ON s.archive_id = m.archive_id AND s.guid = m.source_guid"
+               f" WHERE l.id IN (SELECT t.lu_id FROM lu_terms t WHERE t.kind = ? AND {where})"
+               " ORDER BY a.name, s.name, l.start")
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self.query(sql, params)
+
+    def counts(self, column):
+        """Returns numbers of metaphors per value of `column` (`target`, `source_domain` or `type`) and archive."""
+        if column not in ("target", "source_domain", "type"):
+            raise ValueError(f"Unknown column: {column}")
+        return self.query(
+            f"SELECT m.{column} AS name, a.name AS archive, COUNT(*) AS metaphors"
+            " FROM metaphors m JOIN archives a ON a.id = m.archive_id"
+            f" GROUP BY m.{column}, a.name ORDER BY m.{column}, a.name")
+
+    def names(self, column):
+        """Returns distinct values of a metaphor column (`target`, `source_domain` or `type`)."""
+        if column not in ("target", "source_domain", "type"):
+            raise ValueError(f"Unknown column: {column}")
+        return [row["name"] for row in self.query(
+            f"SELECT DISTINCT {column} AS name FROM metaphors WHERE {column} IS NOT NULL ORDER BY {column}")]
+
+    def close(self):
+        self.connection.close()
+
+    def __repr__(self):
+        return f'CorpusDB(path={self.path})'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='QDPX corpus',
+        description='Ingests QPDX archives into an SQLite database and queries metaphors\
+             across all of them')
+    parser.add_argument('--database', '-d', default="corpus.sqlite")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest = commands.add_parser('ingest')
+    ingest.add_argument('paths', nargs='+')
+    ingest.add_argument('--lu_code_name', '-l')
+    ingest.add_argument('--f_code_name', '-f')
+    ingest.add_argument('--g_code_name', '-g', default="Grammar")
+    ingest.add_argument('--backend', '-b', choices=BACKENDS, default="stream")
+    ingest.add_argument('--tag', action='store_true', help='index lemmata of LUs (needs cltk)')
+    ingest.add_argument('--tag_cache', default="tagging_cache", help='directory of cached analyses')
+    ingest.add_argument('--workers', '-w', type=int, default=1,
+                        help='number of tagging processes (0 for the number of CPUs)')
+    query = commands.add_parser('query')
+    for field in METAPHOR_FILTERS:
+        query.add_argument('--' + field)
+    query.add_argument('--limit', type=int)
+    concordance = commands.add_parser('concordance')
+    concordance.add_argument('term')
+    concordance.add_argument('--kind', '-k', choices=TERM_KINDS, default="form")
+    concordance.add_argument('--prefix', '-p', action='store_true')
+    concordance.add_argument('--limit', type=int)
+    args = parser.parse_args()
+
+    corpus = CorpusDB(args.database)
+    if args.command == "ingest":
+        with GreekTagger(args.workers or None, args.tag_cache) if args.tag else contextlib.nullcontext() as tagger:
+            for path in args.paths:
+                changed = corpus.ingest(path, os.path.basename(path), args.lu_code_name,
+                                        args.f_code_name, args.g_code_name, args.backend, tagger=tagger)
+                print(path, "ingested" if changed else "unchanged")
+    elif args.command == "concordance":
+        for lu in corpus.concordance(args.term, args.kind, args.prefix, args.limit):
+            left = lu["left_context"].replace("\n", " ")
+            right = lu["right_context"].replace("\n", " ")
+            print(f'{lu["archive"]} {lu["source"]} {lu["start"]}: {left:>{CONTEXT}} [{lu["text"]}] {right}')
+    else:
+        filters = {field: getattr(args, field) for field in METAPHOR_FILTERS}
+        for metaphor in corpus.metaphors(args.limit, **filters):
+            print(metaphor)
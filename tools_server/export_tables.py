@@ -0,0 +1,268 @@
+import argparse
+import csv
+import io
+import os
+import os.path
+from zipfile import ZipFile, ZIP_DEFLATED
+from parseQDPX import read_qdpx_file, Project, BACKENDS
+from extract_fragments_files import ChunkBuffer
+
+FORMATS = ("csv", "parquet", "arrow")
+EXTENSIONS = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
+# Columns of the normalized tables with their types (`int` or `str`)
+TABLES = {
+    "metaphors": (("metaphor_id", "int"), ("archive", "str"), ("source_guid", "str"), ("source_name", "str"),
+                  ("start", "int"), ("end", "int"), ("target_guid", "str"), ("target", "str"),
+                  ("source_domain_guid", "str"), ("source_domain", "str"), ("type_guid", "str"), ("type", "str")),
+    "lus": (("lu_id", "int"), ("metaphor_id", "int"), ("archive", "str"), ("source_guid", "str"),
+            ("code_guid", "str"), ("name", "str"), ("start", "int"), ("end", "int"), ("text", "str")),
+    "elements": (("lu_id", "int"), ("metaphor_id", "int"), ("archive", "str"),
+                 ("code_guid", "str"), ("name", "str")),
+}
+# Number of rows buffered before a row group (Parquet) or a record batch (Arrow) is written
+ROW_GROUP_SIZE = 64 * 1024
+
+
+class ExportIds:
+    """Running ids of metaphors and LUs, unique within a single export."""
+
+    def __init__(self):
+        self.metaphor = 0
+        self.lu = 0
+
+
+def source_rows(source, archive, ids, tables=TABLES):
+    """Returns rows of the given tables for a single source.
+
+    Args:
+        source: a Source object
+        archive: name of the archive the source comes from
+        ids: ExportIds advanced by the metaphors and LUs of the source
+        tables: names of the tables to build rows of (rows of the other tables are not built at all)
+    Returns:
+        A dictionary with names of the tables as keys and lists of row tuples (ordered as in TABLES) as values
+    """
+    rows = {table: [] for table in tables}
+    metaphors, lus, elements = rows.get("metaphors"), rows.get("lus"), rows.get("elements")
+    for metaphor in source.metaphors:
+        ids.metaphor += 1
+        if metaphors is not None:
+            info = [value for key in ("Target", "Source", "Type")
+                    for value in code_columns(metaphor.info.get(key))]
+            metaphors.append((ids.metaphor, archive, source.guid, source.name,
+                              metaphor.span[0], metaphor.span[1], *info))
+        if lus is None and elements is None:
+            ids.lu += len(metaphor.lus)
+            continue
+        for lu in metaphor.lus:
+            ids.lu += 1
+            if lus is not None:
+                lus.append((ids.lu, ids.metaphor, archive, source.guid, lu.code.guid, lu.code.name,
+                            lu.start_pos, lu.end_pos, lu.full_text))
+            if elements is not None:
+                for element in lu.Elements:
+                    elements.append((ids.lu, ids.metaphor, archive, element.guid, element.name))
+    return rows
+
+
+def code_columns(code):
+    return (code.guid, code.name) if code is not None else (None, None)
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet and Arrow exports need pyarrow (pip install pyarrow)") from None
+    return pyarrow
+
+
+def arrow_schema(table):
+    pa = _pyarrow()
+    types = {"int": pa.int64(), "str": pa.string()}
+    return pa.schema([(name, types[kind]) for name, kind in TABLES[table]])
+
+
+class CSVTableWriter:
+    """Writes rows of a table as UTF-8 CSV (with a header) into a binary file-like object."""
+
+    def __init__(self, f, table):
+        self.text = io.TextIOWrapper(f, encoding="utf-8", newline="")
+        self.writer = csv.writer(self.text)
+        self.writer.writerow([name for name, _ in TABLES[table]])
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.text.flush()
+        # The underlying file is closed by its owner
+        self.text.detach()
+
+
+class ArrowTableWriter:
+    """Writes rows of a table as Parquet or Arrow IPC into a binary file-like object.
+
+    Rows are buffered and written as a row group (record batch) of ROW_GROUP_SIZE rows,
+    so memory used by the writer does not grow with the table.
+    """
+
+    def __init__(self, f, table, format="parquet", row_group_size=ROW_GROUP_SIZE):
+        pa = _pyarrow()
+        self.schema = arrow_schema(table)
+        self.row_group_size = row_group_size
+        self.rows = []
+        if format == "parquet":
+            self.writer = pa.parquet.ParquetWriter(f, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(f, self.schema)
+
+    def write_rows(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        pa = _pyarrow()
+        columns = list(zip(*self.rows))
+        self.writer.write_table(pa.Table.from_arrays(
+            [pa.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+            schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def table_writer(f, table, format):
+    if format not in FORMATS:
+        raise ValueError(f"Unknown export format: {format}")
+    if format == "csv":
+        return CSVTableWriter(f, table)
+    return ArrowTableWriter(f, table, format)
+
+
+class TableExporter:
+    """Exports projects into files of normalized tables (`metaphors`, `lus` and `elements`), source by source.
+
+    Rows of a source are written as soon as it is added, so projects can be exported one after
+    another (e.g. a whole corpus) without holding more than one of them in memory.
+
+    Attributes:
+        directory: directory the tables are written to (as `table.csv`, `table.parquet` or `table.arrow`)
+        format: `csv`, `parquet` or `arrow`
+        rows: dictionary with names of the tables as keys and numbers of written rows as values
+    """
+
+    def __init__(self, directory, format="csv"):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown export format: {format}")
+        if format != "csv":
+            _pyarrow()
+        self.directory = directory
+        self.format = format
+        os.makedirs(directory, exist_ok=True)
+        self.ids = ExportIds()
+        self.rows = {table: 0 for table in TABLES}
+        self.files = {}
+        self.writers = {}
+        for table in TABLES:
+            self.files[table] = open(os.path.join(directory, table + EXTENSIONS[format]), "wb")
+            self.writers[table] = table_writer(self.files[table], table, format)
+
+    def add_source(self, source, archive):
+        for table, rows in source_rows(source, archive, self.ids).items():
+            self.writers[table].write_rows(rows)
+            self.rows[table] += len(rows)
+
+    def add_project(self, project, archive):
+        for source in project.sources:
+            self.add_source(source, archive)
+
+    def close(self):
+        for table in TABLES:
+            self.writers[table].close()
+            self.files[table].close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def export_archives(paths, directory, lu_code_name, f_code_name, g_code_name="Grammar",
+                    format="csv", backend="stream"):
+    """Exports tables of many QDPX archives into one set of files, parsing one archive at a time.
+
+    Archives are named by their file names in the `archive` column.
+
+    Returns:
+        A dictionary with names of the tables as keys and numbers of written rows as values
+    """
+    with TableExporter(directory, format) as exporter:
+        for path in paths:
+            project = Project(*read_qdpx_file(path, backend), lu_code_name, f_code_name, g_code_name)
+            exporter.add_project(project, os.path.basename(path))
+            # Texts are read from the archive only for the rows of LUs, so it can be closed right away
+            if hasattr(project.sources_raw, "close"):
+                project.sources_raw.close()
+    return exporter.rows
+
+
+def stream_tables_zip(projects, format="csv"):
+    """Generates bytes of a ZIP archive with the tables of projects, as soon as they are written.
+
+    Entries of a ZIP archive are written one after another, so sources are walked once per table
+    (building the rows of that table only).
+
+    Args:
+        projects: a list of (Project, archive name) tuples
+        format: `csv`, `parquet` or `arrow`
+    Yields:
+        Consecutive chunks of the ZIP archive
+    """
+    if format != "csv":
+        _pyarrow()
+    buffer = ChunkBuffer()
+    archive = ZipFile(buffer, "w", ZIP_DEFLATED)
+    for table in TABLES:
+        ids = ExportIds()
+        with archive.open(table + EXTENSIONS[format], "w") as f:
+            writer = table_writer(f, table, format)
+            for project, name in projects:
+                for source in project.sources:
+                    writer.write_rows(source_rows(source, name, ids, (table,))[table])
+                    yield buffer.take()
+            writer.close()
+        yield buffer.take()
+    archive.close()
+    yield buffer.take()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='QDPX tables',
+        description='Exports metaphors, lexical units and frame elements of QPDX archives\
+             as normalized CSV, Parquet or Arrow tables')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--lu_code_name', '-l')
+    parser.add_argument('--f_code_name', '-f')
+    parser.add_argument('--g_code_name', '-g', default="Grammar")
+    parser.add_argument('--backend', '-b', choices=BACKENDS, default="stream")
+    parser.add_argument('--format', '-t', choices=FORMATS, default="csv")
+    parser.add_argument('--output', '-o', default="tables")
+    args = parser.parse_args()
+
+    try:
+        rows = export_archives(args.paths, args.output, args.lu_code_name, args.f_code_name,
+                               args.g_code_name, args.format, args.backend)
+    except ImportError as e:
+        parser.error(str(e))
+    for table, n in rows.items():
+        print(table, n)
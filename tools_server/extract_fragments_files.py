@@ -1,10 +1,11 @@
 import argparse
 import datetime
 import uuid
-from parseQDPX import read_qdpx_file
-from zipfile import ZipFile, ZipInfo
-from bs4 import BeautifulSoup
+import os.path
+from parseQDPX import read_qdpx_file, Code, SourceStore
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED
 import time
+from instrumentation import phase, count
 
 
 user_guid = "DB54F35C-F8C7-4A3F-906C-074FFE27CD0F"
@@ -31,60 +32,38 @@ document_template = '''
 link_template = '''
 <Link originGUID="{originGUID}" name="Link" guid="{linkGUID}" targetGUID="{targetGUID}" color="#000000" direction="Associative"/>'''
 
+selection_template = '''
+<PlainTextSelection guid="{guid}" name="{start_pos},{end_pos}" startPosition="{start_pos}" endPosition="{end_pos}" creatingUser="{user_guid}" creationDateTime="{created}">{codings}
+</PlainTextSelection>'''
+
+coding_template = '''
+<Coding guid="{guid}" creatingUser="{user_guid}" creationDateTime="{created}"><CodeRef targetGUID="{code_guid}"/></Coding>'''
+
 users_template = '''
  <Users>
   <User name="{user}" guid="DB54F35C-F8C7-4A3F-906C-074FFE27CD0F"/>
  </Users>'''
 
 def create_document(fragment, name):
-    now = datetime.datetime.now().replace(microsecond=0).isoformat()
-    userGUID = user_guid
-    textSourceGUID = str(uuid.uuid4()).upper()
-    textSelectionGUID = str(uuid.uuid4()).upper()
-    start_pos = goto_start
-    end_pos = goto_end
-    name = name
-
-    document_xml = document_template.format(
-        now=now,
-        userGUID=userGUID,
-        textSourceGUID=textSourceGUID,
-        textSelectionGUID=textSelectionGUID,
+    """Returns XML of the document of an extracted fragment (see extract_fragments)."""
+    return document_template.format(
+        textSourceGUID=fragment["document_guid"],
+        textSelectionGUID=fragment["selection_guid"],
         start_pos=goto_start,
         end_pos=goto_end,
         name=name,
-        user_guid = user_guid
-    )
-    linkGUID = str(uuid.uuid4()).upper()
-    link_xml = link_template.format(
-        linkGUID=linkGUID,
-        originGUID=fragment["GUID"],
-        targetGUID=textSelectionGUID
+        user_guid=user_guid
     )
 
-    file = {"filename": textSourceGUID + ".txt",
-            "full_text": header + fragment["full_text"]}
-
-    return document_xml, link_xml, file
-
 
-class Code:
-    def __init__(self, name, guid, parent):
-        self.name = name
-        self.guid = guid
-        self.parent = parent
-        self.children = []
+def create_link(fragment):
+    """Returns XML of the link from a coded fragment to its document."""
+    return link_template.format(
+        linkGUID=str(uuid.uuid4()).upper(),
+        originGUID=fragment["GUID"],
+        targetGUID=fragment["selection_guid"]
+    )
 
-    def isChildOf(self, code):
-        """Checks whether a code is a descendant of another code.
-        """
-        if self.parent:
-            if code == self.parent:
-                return True
-            else:
-                return (self.parent.isChildOf(code))
-        else:
-            return False
 
 def extract_codes(project):
     codes_list = []
@@ -104,94 +83,212 @@ def extract_codes(project):
     search_for_codes(all_codes, None, codes_list)
     return codes_list
 
+@phase("extract_fragments")
 def extract_fragments(project, sources, fragment_code, filename):
+    """Extracts fragments coded with children of `fragment_code` into separate documents.
+
+    Coderefs are walked once and grouped by their target code; only positions and GUIDs of the
+    fragments are kept. Documents and files are generated while they are written, source by source,
+    so the text of a source is read (from `sources`) and decoded only when its files are written
+    and only one text is held at a time.
+
+    Args:
+        project: project.qde file as a BeautifulSoup object
+        sources: dictionary (or SourceStore) with base names of the sources files as keys and binary data as values
+        fragment_code: name of the code whose children mark the fragments
+        filename: the QDPX archive (used only if `sources` is empty)
+    Returns:
+        A touple containing a generator of XML of the documents, a list of XML of the links and
+        a generator of files to be written (dictionaries with `filename` and `full_text`)
+    """
     codes_list = extract_codes(project)
     extraction_code = None
     for code in codes_list:
         if code.name == fragment_code:
             extraction_code = code
             break
-    frags = []
-    for code in extraction_code.children:
-        frags.append((code.name, project.find_all(name="CodeRef", attrs={
-                                 "targetGUID": code.guid})))
+    frags = {code.guid: (code.name, []) for code in extraction_code.children}
+    for coderef in project.find_all("CodeRef"):
+        if coderef.get("targetGUID") in frags:
+            frags[coderef["targetGUID"]][1].append(coderef)
+    if not sources:
+        sources = SourceStore(filename)
     extracted = []
-    documents = []
     links = []
-    files = []
+    # Fragments grouped by the paths of their sources, so that every source is decoded once
+    paths = {}
     guids_map = {}
-    for name, fragments in frags:
+    for name, fragments in frags.values():
         for fragment in fragments:
-            parent_name = fragment.parent.parent.parent["name"]
-            start_position = int(fragment.parent.parent["startPosition"])
-            end_position = int(fragment.parent.parent["endPosition"])
-            path = fragment.parent.parent.parent["plainTextPath"].split("://")[1]
-            with ZipFile(filename) as qdpx_archive:
-                with qdpx_archive.open(f'sources/{path}') as text:
-                    full_text  = text.read().decode()
-                    if not path.split(".")[0] in guids_map:
-                        new_guid = str(uuid.uuid4()).upper()
-                        guids_map[path.split(".")[0]] = new_guid 
-                        files.append({"filename": new_guid + ".txt", "full_text": full_text})
-            extracted.append({"parent_name" : parent_name,
-                            "start_position" : start_position,
-                            "end_position" : end_position,
-                            "GUID" : fragment.parent.parent["guid"],
-                            "path" : path,
-                            "full_text" : full_text[start_position:end_position],
-                            "code_name" : name,
-                            "source_doc_guid" : guids_map[path.split(".")[0]]
-                            }
-                            )
-            print(full_text[start_position:end_position])
-            print(fragment.parent.parent["guid"])
-            print("---")
-
-
-    for n, fragment in enumerate(extracted):
-        document_xml, link_xml, file = create_document(
-            fragment, fragment["code_name"])
-        documents.append(document_xml)
-        links.append(link_xml)
-        files.append(file)
-    project_docs = project.find_all("TextSource")
-    for doc in project_docs:
-        doc["creatingUser"] = user_guid
-        doc["guid"] = guids_map[doc["guid"]]
-        doc["plainTextPath"] = "internal://" + doc["guid"] + ".txt"
-        doc["name"] = doc["name"] + " linked"
-        for selection in doc.find_all("PlainTextSelection"):
-            selection.clear()
-            del selection["creatingUser"]
-            del selection["creationDateTime"]
-            del selection["modifiedDateTime"]
-            del selection["modifyingUser"]
-            # del selection["name"]
-    documents = documents + [str(d) for d in project_docs] 
-    files = [dict(t) for t in {tuple(d.items()) for d in files}]
-    return documents, links, files
-
-
-def make_qdpx_project(documents, links, files, output, project, user):
-    documents_xml = "\n<Sources>\n" + "".join(documents) + "\n</Sources>"
-    links.reverse()
-    links_xml = "\n<Links>" + "".join(links) + "\n</Links>"
-
-    project_xml = f'''<?xml version="1.0" encoding="utf-8"?>\n<Project xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="urn:QDA-XML:project:1.0 http://schema.qdasoftware.org/versions/Project/v1.0/Project.xsd" name="imported" origin="MAXQDA 2022 (Release 22.4.0)" xmlns="urn:QDA-XML:project:1.0">''' + users_template.format(user = user) + documents_xml + links_xml + '\n</Project>'
-
-    files.reverse()
-    with ZipFile(output, "w") as qdpx_archive:
-        with qdpx_archive.open('project.qde', "w") as project:
-            soup = BeautifulSoup(project_xml, features="xml")
-            project.write(project_xml.encode())
-            print(project_xml)
-        #qdpx_archive.getinfo("project.qde").external_attr = 0666 << 16
+            selection = fragment.parent.parent
+            text_source = selection.parent
+            path = text_source["plainTextPath"].split("://")[1]
+            source_guid = path.split(".")[0]
+            if source_guid not in guids_map:
+                guids_map[source_guid] = str(uuid.uuid4()).upper()
+            fragment = {"parent_name": text_source["name"],
+                        "start_position": int(selection["startPosition"]),
+                        "end_position": int(selection["endPosition"]),
+                        "GUID": selection["guid"],
+                        "path": path,
+                        "code_name": name,
+                        "source_doc_guid": guids_map[source_guid],
+                        "document_guid": str(uuid.uuid4()).upper(),
+                        "selection_guid": str(uuid.uuid4()).upper()}
+            extracted.append(fragment)
+            paths.setdefault(path, []).append(fragment)
+            links.append(create_link(fragment))
+    count("fragments_extracted", len(extracted))
+
+    def documents():
+        for fragment in extracted:
+            yield create_document(fragment, fragment["code_name"])
+        # Only sources containing fragments are copied into the new project
+        for doc in project.find_all("TextSource"):
+            if doc["guid"] not in guids_map:
+                continue
+            doc["creatingUser"] = user_guid
+            doc["guid"] = guids_map[doc["guid"]]
+            doc["plainTextPath"] = "internal://" + doc["guid"] + ".txt"
+            doc["name"] = doc["name"] + " linked"
+            for selection in doc.find_all("PlainTextSelection"):
+                selection.clear()
+                del selection["creatingUser"]
+                del selection["creationDateTime"]
+                del selection["modifiedDateTime"]
+                del selection["modifyingUser"]
+                # del selection["name"]
+            yield str(doc)
+
+    def files():
+        for path, fragments in paths.items():
+            full_text = sources[path].decode()
+            yield {"filename": fragments[0]["source_doc_guid"] + ".txt", "full_text": full_text}
+            for fragment in fragments:
+                yield {"filename": fragment["document_guid"] + ".txt",
+                       "full_text": header + full_text[fragment["start_position"]:fragment["end_position"]]}
+
+    return documents(), links, files()
+
+
+project_header = '''<?xml version="1.0" encoding="utf-8"?>\n<Project xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="urn:QDA-XML:project:1.0 http://schema.qdasoftware.org/versions/Project/v1.0/Project.xsd" name="imported" origin="MAXQDA 2022 (Release 22.4.0)" xmlns="urn:QDA-XML:project:1.0">'''
+
+
+class QDPXWriter:
+    """Writes a QDPX archive entry by entry straight into its destination.
+
+    Nothing is assembled in memory: `project.qde` is written piece by piece into the archive
+    entry and every source is written as soon as it is given.
+
+    Attributes:
+        archive: the ZipFile object the archive is written to
+    """
+
+    def __init__(self, output, compresslevel=None):
+        """Inits QDPXWriter.
+
+        Args:
+            output: path or a (possibly unseekable) file-like object for the archive
+            compresslevel: None to store entries uncompressed, 0-9 to deflate them with a given level
+        """
+        if compresslevel is None:
+            self.archive = ZipFile(output, "w", ZIP_STORED)
+        else:
+            self.archive = ZipFile(output, "w", ZIP_DEFLATED, compresslevel=compresslevel)
+
+    def write_project(self, documents, links, user, header=project_header, codebook=None):
+        """Writes `project.qde` from iterables of XML of the documents and the links (and optional XML of the CodeBook)."""
+        for _ in self.project_writer(documents, links, user, header, codebook):
+            pass
+
+    def project_writer(self, documents, links, user, header=project_header, codebook=None):
+        """Writes `project.qde` as write_project does, pausing (yielding) after every document."""
+        with self.archive.open('project.qde', "w") as project:
+            project.write(header.encode())
+            project.write(users_template.format(user=user).encode())
+            if codebook:
+                project.write(codebook.encode())
+            project.write("\n<Sources>\n".encode())
+            for document in documents:
+                project.write(document.encode())
+                yield
+            project.write("\n</Sources>".encode())
+            project.write("\n<Links>".encode())
+            for link in links:
+                project.write(link.encode())
+            project.write("\n</Links>".encode())
+            project.write('\n</Project>'.encode())
+
+    def write_source(self, filename, full_text):
+        with self.archive.open('sources/' + filename, "w") as f:
+            f.write(full_text.encode())
+
+    def close(self):
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@phase("make_qdpx_project")
+def make_qdpx_project(documents, links, files, output, project, user, compresslevel=None):
+    """Writes a QDPX archive with given documents, links and source files.
+
+    Args:
+        documents: iterable of XML of the documents (TextSource elements)
+        links: iterable of XML of the links
+        files: iterable of dictionaries with `filename` and `full_text` of the sources
+        output: path or file-like object for the archive
+        project: unused, kept for compatibility
+        user: name of the user of the new project
+        compresslevel: None to store entries uncompressed, 0-9 to deflate them with a given level
+    Returns:
+        The (closed) ZipFile object
+    """
+    with QDPXWriter(output, compresslevel) as writer:
+        writer.write_project(documents, links, user)
         for file in files:
-            with qdpx_archive.open('sources/' + file['filename'], "w") as f:
-                f.write(file["full_text"].encode())
-            #qdpx_archive.getinfo("sources/" + file["filename"]).external_attr = 0666 << 16
-    #f = open("fragments.qdxp", 'r')
-    return qdpx_archive
+            writer.write_source(file['filename'], file["full_text"])
+    return writer.archive
+
+
+class ChunkBuffer:
+    """Unseekable file-like object collecting written bytes until they are taken."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_qdpx_project(documents, links, files, user, compresslevel=None):
+    """Generates bytes of a QDPX archive (as make_qdpx_project) as soon as they are written.
+
+    Yields:
+        Consecutive chunks of the archive, one per document of `project.qde` and one per source file
+    """
+    buffer = ChunkBuffer()
+    writer = QDPXWriter(buffer, compresslevel)
+    for _ in writer.project_writer(documents, links, user):
+        yield buffer.take()
+    for file in files:
+        writer.write_source(file['filename'], file["full_text"])
+        yield buffer.take()
+    writer.close()
+    yield buffer.take()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -200,6 +297,9 @@ if __name__ == "__main__":
     parser.add_argument('--path', '-p')
     parser.add_argument('--unit-code', '-u')
     parser.add_argument('--output', '-o')
+    parser.add_argument('--user', '-n', default="user")
+    parser.add_argument('--compress', '-c', type=int, choices=range(10),
+                        help='deflate level of the archive entries (stored uncompressed if not given)')
 
     args = parser.parse_args()
 
@@ -207,4 +307,5 @@ if __name__ == "__main__":
 
     documents, links, files, = extract_fragments(
         project, sources, args.unit_code, args.path)
-    qdpx_archive = make_qdpx_project(documents, links, files, args.output, project)
+    qdpx_archive = make_qdpx_project(documents, links, files, args.output, project,
+                                     args.user, args.compress)
@@ -0,0 +1,267 @@
+import argparse
+import hashlib
+from bisect import bisect_left
+from parseQDPX import read_qdpx_file, Project, BACKENDS
+from greek_text import normalize_with_offsets, fold, original_span
+from instrumentation import phase, count
+from tiered_cache import TieredCache
+
+# Part of every cache key, bumped whenever the pipeline or the shape of records changes so that stale analyses are ignored
+TAGGER_VERSION = 1
+# Processes of the CLTK pipeline whose results are not stored (embeddings take most of the time of the pipeline)
+SKIPPED_PROCESSES = ("GreekEmbeddingsProcess", "StopsProcess")
+# How far (in characters) a token is looked for after the end of the previous one
+MAX_TOKEN_GAP = 200
+SCOPES = ("sources", "metaphors")
+
+_pipeline = None
+
+
+class Token:
+    """A token of a tagged text.
+
+    Attributes:
+        start: start offset of the token in the text of the source (as LexicalUnit.start_pos)
+        end: end offset of the token in the text of the source (as LexicalUnit.end_pos)
+        string: the token as returned by the tagger
+        lemma: a lemma of the token
+        pos: a part of speech (UPOS)
+        features: morphosyntactic features (e.g. `Case=nominative|Gender=feminine|Number=singular`)
+    """
+    __slots__ = ("start", "end", "string", "lemma", "pos", "features")
+
+    def __init__(self, start, end, string, lemma, pos, features):
+        self.start = start
+        self.end = end
+        self.string = string
+        self.lemma = lemma
+        self.pos = pos
+        self.features = features
+
+    def __repr__(self):
+        return f'Token({self.string}, lemma={self.lemma}, pos={self.pos}, span=({self.start}, {self.end}))'
+
+
+class SourceTags:
+    """Tokens of a tagged source, ordered by their offsets.
+
+    Attributes:
+        tokens: a list of Token objects
+        starts: start offsets of the tokens
+    """
+
+    def __init__(self, tokens):
+        self.tokens = sorted(tokens, key=lambda token: token.start)
+        self.starts = [token.start for token in self.tokens]
+
+    def in_span(self, start, end):
+        """Returns tokens overlapping a span of the text of the source."""
+        i = bisect_left(self.starts, start)
+        # A token starting before the span may still reach into it
+        if i > 0 and self.tokens[i - 1].end > start:
+            i -= 1
+        tokens = []
+        while i < len(self.tokens) and self.tokens[i].start < end:
+            tokens.append(self.tokens[i])
+            i += 1
+        return tokens
+
+    def lu_tokens(self, lu):
+        """Returns tokens of a LexicalUnit."""
+        return self.in_span(lu.start_pos, lu.end_pos)
+
+
+def load_pipeline():
+    try:
+        from cltk import NLP
+    except ImportError:
+        raise ImportError("Greek tagging needs cltk (pip install cltk)") from None
+    nlp = NLP(language="grc", suppress_banner=True)
+    nlp.pipeline.processes = [process for process in nlp.pipeline.processes
+                              if process.__name__ not in SKIPPED_PROCESSES]
+    return nlp
+
+
+def init_tagger():
+    global _pipeline
+    _pipeline = load_pipeline()
+
+
+def features_text(features):
+    """Returns a bundle of CLTK morphosyntactic features as `Feature=value|...`, sorted by features."""
+    pairs = []
+    for feature, values in (getattr(features, "features", None) or {}).items():
+        name = getattr(feature, "__name__", str(feature))
+        pairs.append(f"{name}={','.join(getattr(value, 'name', str(value)) for value in values)}")
+    return "|".join(sorted(pairs))
+
+
+def align_tokens(text, tokens):
+    """Finds tokens in the text they come from, regardless of their normalization by the tagger.
+
+    Returns:
+        A list of (start, end) offsets in the text, or None for tokens which were not found
+    """
+    folded, starts, ends = normalize_with_offsets(text, fold=True)
+    position = 0
+    spans = []
+    for token in tokens:
+        needle = fold(token)
+        i = folded.find(needle, position, position + MAX_TOKEN_GAP + len(needle)) if needle else -1
+        if i < 0:
+            spans.append(None)
+            continue
+        spans.append(original_span(starts, ends, i, i + len(needle)))
+        position = i + len(needle)
+    return spans
+
+
+def tag_text(text):
+    """Tags a text with the CLTK pipeline of this (worker) process.
+
+    Returns:
+        A list of (start, end, string, lemma, pos, features) records, offsets of tokens which
+        could not be found in the text are None
+    """
+    global _pipeline
+    if not text.strip():
+        return []
+    if _pipeline is None:
+        _pipeline = load_pipeline()
+    words = _pipeline(text=text).words
+    spans = align_tokens(text, [word.string for word in words])
+    return [(*(span or (None, None)), word.string, word.lemma, word.upos, features_text(word.features))
+            for word, span in zip(words, spans)]
+
+
+class GreekTagger:
+    """Tags Greek texts with long-lived CLTK pipelines, caching the analyses by the hash of a text.
+
+    Loading the pipeline is slow, so it is loaded once per process: in this process or, with more
+    than one worker, once in every process of a pool kept until the tagger is closed. Analyses are kept
+    in an in-memory LRU tier and, optionally, pickled into a directory, so re-tagging an unchanged text costs nothing.
+
+    Attributes:
+        workers: number of tagging processes (1 tags in this process, None uses all CPUs)
+        cache: TieredCache of the analyses (lists of records) by make_key of their texts
+    """
+
+    def __init__(self, workers=1, directory=None, max_entries=256):
+        self.workers = workers
+        self.cache = TieredCache(max_entries, directory)
+        self.executor = None
+
+    @staticmethod
+    def make_key(text):
+        return hashlib.sha256(f"{TAGGER_VERSION}\x1f{text}".encode()).hexdigest()
+
+    def map(self, texts):
+        if self.workers == 1:
+            return map(tag_text, texts)
+        if self.executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_tagger)
+        # Texts are long, so they are sent one by one to keep the workers evenly busy
+        return self.executor.map(tag_text, texts)
+
+    @phase("tag_texts")
+    def tag(self, texts):
+        """Tags a batch of texts, each distinct uncached text once.
+
+        Returns:
+            A list of lists of records (see tag_text), in the order of `texts`
+        """
+        keys = [self.make_key(text) for text in texts]
+        analyses = {}
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key in analyses or key in missing:
+                continue
+            records = self.cache.get(key)
+            if records is None:
+                missing[key] = text
+            else:
+                analyses[key] = records
+        for key, records in zip(missing, self.map(missing.values())):
+            self.cache.put(key, records)
+            analyses[key] = records
+        count("texts_tagged", len(missing))
+        count("texts_reused", len(set(keys)) - len(missing))
+        return [analyses[key] for key in keys]
+
+    def tag_project(self, project, scope="sources"):
+        """Tags all sources of a project, or only the spans of their metaphors.
+
+        Args:
+            project: a Project object
+            scope: `sources` to tag full texts of sources, `metaphors` to tag only the spans of metaphors
+        Returns:
+            A dictionary with GUIDs of sources as keys and SourceTags objects (with offsets in the full texts of sources) as values
+        """
+        if scope not in SCOPES:
+            raise ValueError(f"Unknown scope: {scope}")
+        pieces = []
+        for source in project.sources:
+            if scope == "sources":
+                pieces.append((source, 0, source.full_text))
+            else:
+                for metaphor in source.metaphors:
+                    start, end = metaphor.span
+                    pieces.append((source, start, source.full_text[start:end]))
+        tokens = {source.guid: [] for source in project.sources}
+        unaligned = 0
+        for (source, offset, _), records in zip(pieces, self.tag([text for _, _, text in pieces])):
+            for start, end, *analysis in records:
+                if start is None:
+                    unaligned += 1
+                    continue
+                tokens[source.guid].append(Token(start + offset, end + offset, *analysis))
+        count("tokens_unaligned", unaligned)
+        return {guid: SourceTags(source_tokens) for guid, source_tokens in tokens.items()}
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def stats(self):
+        return self.cache.stats()
+
+    def __repr__(self):
+        return f'GreekTagger({self.stats()})'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='QDPX tagger',
+        description='Tags sources of a QPDX archive with lemmata, parts of speech and\
+             morphosyntactic features and prints them for every lexical unit')
+    parser.add_argument('path')
+    parser.add_argument('--lu_code_name', '-l')
+    parser.add_argument('--f_code_name', '-f')
+    parser.add_argument('--g_code_name', '-g', default="Grammar")
+    parser.add_argument('--backend', '-b', choices=BACKENDS, default="stream")
+    parser.add_argument('--scope', '-s', choices=SCOPES, default="sources")
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help='number of tagging processes (0 for the number of CPUs)')
+    parser.add_argument('--cache', '-c', default="tagging_cache",
+                        help='directory of cached analyses')
+    args = parser.parse_args()
+
+    project = Project(*read_qdpx_file(args.path, args.backend), args.lu_code_name,
+                      args.f_code_name, args.g_code_name)
+    with GreekTagger(args.workers or None, args.cache) as tagger:
+        tags = tagger.tag_project(project, args.scope)
+        for source in project.sources:
+            for metaphor in source.metaphors:
+                for lu in metaphor.lus:
+                    tokens = tags[source.guid].lu_tokens(lu)
+                    print(source.name, lu.code.name, lu.full_text,
+                          " ".join(f"{token.lemma}/{token.pos}" for token in tokens))
+        print(tagger)
@@ -0,0 +1,81 @@
+import re
+import unicodedata
+from array import array
+
+# Variants of the apostrophe (elision) found in polytonic texts, folded into "'"
+APOSTROPHES = "'’ʼ᾿᾽"
+
+
+def clusters(text):
+    """Yields (start, end) of characters of a text together with the combining marks following them."""
+    start = 0
+    for i in range(1, len(text)):
+        if not unicodedata.combining(text[i]):
+            yield start, i
+            start = i
+    if text:
+        yield start, len(text)
+
+
+def fold_cluster(cluster):
+    """Returns a character stripped of accents, breathings, diaeresis and iota subscript, in lower case (any whitespace as a space)."""
+    if cluster in APOSTROPHES:
+        return "'"
+    if cluster.isspace():
+        return " "
+    base = "".join(c for c in unicodedata.normalize("NFD", cluster) if not unicodedata.combining(c))
+    return base.lower().replace("ς", "σ")
+
+
+def normalize_with_offsets(text, fold=False):
+    """Normalizes a text to NFC (or, if `fold` is set, strips it of diacritics) keeping track of offsets.
+
+    Every character of the normalized text comes from one character (with its combining marks)
+    of the original text, so spans found in the normalized text can be mapped back to the original
+    one, e.g. to the offsets of selections (LexicalUnit.start_pos and end_pos).
+
+    Args:
+        text: an original text
+        fold: whether accents, breathings, diaeresis, iota subscript and case are folded (see fold_cluster)
+    Returns:
+        A touple containing the normalized text, and arrays of start and end offsets (in the original text)
+        of every character of the normalized text
+    """
+    convert = fold_cluster if fold else nfc
+    chars = set(text)
+    table = {ord(c): convert(c) for c in chars}
+    if all(len(piece) == 1 for piece in table.values()) and not any(map(unicodedata.combining, chars)):
+        # Without combining marks every character is converted into one, so offsets do not move
+        return text.translate(table), array("i", range(len(text))), array("i", range(1, len(text) + 1))
+    pieces = []
+    starts = array("i")
+    ends = array("i")
+    converted = {}
+    for start, end in clusters(text):
+        cluster = text[start:end]
+        piece = converted.get(cluster)
+        if piece is None:
+            piece = converted[cluster] = convert(cluster)
+        pieces.append(piece)
+        starts.extend([start] * len(piece))
+        ends.extend([end] * len(piece))
+    return "".join(pieces), starts, ends
+
+
+def nfc(cluster):
+    return unicodedata.normalize("NFC", cluster)
+
+
+def fold(text):
+    """Returns a text stripped of diacritics and case (as normalize_with_offsets with `fold` set), e.g. for queries."""
+    return "".join(fold_cluster(text[start:end]) for start, end in clusters(text))
+
+
+def fold_words(text):
+    """Returns folded words of a text (see fold), without punctuation."""
+    return re.findall(r"\w+", fold(text))
+
+
+def original_span(starts, ends, start, end):
+    """Maps a non-empty span of a normalized text to the span of the original text it comes from."""
+    return starts[start], ends[end - 1]
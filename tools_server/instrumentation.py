@@ -0,0 +1,158 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# Upper bounds (in seconds) of the buckets of latency histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _labels_text(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    """Monotonic counter with optional labels, exposed in the Prometheus text format.
+
+    Attributes:
+        name: a name of the metric
+        help: a description of the metric
+        labels: names of the labels
+        values: dictionary with tuples of label values as keys and counts as values
+        function: optional function returning such a dictionary when the metric is exposed
+            (for values counted elsewhere, e.g. hits of a cache), `values` are ignored then
+    """
+
+    type = "counter"
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.function = function
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        if self.function is not None:
+            values = self.function()
+        else:
+            with self.lock:
+                values = dict(self.values)
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels_text(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    """Value which can go up and down (e.g. a number of entries), see Counter for the attributes."""
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram:
+    """Histogram of observed values (e.g. durations in seconds) with optional labels.
+
+    Attributes:
+        name: a name of the metric
+        help: a description of the metric
+        labels: names of the labels
+        buckets: upper bounds of the buckets (the `+Inf` bucket is implicit)
+        values: dictionary with tuples of label values as keys and [bucket counts, sum, count] as values
+    """
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (buckets, total, count) in sorted(self.values.items()):
+                for bound, bucket in zip(self.buckets, buckets):
+                    labels = _labels_text(self.labels + ("le",), key + (bound,))
+                    lines.append(f"{self.name}_bucket{labels} {bucket}")
+                labels = _labels_text(self.labels + ("le",), key + ("+Inf",))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                lines.append(f"{self.name}_sum{_labels_text(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{_labels_text(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    """Collection of metrics exposed together (e.g. by the `/metrics` route of srv.py)."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self, extra=()):
+        """Returns all metrics (followed by `extra` lines) in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        lines.extend(extra)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+PHASE_SECONDS = REGISTRY.register(Histogram(
+    "qdpx_phase_seconds", "Duration of phases of parsing, comparing and extracting", ("phase",)))
+EVENTS = REGISTRY.register(Counter(
+    "qdpx_events_total", "Numbers of parsed, reused, compared and extracted objects", ("event",)))
+
+
+@contextmanager
+def phase(name):
+    """Times a phase of the pipeline into PHASE_SECONDS (usable as a context manager or a decorator)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        PHASE_SECONDS.observe(elapsed, phase=name)
+        log.debug("%s took %.4fs", name, elapsed)
+
+
+def count(event, amount=1):
+    """Adds `amount` to the counter of an event in EVENTS."""
+    EVENTS.inc(amount, event=event)
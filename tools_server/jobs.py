@@ -0,0 +1,114 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job:
+    """A unit of work run in the background by JobQueue.
+
+    Attributes:
+        id: a unique id of the job
+        key: a key identifying the inputs of the job (jobs with the same key share results)
+        kind: a kind of the job (e.g. `preview`, `compare` or `extract`)
+        status: `queued`, `running`, `done` or `failed`
+        progress: a short message describing the progress (e.g. "12/40 sources parsed")
+        result: a value returned by the job function (once done)
+        error: a message of the exception raised by the job function (if failed)
+        created: time when the job was submitted
+        finished: time when the job was done or failed (None before)
+    """
+
+    def __init__(self, key, kind):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.kind = kind
+        self.status = "queued"
+        self.progress = ""
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def report(self, message):
+        self.progress = message
+
+    def progress_reporter(self, what):
+        """Returns a callable reporting progress as "done/total `what`" (to be passed as `progress`)."""
+        def progress(done, total):
+            self.report(f"{done}/{total} {what}")
+        return progress
+
+    def to_dict(self):
+        return {"id": self.id, "kind": self.kind, "status": self.status,
+                "progress": self.progress, "error": self.error,
+                "created": self.created, "finished": self.finished}
+
+    def __repr__(self):
+        return f'Job(id={self.id}, kind={self.kind}, status={self.status}, progress={self.progress})'
+
+
+class JobQueue:
+    """Runs jobs in a bounded thread pool and keeps their results for a while.
+
+    A job submitted with the key of a job that is still queued, running or whose result has not
+    expired yet is not run again; the existing job is returned instead.
+
+    Attributes:
+        ttl: number of seconds for which finished jobs are kept
+        jobs: dictionary with ids as keys and Job objects as values
+    """
+
+    def __init__(self, max_workers=2, ttl=3600):
+        self.ttl = ttl
+        self.jobs = {}
+        self.jobs_by_key = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+
+    def submit(self, key, kind, function, *args, **kwargs):
+        """Submits a job, unless there already is one with the same key.
+
+        The job function is called with the Job object as its first argument, followed by `args` and `kwargs`.
+
+        Returns:
+            A Job object
+        """
+        with self.lock:
+            self.expire()
+            job = self.jobs_by_key.get(key)
+            if job is not None and job.status != "failed":
+                return job
+            job = Job(key, kind)
+            self.jobs[job.id] = job
+            self.jobs_by_key[key] = job
+        self.executor.submit(self.run, job, function, args, kwargs)
+        return job
+
+    def run(self, job, function, args, kwargs):
+        job.status = "running"
+        try:
+            job.result = function(job, *args, **kwargs)
+            job.status = "done"
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            job.status = "failed"
+        finally:
+            job.finished = time.time()
+
+    def get(self, job_id):
+        with self.lock:
+            self.expire()
+            return self.jobs.get(job_id)
+
+    def expire(self):
+        """Drops finished jobs older than ttl (the lock must be held)."""
+        now = time.time()
+        for job in list(self.jobs.values()):
+            if job.finished is not None and now - job.finished > self.ttl:
+                del self.jobs[job.id]
+                if self.jobs_by_key.get(job.key) is job:
+                    del self.jobs_by_key[job.key]
+
+    def __repr__(self):
+        return f'JobQueue(jobs={len(self.jobs)})'
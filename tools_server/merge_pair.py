@@ -0,0 +1,320 @@
+import argparse
+import datetime
+import uuid
+from xml.sax.saxutils import quoteattr
+from parseQDPX import read_qdpx_file, Project, BACKENDS
+from compare_pair import ProjectPair, TEXT_TOLERANCE
+from extract_fragments_files import QDPXWriter, ChunkBuffer, user_guid, selection_template, coding_template
+from text_alignment import TextOffsetMap
+from instrumentation import phase, count
+
+# Name of the top-level code whose children mark what the adjudicator still has to decide
+MARKER_CODE_NAME = "Adjudication"
+MARKERS = {"only_first": "Only first coder",
+           "only_second": "Only second coder",
+           "domains": "Different domains",
+           "elements": "Different elements"}
+# Labels of the header of a metaphor coded with its domains and type (see Metaphor.extract_info)
+LABELS = {"Target": "TARGET DOMAIN", "Source": "SOURCE DOMAIN", "Type": "METAPHOR TYPE"}
+
+
+def code_path(code):
+    """Returns names of a code and all its ancestors, starting from the top-level code."""
+    path = []
+    while code is not None:
+        path.append(code.name)
+        code = code.parent
+    return tuple(reversed(path))
+
+
+class MergedCode:
+    """A code of the merged codebook.
+
+    Attributes:
+        name: a name of the code
+        guid: a guid of the code
+        children: a list of MergedCode objects
+    """
+
+    def __init__(self, name, guid):
+        self.name = name
+        self.guid = guid
+        self.children = []
+
+    def to_xml(self):
+        inner = "".join(child.to_xml() for child in self.children)
+        return (f'\n<Code guid="{self.guid}" name={quoteattr(self.name)} isCodable="true" color="#808080">'
+                f'{inner}</Code>')
+
+
+class MergedCodebook:
+    """Union of the codebooks of two projects, codes being the same when their paths of names are.
+
+    Codes keep the GUIDs of the first project (or of the second one, for codes only it has),
+    marker codes (MARKERS) are added under MARKER_CODE_NAME.
+
+    Attributes:
+        roots: top-level MergedCode objects
+        by_path: dictionary with paths of names (see code_path) as keys and MergedCode objects as values
+        guids: dictionary with (number of the project, GUID in the project) as keys and merged GUIDs as values
+        used: set of GUIDs already given to merged codes (a GUID taken is never given to another code)
+    """
+
+    def __init__(self, project_first, project_second):
+        self.roots = []
+        self.by_path = {}
+        self.guids = {}
+        self.used = set()
+        for n, project in enumerate((project_first, project_second)):
+            # Parents are added before their children
+            for code in sorted(project.codes, key=lambda c: len(code_path(c))):
+                self.guids[(n, code.guid)] = self.add(code_path(code), code.guid).guid
+        self.markers = {key: self.add((MARKER_CODE_NAME, name)).guid for key, name in MARKERS.items()}
+
+    def add(self, path, guid=None):
+        node = self.by_path.get(path)
+        if node is not None:
+            return node
+        if len(path) > 1:
+            parent = self.add(path[:-1]).children
+        else:
+            parent = self.roots
+        if guid is None or guid in self.used:
+            guid = str(uuid.uuid4()).upper()
+        self.used.add(guid)
+        node = self.by_path[path] = MergedCode(path[-1], guid)
+        parent.append(node)
+        return node
+
+    def guid(self, code, n):
+        """Returns the merged GUID of a code of the first (`n` = 0) or the second (`n` = 1) project."""
+        return self.guids[(n, code.guid)]
+
+    def to_xml(self):
+        return "\n<CodeBook>\n<Codes>" + "".join(c.to_xml() for c in self.roots) + "\n</Codes>\n</CodeBook>"
+
+
+class AdjudicatedMerge:
+    """One project merged from a comparison of two coders, for adjudication.
+
+    Everything both coders agree on is coded once. Disagreements are coded with the codes of both
+    coders and a marker code (see MARKERS), so that only they need to be decided:
+    metaphors and LUs coded by one coder only, different domains or types of matched metaphors
+    and different frame elements of matched LUs.
+
+    The merged project uses the texts of the sources of the first project; spans coded by the second
+    coder are mapped into them (see TextOffsetMap) if the texts differ. Codebooks and texts are
+    taken from the parsed projects, neither archive is read again.
+
+    Attributes:
+        project_pair: the ProjectPair being merged
+        codebook: the MergedCodebook
+        counts: numbers of agreed and marked metaphors and LUs
+    """
+
+    def __init__(self, project_pair):
+        self.project_pair = project_pair
+        self.codebook = MergedCodebook(project_pair.project_first, project_pair.project_second)
+        self.unit_guid = self.codebook.guid(project_pair.project_first.unit_code, 0)
+        self.counts = {"metaphors_agreed": 0, "metaphors_marked": 0, "lus_agreed": 0, "lus_marked": 0}
+
+    def metaphor_selections(self, text, span, infos, marker=None):
+        """Returns selections of a metaphor (its unit and labels of the header) in the merged text.
+
+        Args:
+            text: the merged text of the source
+            span: the span of the metaphor in the merged text
+            infos: (Metaphor.info, number of the project) touples of the coders of the metaphor
+            marker: optional key of MARKERS the unit is coded with
+        """
+        selections = [(*span, [self.unit_guid] + ([self.codebook.markers[marker]] if marker else []))]
+        for key, label in LABELS.items():
+            start = text.find(label, *span)
+            guids = []
+            coded = 0
+            for info, n in infos:
+                code = info.get(key)
+                if code is None:
+                    continue
+                coded += 1
+                if self.codebook.guid(code, n) not in guids:
+                    guids.append(self.codebook.guid(code, n))
+            if start < 0 or not guids:
+                continue
+            # Different codes, or a label coded by one of the coders only
+            if len(guids) > 1 or coded < len(infos):
+                guids.append(self.codebook.markers["domains"])
+            selections.append((start, start + len(label), guids))
+        return selections
+
+    def lu_selection(self, span, lus, marker=None):
+        """Returns the selection of a LU coded by one or both coders.
+
+        Args:
+            span: the span of the LU in the merged text
+            lus: (LexicalUnit, number of the project) touples
+            marker: optional key of MARKERS the LU is coded with (`elements` is added when elements differ)
+        """
+        guids = [self.codebook.guid(lus[0][0].code, lus[0][1])]
+        elements = []
+        for lu, n in lus:
+            elements.append({self.codebook.guid(element, n) for element in lu.Elements})
+            for element in lu.Elements:
+                if self.codebook.guid(element, n) not in guids:
+                    guids.append(self.codebook.guid(element, n))
+        if marker is None and any(e != elements[0] for e in elements):
+            marker = "elements"
+        if marker is not None:
+            guids.append(self.codebook.markers[marker])
+        return (*span, guids)
+
+    def same_info(self, metaphor_first, metaphor_second):
+        """Returns whether two matched metaphors have the same domains and type (by merged codes)."""
+        for key in LABELS:
+            codes = (metaphor_first.info.get(key), metaphor_second.info.get(key))
+            guids = [self.codebook.guid(code, n) if code is not None else None for n, code in enumerate(codes)]
+            if guids[0] != guids[1]:
+                return False
+        return True
+
+    def source_selections(self, source, data):
+        """Returns the merged selections of a source as (start, end, merged GUIDs of codes) touples in document order."""
+        text = source.full_text
+        source_second = self.project_pair.srcs_second[source.name]
+        offset_map = None
+
+        def mapped(start, end):
+            # The texts are only diffed once a span of the second coder has to be mapped
+            nonlocal offset_map
+            if offset_map is None:
+                offset_map = TextOffsetMap(source_second.full_text, text)
+            if offset_map.identical:
+                return start, end
+            start, end = offset_map.map_span(start, end)
+            return min(max(start, 0), len(text)), min(max(end, 0), len(text))
+
+        selections = []
+        # Matching by domains can pair many first metaphors with the same second one, its codings are merged
+        # into the first of them only and the others are left for adjudication as metaphors of the first coder;
+        # second metaphors merged into none (even when sharing a domain with a first one) are left likewise
+        merged_second = set()
+        unmatched_first = []
+        for comparison in data["common"]:
+            first, second = comparison.metaphor_first, comparison.metaphor_second
+            if id(second) in merged_second:
+                unmatched_first.append(first)
+                continue
+            merged_second.add(id(second))
+            selections += self.metaphor_selections(text, first.span, [(first.info, 0), (second.info, 1)])
+            for lu_first, lu_second in comparison.aligned_elements:
+                selection = self.lu_selection((lu_first.start_pos, lu_first.end_pos),
+                                              [(lu_first, 0), (lu_second, 1)])
+                selections.append(selection)
+                self.counts["lus_marked" if self.codebook.markers["elements"] in selection[2]
+                            else "lus_agreed"] += 1
+            for lu in comparison.lus_only_first:
+                selections.append(self.lu_selection((lu.start_pos, lu.end_pos), [(lu, 0)], "only_first"))
+            for lu in comparison.lus_only_second:
+                selections.append(self.lu_selection(mapped(lu.start_pos, lu.end_pos), [(lu, 1)], "only_second"))
+            self.counts["lus_marked"] += len(comparison.lus_only_first) + len(comparison.lus_only_second)
+            self.counts["metaphors_agreed" if self.same_info(first, second) else "metaphors_marked"] += 1
+        unmatched_second = [metaphor for metaphor in source_second.metaphors if id(metaphor) not in merged_second]
+        for metaphors, n, marker in ((data["first"] + unmatched_first, 0, "only_first"),
+                                     (unmatched_second, 1, "only_second")):
+            for metaphor in metaphors:
+                span = metaphor.span if n == 0 else mapped(*metaphor.span)
+                selections += self.metaphor_selections(text, span, [(metaphor.info, n)], marker)
+                for lu in metaphor.lus:
+                    lu_span = (lu.start_pos, lu.end_pos) if n == 0 else mapped(lu.start_pos, lu.end_pos)
+                    selections.append(self.lu_selection(lu_span, [(lu, n)], marker))
+                self.counts["metaphors_marked"] += 1
+                self.counts["lus_marked"] += len(metaphor.lus)
+        # Spans of the second coder mapped into a text lacking them collapse and are left out
+        kept = [selection for selection in selections if selection[0] < selection[1]]
+        count("merged_spans_dropped", len(selections) - len(kept))
+        selections = kept
+        selections.sort(key=lambda selection: (selection[0], selection[1]))
+        return selections
+
+    def documents(self, created):
+        """Yields XML of the merged sources one by one (TextSource elements)."""
+        for source, data in self.project_pair.sources.items():
+            xml = [f'\n<TextSource guid="{source.guid}" name={quoteattr(source.name)} creatingUser="{user_guid}" '
+                   f'creationDateTime="{created}" plainTextPath="internal://{source.guid}.txt">']
+            for start, end, guids in self.source_selections(source, data):
+                codings = "".join(coding_template.format(guid=str(uuid.uuid4()).upper(), user_guid=user_guid,
+                                                         created=created, code_guid=guid) for guid in guids)
+                xml.append(selection_template.format(guid=str(uuid.uuid4()).upper(), start_pos=start, end_pos=end,
+                                                     user_guid=user_guid, created=created, codings=codings))
+            xml.append("\n</TextSource>")
+            yield "".join(xml)
+
+    def write_entries(self, writer, user):
+        """Writes the merged project with a QDPXWriter in one pass over the compared sources, yielding after every entry.
+
+        `project.qde` is written source by source (yielding after each of them) and then the texts
+        follow, so only one source is held as XML at a time.
+        """
+        created = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        yield from writer.project_writer(self.documents(created), [], user, codebook=self.codebook.to_xml())
+        for source in self.project_pair.sources:
+            writer.write_source(source.guid + ".txt", source.full_text)
+            yield
+        for key, value in self.counts.items():
+            count(f"merged_{key}", value)
+
+    @phase("merge_pair")
+    def write(self, output, user, compresslevel=None):
+        """Writes the merged project as a QDPX archive.
+
+        Args:
+            output: path or file-like object for the archive
+            user: name of the user (the adjudicator) of the merged project
+            compresslevel: None to store entries uncompressed, 0-9 to deflate them with a given level
+        Returns:
+            A dictionary with numbers of agreed and marked metaphors and LUs
+        """
+        with QDPXWriter(output, compresslevel) as writer:
+            for _ in self.write_entries(writer, user):
+                pass
+        return self.counts
+
+    def stream(self, user, compresslevel=None):
+        """Generates bytes of the merged QDPX archive (as write) as soon as they are written.
+
+        Yields:
+            Consecutive chunks of the archive, one per source
+        """
+        buffer = ChunkBuffer()
+        writer = QDPXWriter(buffer, compresslevel)
+        for _ in self.write_entries(writer, user):
+            yield buffer.take()
+        writer.close()
+        yield buffer.take()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='QDPX merge',
+        description='Compares two QPDX archives and writes one archive with the metaphors\
+             both coders agree on and their disagreements marked for adjudication')
+    parser.add_argument('--path_first', '-pf')
+    parser.add_argument('--path_second', '-ps')
+    parser.add_argument('--lu_code_name', '-l')
+    parser.add_argument('--f_code_name', '-f')
+    parser.add_argument('--g_code_name', '-g', default="Grammar")
+    parser.add_argument('--backend', '-b', choices=BACKENDS, default="stream")
+    parser.add_argument('--match', '-m', choices=ProjectPair.MATCH_MODES, default="overlap")
+    parser.add_argument('--tolerance', type=int, default=TEXT_TOLERANCE)
+    parser.add_argument('--output', '-o')
+    parser.add_argument('--user', '-n', default="adjudicator")
+    parser.add_argument('--compress', '-c', type=int, choices=range(10),
+                        help='deflate level of the archive entries (stored uncompressed if not given)')
+    args = parser.parse_args()
+
+    project_first = Project(*read_qdpx_file(args.path_first, args.backend), args.lu_code_name,
+                            args.f_code_name, args.g_code_name)
+    project_second = Project(*read_qdpx_file(args.path_second, args.backend), args.lu_code_name,
+                             args.f_code_name, args.g_code_name)
+    project_pair = ProjectPair(project_first, project_second, args.match, tolerance=args.tolerance)
+    print(AdjudicatedMerge(project_pair).write(args.output, args.user, args.compress))
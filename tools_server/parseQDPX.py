@@ -1,12 +1,25 @@
 from zipfile import ZipFile
-from bs4 import BeautifulSoup
-import uuid
-import datetime
+from bisect import bisect_left, bisect_right
+from xml.etree import ElementTree
+import os
 import os.path
-from pprint import pprint, pp, pformat
+import shutil
+import tempfile
 from textwrap import indent
 import argparse
-import pandas as pd
+import hashlib
+import logging
+import sys
+import zlib
+from instrumentation import phase, count
+
+log = logging.getLogger(__name__)
+
+BACKENDS = ("soup", "stream")
+# Uploaded archives up to this size are kept in memory by SourceStore, larger ones are spooled to disk
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+# Projects with fewer sources to extract are always parsed serially, even if workers are requested
+PARALLEL_MIN_SOURCES = 8
 
 
 class Project:
@@ -15,35 +28,123 @@ class Project:
     It stores both codebook with associated codes as well as source texts and codings.
 
     Attributes:
-        xml: xml of the project.qdp file as a BeautifulSoup objectect
-        sources_raw: files associated with project sources as raw data
+        xml: xml of the project.qdp file as a BeautifulSoup objectect (None if the project was read with the `stream` backend)
+        records: compact records of the project.qde file as a ProjectRecords object (None if the project was read with the `soup` backend)
+        sources_raw: files associated with project sources as raw data (a dictionary or a lazy SourceStore)
         sources: project sources as a list of Source objects
         codes: project codes as a list of Code objects
         codes_by_name: dictionary of codes with their names as keys
         codes_by_guid: dictionary of codes with their GUIDs as keys
+        lu_codes: set of codes of lexical units (children of the `LU_CODE_NAME` code)
+        frame_codes: set of all codes under the `FRAME_CODE_NAME` code
+        grammar_codes: set of all codes under the `GRAMMAR_CODE_NAME` code
+        changes: dictionary with names of `added`, `changed`, `removed` and `unchanged` sources
+            compared to the previous revision (None if the project was parsed without one)
     """
 
-    def extract_sources(self):
+    @phase("extract_sources")
+    def extract_sources(self, progress=None, previous=None, workers=1):
         """Extract sources from the raw files and project data.
 
+        Sources of the previous revision whose text and selections did not change are reused
+        together with their metaphors (copied, see Source.copy_to), only the other ones are extracted again.
+
+        With more than one worker, metaphors of the sources are extracted in a process pool
+        (see extract_in_pool), unless there are fewer than PARALLEL_MIN_SOURCES of them.
+
+        Args:
+            progress: optional callable called with the number of parsed sources and the number of all sources after each source
+            previous: optional Project parsed from the previous revision of the same archive (with the same codes)
+            workers: number of worker processes (None for the number of CPUs, 1 parses the sources serially)
         Returns:
             A list containing Source objects.
         """
-        sources = self.xml.find_all("TextSource")
+        if self.records is not None:
+            found = [(record.name, record.guid, None, SelectionIndex(record.selections))
+                     for record in self.records.sources]
+        else:
+            # Full text is read from sources_raw only when it is needed for the first time
+            found = [(source['name'], source['guid'], source, SelectionIndex.from_xml(source))
+                     for source in self.xml.find_all("TextSource")]
+        reusable = {source.guid: source for source in previous.sources} if previous is not None else {}
+        if previous is not None:
+            self.changes = {"added": [], "changed": [], "removed": [], "unchanged": []}
         sources_list = []
-        for source in sources:
-            name = source['name']
-            guid = source['guid']
-            full_text = self.sources_raw[guid + '.txt']
-            sources_list.append(Source(name, guid, source, full_text, self))
+        to_extract = []
+        for name, guid, xml, selections in found:
+            fingerprint = source_fingerprint(text_fingerprint(self.sources_raw, guid + '.txt'), selections)
+            source = reusable.pop(guid, None)
+            if source is not None and source.fingerprint == fingerprint:
+                source = source.copy_to(self, name, xml, selections)
+                self.changes["unchanged"].append(name)
+            else:
+                if previous is not None:
+                    self.changes["added" if source is None else "changed"].append(name)
+                to_extract.append(len(sources_list))
+                source = (name, guid, xml, selections, fingerprint)
+            sources_list.append(source)
+        if previous is not None:
+            self.changes["removed"] = [source.name for source in reusable.values()]
+
+        if workers != 1 and len(to_extract) >= PARALLEL_MIN_SOURCES:
+            extracted = self.extract_in_pool([sources_list[i] for i in to_extract], workers)
+        else:
+            extracted = (Source(*args[:3], None, self, *args[3:]) for args in (sources_list[i] for i in to_extract))
+        done = len(sources_list) - len(to_extract)
+        for i, source in zip(to_extract, extracted):
+            sources_list[i] = source
+            done += 1
+            count("metaphors_extracted", len(source.metaphors))
+            if progress:
+                progress(done, len(sources_list))
+        count("sources_extracted", len(to_extract))
+        count("sources_reused", len(sources_list) - len(to_extract))
         return sources_list
 
+    def extract_in_pool(self, sources, workers=None):
+        """Extracts metaphors of sources in a process pool, yielding Source objects in the order of `sources`.
+
+        Workers receive the codebook once and every source as its text and a list of
+        (guid, start, end, code GUIDs) tuples of its selections (never as XML), and send back compact metaphor records that are turned into
+        Metaphor objects referring to the codes of this project.
+
+        Args:
+            sources: a list of (name, guid, xml, selections, fingerprint) tuples
+            workers: number of worker processes (None for the number of CPUs)
+        """
+        codebook = ([(c.name, c.guid, c.parent.guid if c.parent else None) for c in self.codes],
+                    self.LU_CODE_NAME, self.FRAME_CODE_NAME, self.GRAMMAR_CODE_NAME)
+        jobs = [(name, guid, self.sources_raw[guid + '.txt'],
+                 [(s.guid, s.start_pos, s.end_pos, s.code_guids) for s in selections.selections])
+                for name, guid, _, selections, _ in sources]
+        from concurrent.futures import ProcessPoolExecutor
+        workers = workers or os.cpu_count()
+        chunksize = max(1, len(jobs) // (4 * workers))
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_source_worker,
+                                 initargs=codebook) as executor:
+            for (name, guid, xml, selections, fingerprint), records in zip(
+                    sources, executor.map(extract_source_records, jobs, chunksize=chunksize)):
+                source = Source(name, guid, xml, None, self, selections, fingerprint, metaphors=[])
+                source.metaphors = [Metaphor.from_record(source, record) for record in records]
+                yield source
+
+    @phase("extract_codes")
     def extract_codes(self):
         """Extract codes from the raw files and project data. In addition to that this function also reads hierarchical structure of codes.
         Returns:
             A list containing Code objects.
         """
         codes_list = []
+        if self.records is not None:
+            codes_by_guid = {}
+            for name, guid, parent_guid in self.records.codes:
+                parent_code = codes_by_guid.get(parent_guid)
+                c = Code(name, guid, parent_code)
+                codes_list.append(c)
+                codes_by_guid[guid] = c
+                if parent_code:
+                    parent_code.children.append(c)
+            return codes_list
         all_codes = self.xml.find("Codes")
 
         def search_for_codes(parent_xml, parent_code, codes_list):
@@ -59,22 +160,45 @@ class Project:
         search_for_codes(all_codes, None, codes_list)
         return codes_list
 
-    def __init__(self, project_xml, source_files, lu_code_name="LexicalUnit", f_code_name="Frame", g_code_name="Grammar"):
+    def __init__(self, project_xml, source_files, lu_code_name="LexicalUnit", f_code_name="Frame", g_code_name="Grammar", progress=None, previous=None, workers=1, keep_xml=False):
         """Inits Project with project_xml read from `project.qde` file and a dictionary of source files.
 
+        If a previous revision of the project is given, its unchanged sources (and their metaphors)
+        are copied to the new project instead of being extracted again. This is only done when the
+        codebook and the names of codes are the same, otherwise every source is extracted.
+
+        Once the sources are extracted the XML tree (or the records) is released (see detach),
+        unless `keep_xml` is True; texts of the sources are still read from `source_files` on demand.
+
         Args:
-            project_xml: a project.qde file compliant with REFI-QDA standard in a form of BeautifulSoup object
-            source_files: dictionary with base names of the sources fils as keys and binary data as values (read from `sources` directory in a QDPX archive)
+            project_xml: a project.qde file compliant with REFI-QDA standard in a form of BeautifulSoup object (`soup` backend) or ProjectRecords object (`stream` backend)
+            source_files: dictionary (or SourceStore) with base names of the sources fils as keys and binary data as values (read from `sources` directory in a QDPX archive)
             lu_code_name = name of the code used for lexical units
             g_code_name = name of the code used for grammatical categories
             f_code_name = name of the code used for elements of scenes
+            progress = optional callable reporting parsed sources (see extract_sources)
+            previous = optional Project parsed from the previous revision of the same archive; it is left as it is, its reused sources are copied
+            workers = number of processes extracting the sources (see extract_sources)
+            keep_xml = whether to keep the XML tree (or the records) and the XML nodes of the sources after extraction
         """
-        self.xml = project_xml
+        if isinstance(project_xml, ProjectRecords):
+            self.xml = None
+            self.records = project_xml
+        else:
+            self.xml = project_xml
+            self.records = None
         self.sources_raw = source_files
         self.codes = self.extract_codes()
         self.LU_CODE_NAME = lu_code_name
         self.GRAMMAR_CODE_NAME = g_code_name
         self.FRAME_CODE_NAME = f_code_name
+        self.changes = None
+        if previous is not None:
+            if self.same_codes(previous):
+                # Metaphors of reused sources refer to the codes of the previous revision
+                self.codes = previous.codes
+            else:
+                previous = None
         # We need to extract metaphors by one specific code
         for code in self.codes:
             if code.name == "Unit":
@@ -84,7 +208,63 @@ class Project:
         for code in self.codes:
             self.codes_by_name[code.name] = code
             self.codes_by_guid[code.guid] = code
-        self.sources = self.extract_sources()
+        self.lu_codes = self.children_of(self.LU_CODE_NAME)
+        self.frame_codes = self.descendants_of(self.FRAME_CODE_NAME)
+        self.grammar_codes = self.descendants_of(self.GRAMMAR_CODE_NAME)
+        self.sources = self.extract_sources(progress, previous, workers)
+        if not keep_xml:
+            self.detach(texts=False)
+
+    def same_codes(self, other):
+        """Checks whether another project has the same codebook and uses the same names of codes."""
+        def codebook(project):
+            return [(c.name, c.guid, c.parent.guid if c.parent else None) for c in project.codes]
+        return ((self.LU_CODE_NAME, self.FRAME_CODE_NAME, self.GRAMMAR_CODE_NAME) ==
+                (other.LU_CODE_NAME, other.FRAME_CODE_NAME, other.GRAMMAR_CODE_NAME)
+                and codebook(self) == codebook(other))
+
+    def children_of(self, name):
+        """Returns a set of direct children of the code with a given name (empty if there is no such code)."""
+        code = self.codes_by_name.get(name)
+        return set(code.children) if code else set()
+
+    def descendants_of(self, name):
+        """Returns a set of all codes under the code with a given name (empty if there is no such code)."""
+        code = self.codes_by_name.get(name)
+        if not code:
+            return set()
+        return {c for c in self.codes if code in c.ancestors}
+
+    def detach(self, texts=True):
+        """Releases the data the project was parsed from, once the sources have been extracted.
+
+        The XML tree (or the records) of project.qde and the XML nodes of the sources are dropped.
+        If `texts` is True, full texts of all sources are loaded first and the raw source files
+        are released too (closing the archive), otherwise they are still read on demand.
+        """
+        self.xml = None
+        self.records = None
+        for source in self.sources:
+            source.xml = None
+            source.selections.release()
+        if texts:
+            for source in self.sources:
+                source.full_text
+            if isinstance(self.sources_raw, SourceStore):
+                self.sources_raw.close()
+            self.sources_raw = {}
+
+    def __getstate__(self):
+        """Pickles the project without the XML tree and the open archive.
+
+        Pickled sources carry their full texts (see Source.__getstate__), so the unpickled project
+        does not need the archive, while the sources of this project still read them on demand.
+        """
+        state = self.__dict__.copy()
+        state["xml"] = None
+        state["records"] = None
+        state["sources_raw"] = {}
+        return state
 
     def __repr__(self):
         return indent(f'Project(Codes={self.codes}, \nSources={self.sources})\n', "\t")
@@ -98,50 +278,187 @@ class Code:
         guid: a guid of the code
         parent: a parent of the code
         children: a children of the code
+        ancestors: a frozenset of all codes above the code
     """
+    __slots__ = ("name", "guid", "parent", "children", "ancestors")
+
     def __init__(self, name, guid, parent):
         self.name = name
-        self.guid = guid
+        # Interned, so that GUIDs in codings of all selections share the string of the code
+        self.guid = sys.intern(guid)
         self.parent = parent
         self.children = []
+        # Parents are always created before their children, so their ancestors are already known
+        self.ancestors = parent.ancestors | {parent} if parent else frozenset()
 
     def isChildOf(self, code):
         """Checks whether a code is a descendant of another code.
         """
-        if self.parent:
-            if code == self.parent:
-                return True
-            else:
-                return (self.parent.isChildOf(code))
-        else:
-            return False
+        return code in self.ancestors
 
     def __repr__(self):
         return indent(f'Code(name={self.name})', "")
 
 
+class TextSelection:
+    """A single PlainTextSelection of a source together with its codings.
+
+    Attributes:
+        guid: a guid of the selection
+        start_pos: start position of the selection in the source file
+        end_pos: end position of the selection in the source file
+        code_guids: GUIDs of the codes assigned to the selection (in document order)
+        order: position of the selection in the source document
+    """
+    __slots__ = ("guid", "start_pos", "end_pos", "code_guids", "order")
+
+    def __init__(self, guid, s_pos, e_pos, code_guids, order):
+        self.guid = guid
+        self.start_pos = s_pos
+        self.end_pos = e_pos
+        self.code_guids = code_guids
+        self.order = order
+
+    def __repr__(self):
+        return f'TextSelection(start={self.start_pos}, end={self.end_pos}, codes={len(self.code_guids)})'
+
+
+class SelectionIndex:
+    """Index of all PlainTextSelection(s) found in a single source.
+
+    The index is built once per source. Selections are sorted by their start position,
+    so that selections falling within a span are found with a binary search, and they
+    are grouped by the text they cover, so that lookups by exact text are a single
+    dictionary access. Query results are always returned in document order.
+
+    Attributes:
+        selections: a list of TextSelection objects in document order
+        coded: a list of TextSelection objects with at least one coding in document order
+    """
+    __slots__ = ("selections", "coded", "_by_start", "_starts", "_by_text")
+
+    def __init__(self, selections):
+        """Inits SelectionIndex with a list of TextSelection objects in document order."""
+        self.selections = selections
+        self.coded = [s for s in selections if s.code_guids]
+        self._by_start = sorted(self.coded, key=lambda s: (s.start_pos, s.order))
+        self._starts = [s.start_pos for s in self._by_start]
+        self._by_text = None
+
+    @classmethod
+    def from_xml(cls, source_xml):
+        """Builds the index from the TextSource node of the BeautifulSoup tree."""
+        selections = []
+        for order, selection in enumerate(source_xml.find_all("PlainTextSelection")):
+            code_guids = tuple(sys.intern(coderef['targetGUID'])
+                               for coderef in selection.find_all("CodeRef"))
+            selections.append(TextSelection(selection.get('guid'),
+                                            int(selection['startPosition']),
+                                            int(selection['endPosition']),
+                                            code_guids, order))
+        return cls(selections)
+
+    def within(self, span):
+        """Returns coded selections lying entirely within the span (in document order)."""
+        lo = bisect_left(self._starts, span[0])
+        hi = bisect_right(self._starts, span[1])
+        found = [s for s in self._by_start[lo:hi] if s.end_pos <= span[1]]
+        found.sort(key=lambda s: s.order)
+        return found
+
+    def with_text(self, text, full_text):
+        """Returns coded selections covering exactly the given text (in document order).
+
+        The text lookup table is built from `full_text` of the source on the first call.
+        """
+        if self._by_text is None:
+            by_text = {}
+            for s in self.coded:
+                by_text.setdefault(full_text[s.start_pos:s.end_pos], []).append(s)
+            self._by_text = by_text
+        return self._by_text.get(text, [])
+
+    def release(self):
+        """Drops the text lookup table (it is built again if with_text is called)."""
+        self._by_text = None
+
+    def __len__(self):
+        return len(self.selections)
+
+
 class Source:
+    __slots__ = ("name", "guid", "xml", "_full_text", "project", "selections", "fingerprint", "metaphors")
+
     def extract_metaphors(self, unit_code):
         metaphors = []
-        selections = self.xml.find_all("PlainTextSelection")
-        for selection in selections:
-            span = (int(selection['startPosition']),
-                    int(selection['endPosition']))
-            coderef = selection.find_all("CodeRef")
-            if len(coderef) == 0:
-                continue
-            if coderef[0]['targetGUID'] == unit_code.guid:
-                print(f"Unit identified in {self.name}")
-                metaphors.append(Metaphor(self, span))
+        for selection in self.selections.coded:
+            if selection.code_guids[0] == unit_code.guid:
+                log.debug("Unit identified in %s", self.name)
+                metaphors.append(
+                    Metaphor(self, (selection.start_pos, selection.end_pos)))
         return metaphors
 
-    def __init__(self, name, guid, xml, full_text, project):
+    def __init__(self, name, guid, xml, full_text, project, selections=None, fingerprint=None, metaphors=None):
+        """Inits Source.
+
+        Args:
+            name: a name of the source
+            guid: a guid of the source
+            xml: TextSource node of the BeautifulSoup tree (None for the `stream` backend)
+            full_text: full text of the source as binary data; if None, it is read from `project.sources_raw` when it is needed for the first time
+            project: a Project the source belongs to
+            selections: a SelectionIndex of the source (built from `xml` if not given)
+            fingerprint: a fingerprint of the text and the selections of the source (see source_fingerprint)
+            metaphors: already extracted metaphors (extracted from the selections if not given)
+        """
         self.name = name
         self.guid = guid
         self.xml = xml
-        self.full_text = full_text.decode()
+        self._full_text = full_text.decode() if full_text is not None else None
         self.project = project
-        self.metaphors = self.extract_metaphors(self.project.unit_code)
+        if selections is None:
+            selections = SelectionIndex.from_xml(xml)
+        self.selections = selections
+        self.fingerprint = fingerprint
+        if metaphors is None:
+            metaphors = self.extract_metaphors(self.project.unit_code)
+        self.metaphors = metaphors
+
+    def copy_to(self, project, name, xml, selections):
+        """Returns a copy of an unchanged source (with its metaphors) for a new revision of the project.
+
+        The previous revision may still be cached and used, so the source is left as it is; the copy
+        shares only immutable data with it (the text, codes and texts of LUs).
+        """
+        source = Source.__new__(Source)
+        source.name = name
+        source.guid = self.guid
+        source.xml = xml
+        source._full_text = self._full_text
+        source.project = project
+        source.selections = selections
+        source.fingerprint = self.fingerprint
+        source.metaphors = [metaphor.copy_to(source) for metaphor in self.metaphors]
+        return source
+
+    @property
+    def full_text(self):
+        """Full text of the source, decoded on first access and cached."""
+        if self._full_text is None:
+            self._full_text = self.project.sources_raw[self.guid + '.txt'].decode()
+        return self._full_text
+
+    def __getstate__(self):
+        state = {name: getattr(self, name) for name in self.__slots__}
+        state["xml"] = None
+        if self._full_text is None:
+            # Only the pickled copy gets the text, this source keeps reading it on demand
+            state["_full_text"] = self.project.sources_raw[self.guid + '.txt'].decode()
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
 
     def __repr__(self):
         return indent(f'Source(name={self.name}, \nmetaphors={self.metaphors})\n', "\t")
@@ -158,20 +475,82 @@ class LexicalUnit:
         Elements: a list of frame elements (Code objects) associated with LexicalUnit with `Frame` as a parent node
         Grammar: a list of frame elements (Code objects) associated with LexicalUnit with `Grammar` as a parent node
     """
+    __slots__ = ("code", "start_pos", "end_pos", "full_text", "Elements")
 
     def __init__(self, code, s_pos, e_pos, full_text):
         self.code = code
         self.start_pos = s_pos
         self.end_pos = e_pos
-        self.full_text = full_text
+        # The same words are coded over and over again, so their texts are shared
+        self.full_text = sys.intern(full_text)
         self.Elements = []
 #        self.Grammar = []
 
+    def copy(self):
+        lu = LexicalUnit.__new__(LexicalUnit)
+        lu.code = self.code
+        lu.start_pos = self.start_pos
+        lu.end_pos = self.end_pos
+        lu.full_text = self.full_text
+        lu.Elements = list(self.Elements)
+        return lu
+
     def __repr__(self):
         #return f'LexicalUnit(text={self.full_text}, \ncode={self.code.name}, \nelements={self.Elements}, \ngrammar={self.Grammar})\n'
         return f'LexicalUnit(text={self.full_text}, \ncode={self.code.name}, \nelements={self.Elements})\n'
 
 
+class MetaphorInfo:
+    """Codes of the type and of the target and source domains of a metaphor.
+
+    A compact read-only mapping (slots instead of a dictionary per metaphor) of `Target`,
+    `Source` and `Type` to Code objects; keys which were not coded are missing.
+    """
+    __slots__ = ("Target", "Source", "Type")
+    KEYS = ("Target", "Source", "Type")
+
+    def __init__(self, Target=None, Source=None, Type=None):
+        self.Target = Target
+        self.Source = Source
+        self.Type = Type
+
+    def __getitem__(self, key):
+        code = getattr(self, key) if key in self.KEYS else None
+        if code is None:
+            raise KeyError(key)
+        return code
+
+    def __setitem__(self, key, code):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        setattr(self, key, code)
+
+    def get(self, key, default=None):
+        code = getattr(self, key) if key in self.KEYS else None
+        return default if code is None else code
+
+    def __contains__(self, key):
+        return key in self.KEYS and getattr(self, key) is not None
+
+    def keys(self):
+        return [key for key in self.KEYS if getattr(self, key) is not None]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def copy(self):
+        return MetaphorInfo(self.Target, self.Source, self.Type)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
 class Metaphor:
     """Representation of a metaphor found in the text.
 
@@ -185,13 +564,13 @@ class Metaphor:
         source: a Source document in which document was found
         span: start and end position of the unit of analysis
         lus: a list of LexicalUnit(s) associated with the metaphor
-        info: a dictionary containing info on metaphor type, source and target scenes and potentially other things
+        info: a MetaphorInfo with codes of the metaphor type and of its source and target scenes
     """
+    __slots__ = ("source", "span", "lus", "info")
 
-    def get_selection_data(self, coderef):
-        selection = coderef.parent.parent
-        start_pos = int(selection['startPosition'])
-        end_pos = int(selection['endPosition'])
+    def get_selection_data(self, selection):
+        start_pos = selection.start_pos
+        end_pos = selection.end_pos
         full_text = self.source.full_text[start_pos:end_pos]
         return selection, start_pos, end_pos, full_text
 
@@ -201,44 +580,41 @@ class Metaphor:
         If this function encounters a lexical unit while parsing the text, it extracts it too
 
         Returns:
-        A dictionary with info on the metaphor. _Does not_ return LexicalUnit(s), but it extracts it and saves it in Metaphor.lus
+        A MetaphorInfo with info on the metaphor. _Does not_ return LexicalUnit(s), but it extracts it and saves it in Metaphor.lus
 
         """
-        info = {}
-        coderefs = self.source.xml.find_all("CodeRef")
-        if len(coderefs) == 0:
-            print("ERROR")
-        for coderef in coderefs:
+        info = MetaphorInfo()
+        if len(self.source.selections.coded) == 0:
+            log.error("No coded selections in %s", self.source.name)
+        lu_codes = self.source.project.lu_codes
+        for selection in self.source.selections.within(self.span):
             selection, start_pos, end_pos, full_text = self.get_selection_data(
-                coderef)
-            if not ((start_pos >= self.span[0]) and (end_pos <= self.span[1])):
-                continue
-            code = self.source.project.codes_by_guid[coderef['targetGUID']]
-            if code.parent == self.source.project.codes_by_name[self.source.project.LU_CODE_NAME]:
-                self.extract_lu(code, start_pos, end_pos, full_text)
-            if full_text == "METAPHOR TYPE":
-                info["Type"] = code
-            if full_text == "TARGET DOMAIN":
-                info["Target"] = code
-            if full_text == "SOURCE DOMAIN":
-                info["Source"] = code
+                selection)
+            for guid in selection.code_guids:
+                code = self.source.project.codes_by_guid[guid]
+                if code in lu_codes:
+                    self.extract_lu(code, start_pos, end_pos, full_text)
+                if full_text == "METAPHOR TYPE":
+                    info["Type"] = code
+                if full_text == "TARGET DOMAIN":
+                    info["Target"] = code
+                if full_text == "SOURCE DOMAIN":
+                    info["Source"] = code
         return info
 
     def extract_lu(self, code, s_pos, e_pos, full_text):
-        coderefs = self.source.xml.find_all("CodeRef")
         lu = LexicalUnit(code, s_pos, e_pos, full_text)
-        if len(coderefs) == 0:
-            print("ERROR")
-        for coderef in coderefs:
-            selection, start_pos, end_pos, full_text = self.get_selection_data(
-                coderef)
-            if full_text != lu.full_text:
-                continue
-            code = self.source.project.codes_by_guid[coderef['targetGUID']]
-            #if code.isChildOf(self.source.project.codes_by_name[self.source.project.GRAMMAR_CODE_NAME]):
-            #    lu.Grammar.append(code)
-            if code.isChildOf(self.source.project.codes_by_name[self.source.project.FRAME_CODE_NAME]):
-                lu.Elements.append(code)
+        if len(self.source.selections.coded) == 0:
+            log.error("No coded selections in %s", self.source.name)
+        frame_codes = self.source.project.frame_codes
+        for selection in self.source.selections.with_text(
+                lu.full_text, self.source.full_text):
+            for guid in selection.code_guids:
+                code = self.source.project.codes_by_guid[guid]
+                #if code in self.source.project.grammar_codes:
+                #    lu.Grammar.append(code)
+                if code in frame_codes:
+                    lu.Elements.append(code)
         self.lus.append(lu)
 
     def __init__(self, source, span):
@@ -247,22 +623,270 @@ class Metaphor:
         self.lus = []
         self.info = self.extract_info()
 
+    def to_record(self):
+        """Returns the metaphor as a compact, picklable record with GUIDs of codes instead of Code objects."""
+        return (self.span,
+                {key: code.guid for key, code in self.info.items()},
+                [(lu.code.guid, lu.start_pos, lu.end_pos, lu.full_text,
+                  [element.guid for element in lu.Elements]) for lu in self.lus])
+
+    @classmethod
+    def from_record(cls, source, record):
+        """Rebuilds a metaphor of a source from a record made by to_record (without extracting it again)."""
+        span, info, lus = record
+        codes_by_guid = source.project.codes_by_guid
+        metaphor = cls.__new__(cls)
+        metaphor.source = source
+        metaphor.span = span
+        metaphor.info = MetaphorInfo(**{key: codes_by_guid[guid] for key, guid in info.items()})
+        metaphor.lus = []
+        for code_guid, s_pos, e_pos, full_text, elements in lus:
+            lu = LexicalUnit(codes_by_guid[code_guid], s_pos, e_pos, full_text)
+            lu.Elements = [codes_by_guid[guid] for guid in elements]
+            metaphor.lus.append(lu)
+        return metaphor
+
+    def copy_to(self, source):
+        """Returns a copy of the metaphor (and its LUs) belonging to another source (see Source.copy_to)."""
+        metaphor = Metaphor.__new__(Metaphor)
+        metaphor.source = source
+        metaphor.span = self.span
+        metaphor.info = self.info.copy()
+        metaphor.lus = [lu.copy() for lu in self.lus]
+        return metaphor
+
     def __repr__(self):
         return indent(f'Metaphor(info={self.info}, \nlus={self.lus})\n', "\t")
 
 
-def read_qdpx_file(path):
+# Project holding only the codebook in a worker process of Project.extract_in_pool, set by init_source_worker
+_worker_project = None
+
+
+def init_source_worker(codes, lu_code_name, f_code_name, g_code_name):
+    global _worker_project
+    records = ProjectRecords()
+    records.codes = codes
+    _worker_project = Project(records, {}, lu_code_name, f_code_name, g_code_name)
+
+
+def extract_source_records(job):
+    """Extracts metaphors of a single source in a worker process and returns them as records (see Metaphor.to_record)."""
+    name, guid, full_text, selections = job
+    selections = [TextSelection(*selection, order) for order, selection in enumerate(selections)]
+    source = Source(name, guid, None, full_text, _worker_project, SelectionIndex(selections))
+    return [metaphor.to_record() for metaphor in source.metaphors]
+
+
+def codebook_fingerprint(project):
+    """Returns a fingerprint of the GUIDs of all codes of a Project or of project.qde (read by either backend).
+
+    GUIDs of codes are generated for every project, so the fingerprint tells revisions of
+    a project from unrelated projects.
+    """
+    if isinstance(project, Project):
+        guids = [code.guid for code in project.codes]
+    elif isinstance(project, ProjectRecords):
+        guids = [guid for _, guid, _ in project.codes]
+    else:
+        guids = [code["guid"] for code in project.find_all("Code")]
+    return hashlib.sha256("\x1f".join(sorted(guids)).encode()).hexdigest()[:16]
+
+
+def text_fingerprint(sources_raw, basename):
+    """Returns a fingerprint of a source file without decompressing it if possible (None if it is missing).
+
+    For a SourceStore the CRC and the size stored in the archive are used, otherwise they are computed from the data.
+    """
+    if isinstance(sources_raw, SourceStore):
+        info = sources_raw.infos.get(basename)
+        return (info.CRC, info.file_size) if info is not None else None
+    data = sources_raw.get(basename)
+    return (zlib.crc32(data), len(data)) if data is not None else None
+
+
+def source_fingerprint(text_print, selections):
+    """Returns a fingerprint of a source made of the fingerprint of its text and its selections with their codings."""
+    digest = hashlib.sha1(repr(text_print).encode())
+    for s in selections.selections:
+        digest.update(f"{s.guid}\x1f{s.start_pos}\x1f{s.end_pos}\x1f{','.join(s.code_guids)}\n".encode())
+    return digest.hexdigest()
+
+
+class SourceRecord:
+    """Compact record of a TextSource read from project.qde by the `stream` backend.
+
+    Attributes:
+        name: a name of the source
+        guid: a guid of the source
+        path: a plainTextPath of the source
+        selections: a list of TextSelection objects in document order
+    """
+
+    def __init__(self, name, guid, path):
+        self.name = name
+        self.guid = guid
+        self.path = path
+        self.selections = []
+
+    def __repr__(self):
+        return f'SourceRecord(name={self.name}, selections={len(self.selections)})'
+
+
+class ProjectRecords:
+    """Compact records of a project.qde file read by the `stream` backend.
+
+    Attributes:
+        codes: a list of (name, guid, parent_guid) tuples in document order
+        sources: a list of SourceRecord objects in document order
+    """
+
+    def __init__(self):
+        self.codes = []
+        self.sources = []
+
+    def __repr__(self):
+        return f'ProjectRecords(codes={len(self.codes)}, sources={len(self.sources)})'
+
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def parse_qde_stream(project_file):
+    """Parses project.qde incrementally into ProjectRecords.
+
+    The XML is read with an incremental parser and every element is discarded as soon
+    as its record has been emitted, so the whole tree is never held in memory.
+
+    Args:
+        project_file: a file-like object (or path) with the project.qde file
+    Returns:
+        A ProjectRecords object
+    """
+    records = ProjectRecords()
+    elements = []
+    code_guids = []
+    in_codes = False
+    source = None
+    selection = None
+    for event, elem in ElementTree.iterparse(project_file, events=("start", "end")):
+        tag = _local_name(elem.tag)
+        if event == "start":
+            elements.append(elem)
+            if tag == "Codes":
+                in_codes = True
+            elif tag == "Code" and in_codes:
+                records.codes.append((elem.get("name"), elem.get("guid"),
+                                      code_guids[-1] if code_guids else None))
+                code_guids.append(elem.get("guid"))
+            elif tag == "TextSource":
+                source = SourceRecord(elem.get("name"), elem.get("guid"),
+                                      elem.get("plainTextPath"))
+            elif tag == "PlainTextSelection" and source is not None:
+                selection = TextSelection(elem.get("guid"),
+                                          int(elem.get("startPosition")),
+                                          int(elem.get("endPosition")),
+                                          [], len(source.selections))
+            elif tag == "CodeRef" and selection is not None:
+                selection.code_guids.append(sys.intern(elem.get("targetGUID")))
+            continue
+        if tag == "Codes":
+            in_codes = False
+        elif tag == "Code" and in_codes:
+            code_guids.pop()
+        elif tag == "PlainTextSelection" and selection is not None:
+            selection.code_guids = tuple(selection.code_guids)
+            source.selections.append(selection)
+            selection = None
+        elif tag == "TextSource":
+            records.sources.append(source)
+            source = None
+        elements.pop()
+        elem.clear()
+        if elements:
+            elements[-1].remove(elem)
+    return records
+
+
+class SourceStore:
+    """Lazy, read-only mapping of the files in the `sources` directory of a QDPX archive.
+
+    The archive is kept open (uploaded files are first copied to a spooled temporary file)
+    and a file is decompressed only when it is accessed. Nothing is cached here; Source
+    caches its decoded full text instead.
+
+    Attributes:
+        archive: the open ZipFile object
+        infos: dictionary with base names of the sources files as keys and ZipInfo objects as values
+    """
+
+    def __init__(self, path):
+        """Inits SourceStore with a path or a file-like object with the QDPX archive."""
+        self._spool = None
+        if not isinstance(path, (str, os.PathLike)):
+            self._spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+            if hasattr(path, "seek"):
+                path.seek(0)
+            shutil.copyfileobj(path, self._spool)
+            self._spool.seek(0)
+            path = self._spool
+        self.archive = ZipFile(path)
+        self.infos = {}
+        for f in self.archive.infolist():
+            if f.filename.startswith("sources"):
+                self.infos[os.path.basename(f.filename)] = f
+
+    def __getitem__(self, basename):
+        with self.archive.open(self.infos[basename]) as source:
+            return source.read()
+
+    def get(self, basename, default=None):
+        if basename not in self.infos:
+            return default
+        return self[basename]
+
+    def __contains__(self, basename):
+        return basename in self.infos
+
+    def __iter__(self):
+        return iter(self.infos)
+
+    def __len__(self):
+        return len(self.infos)
+
+    def keys(self):
+        return self.infos.keys()
+
+    def close(self):
+        self.archive.close()
+        if self._spool is not None:
+            self._spool.close()
+
+    def __repr__(self):
+        return f'SourceStore(files={len(self.infos)})'
+
+
+@phase("read_qdpx_file")
+def read_qdpx_file(path, backend="soup", lazy=True):
     """Reads QDPX archive and return a Project object.
 
     Args:
-        path: relative or absolute path to the QDPX archive
+        path: relative or absolute path to the QDPX archive (or a file-like object)
+        backend: parser used for project.qde, either `soup` (BeautifulSoup tree) or `stream` (incremental parser emitting compact records)
+        lazy: if True, sources are returned as a SourceStore reading each file from the archive on demand, otherwise all of them are read into a dictionary
     Returns:
         A touple containing parsed data from project.qde file and sources from sources directory
     """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown parser backend: {backend}")
+    if lazy:
+        sources = SourceStore(path)
+        with sources.archive.open('project.qde') as project:
+            return _read_project(project, backend), sources
     with ZipFile(path) as qdpx_archive:
         with qdpx_archive.open('project.qde') as project:
-            project_file = project.read()
-            project = BeautifulSoup(project_file, features="xml")
+            project = _read_project(project, backend)
         sources = {}
         for f in qdpx_archive.infolist():
             if f.filename.startswith("sources"):
@@ -273,7 +897,18 @@ def read_qdpx_file(path):
         return project, sources
 
 
+def _read_project(project_file, backend):
+    with phase(f"parse_project[{backend}]"):
+        if backend == "stream":
+            return parse_qde_stream(project_file)
+        # Imported only when it is needed, the `stream` backend does not use it
+        from bs4 import BeautifulSoup
+        return BeautifulSoup(project_file.read(), features="xml")
+
+
 def project_to_table(project, prefix = ''):
+    # pandas takes longer to import than most archives take to parse, so it is imported only here
+    import pandas as pd
     metaphors = []
     for source in project.sources:
         for n, metaphor in enumerate(source.metaphors, start=1):
@@ -287,6 +922,50 @@ def project_to_table(project, prefix = ''):
             metaphors.append(record)
     return pd.DataFrame(metaphors)
 
+def code_to_dict(code):
+    if code is None:
+        return None
+    return {"guid": code.guid, "name": code.name}
+
+
+def lu_to_dict(lu):
+    return {"code": code_to_dict(lu.code),
+            "start": lu.start_pos,
+            "end": lu.end_pos,
+            "text": lu.full_text,
+            "elements": [code_to_dict(element) for element in lu.Elements]}
+
+
+def metaphor_to_dict(metaphor):
+    return {"span": list(metaphor.span),
+            "target": code_to_dict(metaphor.info.get("Target")),
+            "source": code_to_dict(metaphor.info.get("Source")),
+            "type": code_to_dict(metaphor.info.get("Type")),
+            "lus": [lu_to_dict(lu) for lu in metaphor.lus]}
+
+
+def source_to_dict(source):
+    return {"guid": source.guid,
+            "name": source.name,
+            "metaphors": [metaphor_to_dict(metaphor) for metaphor in source.metaphors]}
+
+
+def project_to_dict(project, sources=None):
+    """Converts a project into a JSON-serializable dictionary.
+
+    Args:
+        project: a Project object
+        sources: sources to include (all sources of the project by default)
+    Returns:
+        A dictionary with codes (with GUIDs of their parents) and sources with their metaphors, LUs and elements
+    """
+    if sources is None:
+        sources = project.sources
+    return {"codes": [dict(code_to_dict(code), parent=code.parent.guid if code.parent else None)
+                      for code in project.codes],
+            "sources": [source_to_dict(source) for source in sources]}
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         prog='QDPX parser',
@@ -298,11 +977,13 @@ if __name__ == "__main__":
     parser.add_argument('--g_code_name', '-g')
     parser.add_argument('--table', '-t')
     parser.add_argument('--prefix', '-x')
+    parser.add_argument('--backend', '-b', choices=BACKENDS, default="soup")
+    parser.add_argument('--workers', '-w', type=int, default=1)
     args = parser.parse_args()
 
-    project, sources = read_qdpx_file(args.path)
+    project, sources = read_qdpx_file(args.path, args.backend)
     project = Project(project, sources, args.lu_code_name,
-                      args.f_code_name, args.g_code_name)
+                      args.f_code_name, args.g_code_name, workers=args.workers)
     print(project)
     if args.table:
         project_to_table(project).to_excel(args.table)
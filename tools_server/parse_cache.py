@@ -0,0 +1,93 @@
+import hashlib
+import os
+import re
+from parseQDPX import read_qdpx_file, Project, codebook_fingerprint
+from tiered_cache import TieredCache
+
+# Size of chunks in which uploaded archives are hashed
+CHUNK_SIZE = 1024 * 1024
+# Part of every cache key, bumped whenever parsed objects change shape so that stale pickles are ignored
+FORMAT_VERSION = 5
+
+
+def archive_hash(f):
+    """Computes SHA-256 of a QDPX archive without loading it into memory at once.
+
+    Args:
+        f: relative or absolute path to the QDPX archive or a file-like object (rewound afterwards)
+    Returns:
+        A hex digest of the archive bytes
+    """
+    digest = hashlib.sha256()
+    if isinstance(f, (str, os.PathLike)):
+        with open(f, "rb") as archive:
+            for chunk in iter(lambda: archive.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+    f.seek(0)
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+        digest.update(chunk)
+    f.seek(0)
+    return digest.hexdigest()
+
+
+class ParseCache(TieredCache):
+    """Cache of parsed Project objects keyed by the content of the QDPX archive.
+
+    The key is a hash of the archive bytes together with the names of codes used for parsing,
+    so the same file uploaded again is never parsed twice. Projects are kept in an in-memory
+    LRU tier and, optionally, pickled into a directory so that they survive restarts (see TieredCache).
+
+    Attributes:
+        workers: number of processes extracting sources of a parsed project (see Project.extract_sources)
+        revisions: dictionary with names of archives, fingerprints of their codebooks (see codebook_fingerprint)
+            and names of codes as keys and keys of their latest revisions as values
+    """
+
+    # Hex digests of the archive and of the parameters (see make_key)
+    KEY_PATTERN = re.compile(r"[0-9a-f]{64}-[0-9a-f]{16}")
+
+    def __init__(self, max_entries=16, directory=None, workers=1):
+        super().__init__(max_entries, directory)
+        self.workers = workers
+        self.revisions = {}
+
+    @staticmethod
+    def make_key(digest, lu_code_name, f_code_name, g_code_name):
+        params = "\x1f".join(str(p) for p in (FORMAT_VERSION, lu_code_name, f_code_name, g_code_name))
+        return digest + "-" + hashlib.sha256(params.encode()).hexdigest()[:16]
+
+    def project(self, f, lu_code_name, f_code_name, g_code_name, backend="soup", progress=None, name=None):
+        """Returns a parsed Project for the QDPX archive, parsing it only on a cache miss.
+
+        If the archive is named and a previous revision of it is still cached, only its changed
+        sources are parsed (see Project). A previous revision has the same name and the same
+        codebook (by GUIDs of codes), so unrelated archives uploaded under the same name are not mixed up.
+
+        Args:
+            f: relative or absolute path to the QDPX archive or a file-like object
+            lu_code_name, f_code_name, g_code_name: names of codes passed to Project
+            backend: parser backend used on a cache miss
+            progress: optional callable reporting parsed sources (see Project.extract_sources)
+            name: optional name of the archive (e.g. the name of the uploaded file) under which its revisions are tracked
+        Returns:
+            A touple containing the Project object and its cache key
+        """
+        key = self.make_key(archive_hash(f), lu_code_name, f_code_name, g_code_name)
+        project = self.get(key)
+        if project is not None:
+            if name is not None:
+                self.revisions[(name, codebook_fingerprint(project), lu_code_name, f_code_name, g_code_name)] = key
+            return project, key
+        project_xml, sources = read_qdpx_file(f, backend)
+        revision = (name, codebook_fingerprint(project_xml), lu_code_name, f_code_name, g_code_name)
+        previous = None
+        if name is not None and self.revisions.get(revision):
+            previous = self.get(self.revisions[revision])
+        # Only texts are still read from the archive, the XML tree is released by Project
+        project = Project(project_xml, sources, lu_code_name, f_code_name, g_code_name, progress, previous,
+                          self.workers)
+        self.put(key, project)
+        if name is not None:
+            self.revisions[revision] = key
+        return project, key
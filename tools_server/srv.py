@@ -1,11 +1,50 @@
+import cProfile
+import gzip
+import hashlib
+import json
+import logging
+import os
 import re
-from markupsafe import Markup, escape
-from jinja2 import pass_eval_context, Environment, PackageLoader, select_autoescape
-from flask import Flask, render_template, request, url_for, send_from_directory
-from parseQDPX import read_qdpx_file, Project
-from extract_fragments_files import extract_fragments, make_qdpx_project
 import shutil
-from compare_pair import ProjectPair
+import tempfile
+import threading
+import time
+from functools import lru_cache
+from math import ceil
+from urllib.parse import urlencode
+from markupsafe import Markup, escape
+import jinja2
+from jinja2 import pass_eval_context, ChoiceLoader, Environment, ModuleLoader, PackageLoader, select_autoescape
+from flask import Flask, Response, abort, g, redirect, render_template, request, url_for, send_from_directory, stream_with_context
+from parseQDPX import read_qdpx_file, BACKENDS, SPOOL_MAX_SIZE, project_to_dict
+from parse_cache import ParseCache, archive_hash
+from tiered_cache import TieredCache
+from jobs import JobQueue
+from extract_fragments_files import extract_fragments, make_qdpx_project, stream_qdpx_project
+from compare_pair import ProjectPair, TEXT_TOLERANCE, project_pair_to_dict
+from merge_pair import AdjudicatedMerge
+from corpus_db import CorpusDB, TERM_KINDS
+from greek_tagging import GreekTagger
+from text_search import TextIndex, CONTEXT as SEARCH_CONTEXT, Highlighter, hit_spans
+from export_tables import FORMATS as TABLE_FORMATS, stream_tables_zip
+from instrumentation import REGISTRY, Counter, Gauge, Histogram, phase
+
+
+# Number of distinct texts whose nl2br output is cached
+NL2BR_CACHE_SIZE = 256
+
+
+@lru_cache(maxsize=NL2BR_CACHE_SIZE)
+def nl2br_escaped(value):
+    # Source texts are long-lived strings with cached hashes, so a cache hit costs almost nothing
+    return nl2br_paragraphs(escape(value), Markup("<br>\n"))
+
+
+def nl2br_paragraphs(value, br):
+    return "\n\n".join(
+        f"<p>{br.join(p.splitlines())}</p>"
+        for p in re.split(r"(?:\r\n|\r(?!\n)|\n){2,}", value)
+    )
 
 
 @pass_eval_context
@@ -13,22 +52,90 @@ def nl2br(eval_ctx, value):
     br = "<br>\n"
 
     if eval_ctx.autoescape:
+        if type(value) is str:
+            return Markup(nl2br_escaped(value))
         value = escape(value)
         br = Markup(br)
 
-    result = "\n\n".join(
-        f"<p>{br.join(p.splitlines())}</p>"
-        for p in re.split(r"(?:\r\n|\r(?!\n)|\n){2,}", value)
-    )
+    result = nl2br_paragraphs(value, br)
     return Markup(result) if eval_ctx.autoescape else result
 
 
+# Templates are compiled into Python modules once (and again whenever they change),
+# later starts load the compiled modules instead of parsing the templates
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+TEMPLATE_CACHE = os.environ.get("QDPX_TEMPLATE_CACHE",
+                                os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__", "templates"))
+
+
+def templates_stamp():
+    """Returns a hash of the Jinja version and the paths and contents of all templates."""
+    digest = hashlib.sha256(jinja2.__version__.encode())
+    for directory, subdirectories, names in sorted(os.walk(TEMPLATE_DIR)):
+        subdirectories.sort()
+        for name in sorted(names):
+            if name.endswith(".html"):
+                path = os.path.join(directory, name)
+                digest.update(os.path.relpath(path, TEMPLATE_DIR).encode() + b"\0")
+                with open(path, "rb") as f:
+                    digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def compile_templates(env, stamp):
+    """Compiles the templates into a temporary directory next to TEMPLATE_CACHE and renames it into place,
+    so that other processes never load a partly written cache."""
+    parent = os.path.dirname(TEMPLATE_CACHE)
+    os.makedirs(parent, exist_ok=True)
+    compiled = tempfile.mkdtemp(prefix=".templates-", dir=parent)
+    try:
+        env.compile_templates(compiled, extensions=("html",), zip=None, ignore_errors=False)
+        with open(os.path.join(compiled, "STAMP"), "w") as f:
+            f.write(stamp)
+        old = None
+        if os.path.exists(TEMPLATE_CACHE):
+            old = tempfile.mkdtemp(prefix=".templates-old-", dir=parent)
+            try:
+                os.replace(TEMPLATE_CACHE, old)
+            except OSError:
+                # Another process has just replaced it
+                pass
+        try:
+            os.rename(compiled, TEMPLATE_CACHE)
+        except OSError:
+            # Another process put its (equally new) templates in place first
+            pass
+        if old is not None:
+            shutil.rmtree(old, ignore_errors=True)
+    finally:
+        shutil.rmtree(compiled, ignore_errors=True)
+
+
+def compiled_templates_loader(env):
+    """Returns a loader of the compiled templates, compiling them first if needed (None if they cannot be written)."""
+    stamp = templates_stamp()
+    try:
+        with open(os.path.join(TEMPLATE_CACHE, "STAMP")) as f:
+            compiled = f.read() == stamp
+    except OSError:
+        compiled = False
+    if not compiled:
+        try:
+            compile_templates(env, stamp)
+        except OSError:
+            return None
+    return ModuleLoader(TEMPLATE_CACHE)
+
+
 # Prepare the environment
 env = Environment(loader=PackageLoader("srv"),
                   autoescape=select_autoescape(['html', 'htm', 'xml'])
                   )
 
 env.filters['nl2br'] = nl2br
+module_loader = compiled_templates_loader(env)
+if module_loader is not None:
+    env.loader = ChoiceLoader([module_loader, env.loader])
 
 # Read templates
 upload_template = env.get_template("upload.html")
@@ -36,9 +143,266 @@ preview_template = env.get_template("preview.html")
 extract_template = env.get_template("extract.html")
 compare_template = env.get_template("compare.html")
 upload_two_template = env.get_template("upload_two.html")
+job_template = env.get_template("job.html")
+corpus_template = env.get_template("corpus.html")
+concordance_template = env.get_template("concordance.html")
+search_template = env.get_template("search.html")
 
 app = Flask(__name__)
 
+logging.basicConfig(level=os.environ.get("QDPX_LOG_LEVEL", "INFO"),
+                    format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "qdpx_request_seconds", "Latency of requests per route", ("route", "method", "status")))
+# Requests with `profile=1` in the query string are profiled with cProfile when QDPX_PROFILE_DIR is set,
+# the profiles are dumped there (one .prof file per request)
+PROFILE_DIR = os.environ.get("QDPX_PROFILE_DIR")
+# Only one request is profiled at a time (a profiler sees the calls of all threads, and Python 3.12 refuses
+# to enable a second one), requests asking for a profile meanwhile are served without it
+profile_lock = threading.Lock()
+
+
+def profile_name(route):
+    return f"{route.strip('/').replace('/', '_') or 'root'}-{time.time():.3f}.prof"
+
+
+@app.before_request
+def start_request():
+    g.started = time.perf_counter()
+    g.profiler = None
+    if PROFILE_DIR and request.args.get("profile"):
+        if profile_lock.acquire(blocking=False):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+        else:
+            app.logger.warning("Not profiling %s, another request is being profiled", request.path)
+
+
+@app.after_request
+def finish_request(response):
+    route = request.url_rule.rule if request.url_rule else "(unmatched)"
+    if g.get("profiler"):
+        g.profile_name = profile_name(route)
+        response.headers["X-Profile"] = g.profile_name
+    # Streamed responses are measured until their first chunk is ready
+    REQUEST_SECONDS.observe(time.perf_counter() - g.started, route=route,
+                            method=request.method, status=response.status_code)
+    return response
+
+
+@app.teardown_request
+def stop_profiling(exception):
+    """Dumps the profile of a request, also when its view raised (and after a response streamed with its context)."""
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return
+    try:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        route = request.url_rule.rule if request.url_rule else "(unmatched)"
+        profiler.dump_stats(os.path.join(PROFILE_DIR, g.get("profile_name") or profile_name(route)))
+    finally:
+        profile_lock.release()
+
+# Parser used for project.qde in the viewer and the comparator ("soup" or "stream"),
+# can be overridden per request with the `backend` form field
+app.config["QDPX_BACKEND"] = os.environ.get("QDPX_BACKEND", "soup")
+
+
+def get_backend():
+    backend = request.form.get("backend", app.config["QDPX_BACKEND"])
+    if backend not in BACKENDS:
+        backend = "soup"
+    return backend
+
+# Deflate level of archives made by the extractor (None stores them uncompressed)
+EXTRACT_COMPRESSLEVEL = int(os.environ["QDPX_COMPRESSLEVEL"]) if os.environ.get("QDPX_COMPRESSLEVEL") else None
+
+# Number of sources shown on a page of the viewer and the comparator (0 shows all of them),
+# with QDPX_LAZY_TEXTS set to 0 full texts of the sources are included in the page instead of loaded on demand
+PAGE_SIZE = int(os.environ.get("QDPX_PAGE_SIZE", 10))
+LAZY_TEXTS = os.environ.get("QDPX_LAZY_TEXTS", "1") != "0"
+# Number of template chunks sent at once in the streamed rendering mode
+STREAM_BUFFER = 16
+
+# Parsed projects are cached by the content of the uploaded archive and the names of codes,
+# QDPX_CACHE_DIR enables the on-disk tier and QDPX_PARSE_WORKERS parses sources in a process pool
+# (0 uses all CPUs)
+parse_cache = ParseCache(max_entries=int(os.environ.get("QDPX_CACHE_SIZE", 16)),
+                         directory=os.environ.get("QDPX_CACHE_DIR"),
+                         workers=int(os.environ.get("QDPX_PARSE_WORKERS", 1)) or None)
+# Compared pairs of projects are kept in memory, so that other pages of a comparison are cheap,
+# QDPX_ALIGN_TOLERANCE sets how many characters boundaries of LUs may differ by when matching through edited texts
+pair_cache = TieredCache(max_entries=8)
+ALIGN_TOLERANCE = int(os.environ.get("QDPX_ALIGN_TOLERANCE", TEXT_TOLERANCE))
+# Search indexes of texts are kept by the keys of their projects
+search_cache = TieredCache(max_entries=8)
+# Serialized (and compressed) responses of the JSON API are kept by their ETags
+api_cache = TieredCache(max_entries=64)
+
+# Heavy routes run as background jobs when the `job` form field is set,
+# finished results are kept for JOB_TTL seconds and shared by identical requests
+job_queue = JobQueue(max_workers=int(os.environ.get("JOB_WORKERS", 2)),
+                     ttl=int(os.environ.get("JOB_TTL", 3600)))
+
+CACHES = (("parse", parse_cache), ("pair", pair_cache), ("search", search_cache), ("api", api_cache))
+
+
+def cache_stat(stat):
+    return lambda: {(name,): cache.stats()[stat] for name, cache in CACHES}
+
+
+# Sizes and hits of the caches and the number of jobs are read when /metrics is requested
+REGISTRY.register(Gauge("qdpx_cache_entries", "Numbers of entries in memory of the caches", ("cache",),
+                        function=cache_stat("entries")))
+for stat, help in (("hits", "Hits in memory"), ("disk_hits", "Hits on disk"), ("misses", "Misses")):
+    REGISTRY.register(Counter(f"qdpx_cache_{stat}", f"{help} of the caches", ("cache",), function=cache_stat(stat)))
+REGISTRY.register(Gauge("qdpx_jobs", "Number of kept (queued, running and finished) jobs",
+                        function=lambda: {(): len(job_queue.jobs)}))
+
+# Corpus of ingested archives (opened on first use) and the maximal number of metaphors shown at once
+CORPUS_DB = os.environ.get("QDPX_CORPUS_DB", "corpus.sqlite")
+CORPUS_LIMIT = 500
+# Maximal number of hits of a search in texts of a project
+SEARCH_LIMIT = 500
+corpus = None
+# With QDPX_TAGGING set to 1 lemmata of ingested archives are indexed too (needs cltk),
+# analyses are cached in QDPX_TAG_CACHE
+TAGGING = os.environ.get("QDPX_TAGGING", "0") != "0"
+tagger = None
+
+
+def get_corpus():
+    global corpus
+    if corpus is None:
+        corpus = CorpusDB(CORPUS_DB)
+    return corpus
+
+
+def get_tagger():
+    global tagger
+    if TAGGING and tagger is None:
+        tagger = GreekTagger(int(os.environ.get("QDPX_TAG_WORKERS", 1)) or None,
+                             os.environ.get("QDPX_TAG_CACHE", "tagging_cache"))
+    return tagger
+
+
+def spool_upload(f):
+    """Copies an uploaded file, so that it can still be read after the request is finished."""
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    f.save(spool)
+    spool.seek(0)
+    return spool
+
+
+def start_job(key, kind, function, *args):
+    job = job_queue.submit(key, kind, function, *args)
+    if request.accept_mimetypes.best == "application/json":
+        return job.to_dict(), 202
+    return redirect(url_for("job_page", id=job.id), code=303)
+
+
+def report(job, message):
+    if job:
+        job.report(message)
+
+
+def reporter(job, what):
+    return job.progress_reporter(what) if job else None
+
+
+def paginate(items, page):
+    """Returns items on a given page (counted from 1), the page and the number of pages."""
+    items = list(items)
+    if not PAGE_SIZE:
+        return items, 1, 1
+    pages = max(1, ceil(len(items) / PAGE_SIZE))
+    page = min(max(page, 1), pages)
+    return items[(page - 1) * PAGE_SIZE:page * PAGE_SIZE], page, pages
+
+
+def render_page(template, stream, **context):
+    """Renders a template into a string or, if `stream` is set, into a streamed response."""
+    if stream:
+        chunks = template.stream(**context)
+        chunks.enable_buffering(STREAM_BUFFER)
+        return Response(stream_with_context(chunks), mimetype="text/html")
+    with phase("render"):
+        return template.render(**context)
+
+
+def text_url(key):
+    return "source_text?" + urlencode({"key": key}) if LAZY_TEXTS else None
+
+
+def preview_page(project, key, filename, page=1, stream=False):
+    sources, page, pages = paginate(project.sources, page)
+    page_url = "preview_page?" + urlencode({"key": key, "filename": filename})
+    tables_url = "tables?" + urlencode({"key": key, "filename": filename})
+    return render_page(preview_template, stream, project=project, filename=filename,
+                       sources=sources, page=page, pages=pages, page_url=page_url,
+                       text_url=text_url(key), tables_url=tables_url, table_formats=TABLE_FORMATS,
+                       searched=[(key, filename)])
+
+
+def compare_page(project_pair, keys, filename_first, filename_second, page=1, stream=False):
+    sources, page, pages = paginate(project_pair.sources.items(), page)
+    page_url = "compare_page?" + urlencode({"key_first": keys[0], "key_second": keys[1],
+                                            "match": project_pair.match,
+                                            "filename_first": filename_first,
+                                            "filename_second": filename_second})
+    merge_url = "merge?" + urlencode({"key_first": keys[0], "key_second": keys[1],
+                                      "match": project_pair.match,
+                                      "filename_first": filename_first})
+    return render_page(compare_template, stream, project_pair=project_pair,
+                       filename_first=filename_first, filename_second=filename_second,
+                       sources=sources, page=page, pages=pages,
+                       page_url=page_url, text_url=text_url(keys[0]), merge_url=merge_url,
+                       searched=[(keys[0], filename_first), (keys[1], filename_second)])
+
+
+def compared_pair(project_first, project_second, key_first, key_second, match, progress=None):
+    pair_key = (key_first, key_second, match)
+    project_pair = pair_cache.get(pair_key)
+    if project_pair is None:
+        project_pair = ProjectPair(project_first, project_second, match, progress, ALIGN_TOLERANCE)
+        pair_cache.put(pair_key, project_pair)
+    return project_pair
+
+
+def run_preview(job, f, filename, lu_code_name, f_code_name, g_code_name, backend, stream=False):
+    project, key = parse_cache.project(f, lu_code_name, f_code_name, g_code_name,
+                                       backend, reporter(job, "sources parsed"), filename)
+    report(job, "rendering")
+    return preview_page(project, key, filename, stream=stream)
+
+
+def run_compare(job, f_first, f_second, filename_first, filename_second,
+                lu_code_name, f_code_name, g_code_name, backend, match, stream=False):
+    project_first, key_first = parse_cache.project(f_first, lu_code_name, f_code_name, g_code_name,
+                                                   backend, reporter(job, "sources parsed (first file)"),
+                                                   filename_first)
+    project_second, key_second = parse_cache.project(f_second, lu_code_name, f_code_name, g_code_name,
+                                                     backend, reporter(job, "sources parsed (second file)"),
+                                                     filename_second)
+    project_pair = compared_pair(project_first, project_second, key_first, key_second,
+                                 match, reporter(job, "sources compared"))
+    report(job, "rendering")
+    return compare_page(project_pair, (key_first, key_second),
+                        filename_first, filename_second, stream=stream)
+
+
+def run_extract(job, f, fname, unit_code, user):
+    report(job, "extracting fragments")
+    project, sources = read_qdpx_file(f)
+    documents, links, files, = extract_fragments(
+        project, sources, unit_code, f)
+    report(job, "writing archive")
+    make_qdpx_project(documents, links, files, f'data/{fname}', project, user,
+                      EXTRACT_COMPRESSLEVEL)
+    return extract_template.render(fname=fname)
+
 
 # QDPX files viewer
 @app.route('/upload')
@@ -54,13 +418,101 @@ def preview():
         f_code_name = request.form['f-code-name']
         #g_code_name = request.form['g-code-name']
         g_code_name = "Grammar"
-        project, sources = read_qdpx_file(f)
-        project = Project(project, sources, lu_code_name,
-                          f_code_name, g_code_name)
-        return preview_template.render(project=project, filename=f.filename)
+        args = (f.filename, lu_code_name, f_code_name, g_code_name, get_backend())
+        if request.form.get("job"):
+            key = ("preview", archive_hash(f)) + args[1:4]
+            return start_job(key, "preview", run_preview, spool_upload(f), *args)
+        return run_preview(None, f, *args, stream=bool(request.form.get("stream")))
     else:
         return "Something went wrong..."
 
+@app.route('/preview_page')
+def preview_other_page():
+    key = request.args.get("key", "")
+    project = parse_cache.get(key)
+    if project is None:
+        return "This file is no longer cached, please upload it again.", 404
+    return preview_page(project, key, request.args.get("filename", ""),
+                        request.args.get("page", 1, type=int), bool(request.args.get("stream")))
+
+@app.route('/source_text')
+def source_text():
+    project = parse_cache.get(request.args.get("key", ""))
+    if project is None:
+        abort(404)
+    guid = request.args.get("guid")
+    for source in project.sources:
+        if source.guid == guid:
+            return nl2br_escaped(source.full_text)
+    abort(404)
+
+def search_index(key):
+    """Returns the search index of a cached project (None if the project is no longer cached)."""
+    project = parse_cache.get(key)
+    if project is None:
+        return None
+    index = search_cache.get(key)
+    if index is None:
+        index = TextIndex(project)
+        search_cache.put(key, index)
+    return index
+
+
+@app.route('/search')
+def search_texts():
+    key = request.args.get("key", "")
+    index = search_index(key)
+    if index is None:
+        return "This file is no longer cached, please upload it again.", 404
+    query = request.args.get("q", "")
+    results = []
+    for source, hits in index.search(query, SEARCH_LIMIT):
+        highlighter = Highlighter(source.full_text, hit_spans(source, hits))
+        snippets = [highlighter.render(max(0, hit.start - SEARCH_CONTEXT), hit.end + SEARCH_CONTEXT)
+                    for hit in hits]
+        # Full texts are highlighted when they are opened, unless they are included in the page
+        results.append((source, list(zip(hits, snippets)), None if LAZY_TEXTS else highlighter.render()))
+    full_text_url = "search_text?" + urlencode({"key": key, "q": query}) if LAZY_TEXTS else None
+    return search_template.render(query=query, key=key, filename=request.args.get("filename", ""),
+                                  results=results, limit=SEARCH_LIMIT, full_text_url=full_text_url,
+                                  hits=sum(len(hits) for _, hits, _ in results))
+
+@app.route('/search_text')
+def search_text():
+    index = search_index(request.args.get("key", ""))
+    if index is None:
+        abort(404)
+    found = index.search_source(request.args.get("guid"), request.args.get("q", ""), SEARCH_LIMIT)
+    if found is None:
+        abort(404)
+    source, hits = found
+    return Markup("<p>{}</p>").format(Highlighter(source.full_text, hit_spans(source, hits)).render())
+
+
+@app.route('/tables')
+def download_tables():
+    project = parse_cache.get(request.args.get("key", ""))
+    if project is None:
+        return "This file is no longer cached, please upload it again.", 404
+    filename = request.args.get("filename", "")
+    format = request.args.get("format", "csv")
+    if format not in TABLE_FORMATS:
+        abort(400)
+    try:
+        chunks = stream_tables_zip([(project, filename)], format)
+        # The first chunk is taken here, so that a missing pyarrow is reported before the response starts
+        first = next(chunks)
+    except ImportError as e:
+        return str(e), 501
+    name = os.path.splitext(filename)[0] or "project"
+    return Response(stream_with_context(_prepend(first, chunks)), mimetype="application/zip",
+                    headers={"Content-Disposition": f'attachment; filename="{name}_{format}.zip"'})
+
+
+def _prepend(first, chunks):
+    yield first
+    yield from chunks
+
 # QDPX files comparator
 @app.route('/upload_two')
 def upload_tw_file():
@@ -74,22 +526,162 @@ def compare():
         lu_code_name = request.form['lu-code-name']
         f_code_name = request.form['f-code-name']
         g_code_name = "Grammar"
-        project_first, sources_first = read_qdpx_file(f_first)
-        project_second, sources_second = read_qdpx_file(f_second)
-        project_first = Project(project_first, sources_first, lu_code_name,
-                          f_code_name, g_code_name)
-        project_second = Project(project_second, sources_second, lu_code_name,
-                          f_code_name, g_code_name)
-                        
-        project_pair = ProjectPair(project_first, project_second)
-
-        return compare_template.render(project_pair=project_pair,
-                                        filename_first=f_first.filename,
-                                        filename_second=f_second.filename
-                                        )
+        match = request.form.get("match", "domain")
+        if match not in ProjectPair.MATCH_MODES:
+            match = "domain"
+        args = (f_first.filename, f_second.filename, lu_code_name, f_code_name,
+                g_code_name, get_backend(), match)
+        if request.form.get("job"):
+            key = ("compare", archive_hash(f_first), archive_hash(f_second)) + args[2:5] + (match,)
+            return start_job(key, "compare", run_compare,
+                             spool_upload(f_first), spool_upload(f_second), *args)
+        return run_compare(None, f_first, f_second, *args, stream=bool(request.form.get("stream")))
     else:
         return "Something went wrong..."
 
+@app.route('/compare_page')
+def compare_other_page():
+    key_first = request.args.get("key_first", "")
+    key_second = request.args.get("key_second", "")
+    match = request.args.get("match", "domain")
+    project_first = parse_cache.get(key_first)
+    project_second = parse_cache.get(key_second)
+    if project_first is None or project_second is None or match not in ProjectPair.MATCH_MODES:
+        return "These files are no longer cached, please upload them again.", 404
+    project_pair = compared_pair(project_first, project_second, key_first, key_second, match)
+    return compare_page(project_pair, (key_first, key_second),
+                        request.args.get("filename_first", ""), request.args.get("filename_second", ""),
+                        request.args.get("page", 1, type=int), bool(request.args.get("stream")))
+
+@app.route('/merge')
+def merge_pair():
+    key_first = request.args.get("key_first", "")
+    key_second = request.args.get("key_second", "")
+    match = request.args.get("match", "domain")
+    project_first = parse_cache.get(key_first)
+    project_second = parse_cache.get(key_second)
+    if project_first is None or project_second is None or match not in ProjectPair.MATCH_MODES:
+        return "These files are no longer cached, please upload them again.", 404
+    project_pair = compared_pair(project_first, project_second, key_first, key_second, match)
+    user = request.args.get("user", "adjudicator")
+    name = os.path.splitext(request.args.get("filename_first", ""))[0] or "project"
+    return Response(stream_with_context(AdjudicatedMerge(project_pair).stream(user, EXTRACT_COMPRESSLEVEL)),
+                    mimetype="application/zip",
+                    headers={"Content-Disposition": f'attachment; filename="merged_{name}.qdpx"'})
+
+# JSON API
+def api_response(etag, build):
+    """Returns a JSON response with an ETag, building its content only when it is needed.
+
+    `If-None-Match` is answered with 304 without building anything, bodies are gzipped
+    for clients accepting it and serialized bodies are cached by their ETags.
+
+    Args:
+        etag: an ETag of the content (derived from the cache keys of the archives)
+        build: a callable returning a JSON-serializable object
+    """
+    use_gzip = "gzip" in request.accept_encodings
+    tag = etag + "-gzip" if use_gzip else etag
+    if request.if_none_match.contains(tag):
+        response = Response(status=304)
+    else:
+        body = api_cache.get(tag)
+        if body is None:
+            body = json.dumps(build(), ensure_ascii=False).encode()
+            if use_gzip:
+                body = gzip.compress(body)
+            api_cache.put(tag, body)
+        response = Response(body, mimetype="application/json")
+        if use_gzip:
+            response.headers["Content-Encoding"] = "gzip"
+    response.set_etag(tag)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def api_project(key, page):
+    def build():
+        project = parse_cache.get(key)
+        if project is None:
+            abort(404)
+        sources, current, pages = paginate(project.sources, page)
+        return dict(key=key, page=current, pages=pages, **project_to_dict(project, sources))
+    return api_response(f"{key}-{page}-{PAGE_SIZE}", build)
+
+
+def api_compare(key_first, key_second, match, page):
+    if match not in ProjectPair.MATCH_MODES:
+        abort(400)
+    def build():
+        project_first = parse_cache.get(key_first)
+        project_second = parse_cache.get(key_second)
+        if project_first is None or project_second is None:
+            abort(404)
+        project_pair = compared_pair(project_first, project_second, key_first, key_second, match)
+        sources, current, pages = paginate(project_pair.sources.items(), page)
+        return dict(key_first=key_first, key_second=key_second, page=current, pages=pages,
+                    **project_pair_to_dict(project_pair, sources))
+    return api_response(f"{key_first}-{key_second}-{match}-{page}-{PAGE_SIZE}", build)
+
+
+@app.route('/api/project', methods=['POST'])
+def api_project_upload():
+    f = request.files['file']
+    project, key = parse_cache.project(f, request.form['lu-code-name'], request.form['f-code-name'],
+                                       "Grammar", get_backend())
+    return api_project(key, request.args.get("page", 1, type=int))
+
+@app.route('/api/project/<key>')
+def api_project_page(key):
+    return api_project(key, request.args.get("page", 1, type=int))
+
+@app.route('/api/compare', methods=['POST'])
+def api_compare_upload():
+    lu_code_name = request.form['lu-code-name']
+    f_code_name = request.form['f-code-name']
+    backend = get_backend()
+    project_first, key_first = parse_cache.project(request.files['file_first'], lu_code_name,
+                                                   f_code_name, "Grammar", backend)
+    project_second, key_second = parse_cache.project(request.files['file_second'], lu_code_name,
+                                                     f_code_name, "Grammar", backend)
+    return api_compare(key_first, key_second, request.form.get("match", "domain"),
+                       request.args.get("page", 1, type=int))
+
+@app.route('/api/compare/<key_first>/<key_second>')
+def api_compare_page(key_first, key_second):
+    return api_compare(key_first, key_second, request.args.get("match", "domain"),
+                       request.args.get("page", 1, type=int))
+
+# Corpus of ingested archives
+@app.route('/corpus', methods=['GET', 'POST'])
+def corpus_page():
+    db = get_corpus()
+    message = None
+    if request.method == 'POST':
+        f = request.files['file']
+        changed = db.ingest(f, f.filename, request.form['lu-code-name'], request.form['f-code-name'],
+                            "Grammar", get_backend(), parse_cache, get_tagger())
+        message = f"{f.filename} {'ingested' if changed else 'is unchanged'}"
+    filters = [("target", "Target", db.names("target")),
+               ("source_domain", "Source", db.names("source_domain")),
+               ("type", "Type", db.names("type")),
+               ("archive", "Archive", [archive["name"] for archive in db.archives()])]
+    query = {field: request.args.get(field, "") for field, _, _ in filters}
+    metaphors = db.metaphors(CORPUS_LIMIT, **query) if any(query.values()) else None
+    return corpus_template.render(archives=db.archives(), filters=filters, query=query,
+                                  metaphors=metaphors, limit=CORPUS_LIMIT, message=message)
+
+@app.route('/concordance')
+def concordance_page():
+    term = request.args.get("q", "")
+    kind = request.args.get("kind", "form")
+    if kind not in TERM_KINDS:
+        abort(400)
+    prefix = bool(request.args.get("prefix"))
+    lus = get_corpus().concordance(term, kind, prefix, CORPUS_LIMIT) if term else None
+    return concordance_template.render(term=term, kind=kind, kinds=TERM_KINDS, prefix=prefix,
+                                       lus=lus, limit=CORPUS_LIMIT)
+
 # Fragments extractor
 @app.route('/extract', methods = ['GET', 'POST'])
 def extract_file():
@@ -98,15 +690,55 @@ def extract_file():
         fname = "fragments_" + f.filename
         unit_code = request.form["fragment-code-name"]
         user = request.form["user-name"]
-        project, sources = read_qdpx_file(f)
-        documents, links, files, = extract_fragments(
-            project, sources, unit_code, f)
-        qdpx_archive = make_qdpx_project(documents, links, files, fname, project, user)
-        shutil.copyfile(fname, f'data/{fname}')
-        return extract_template.render(fname=fname)
+        if request.form.get("download"):
+            project, sources = read_qdpx_file(f)
+            documents, links, files, = extract_fragments(
+                project, sources, unit_code, f)
+            # Sources are read while the archive is streamed, so the request context is kept until it ends
+            return Response(stream_with_context(stream_qdpx_project(documents, links, files, user,
+                                                                    EXTRACT_COMPRESSLEVEL)),
+                            mimetype="application/zip",
+                            headers={"Content-Disposition": f'attachment; filename="{fname}"'})
+        if request.form.get("job"):
+            key = ("extract", archive_hash(f), fname, unit_code, user)
+            return start_job(key, "extract", run_extract, spool_upload(f), fname, unit_code, user)
+        return run_extract(None, f, fname, unit_code, user)
     else:
         return extract_template.render()
 
+# Background jobs (served at the top level, so that relative links in the results keep working)
+def get_job():
+    job = job_queue.get(request.args.get("id", ""))
+    if job is None:
+        abort(404)
+    return job
+
+@app.route('/job')
+def job_page():
+    return job_template.render(job=get_job())
+
+@app.route('/job_status')
+def job_status():
+    return get_job().to_dict()
+
+@app.route('/job_result')
+def job_result():
+    job = get_job()
+    if job.status == "failed":
+        # The message of the exception is shown as it is, never interpreted as HTML
+        return Response(job.error, status=500, mimetype="text/plain")
+    if job.status != "done":
+        return job.to_dict(), 202
+    return job.result
+
+@app.route('/cache_stats')
+def cache_stats():
+    return parse_cache.stats()
+
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.expose(), mimetype="text/plain; version=0.0.4")
+
 @app.route('/data/<path:filepath>')
 def data(filepath):
     return send_from_directory('data', filepath)
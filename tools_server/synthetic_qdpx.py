@@ -0,0 +1,205 @@
+import argparse
+import random
+import uuid
+from xml.sax.saxutils import quoteattr
+from extract_fragments_files import QDPXWriter, header, user_guid, selection_template, coding_template
+
+# Words the texts are made of (LU codes are named after the first LU_WORDS of them)
+WORDS = ("λόγος νοῦς ψυχή φρήν διάνοια ὁράω ἀκούω ἅπτομαι ὀφθαλμός φῶς σκότος ὁδός "
+         "πορεύομαι λαμβάνω ἔχω θεωρία μνήμη ἐπιστήμη δόξα ἀλήθεια").split()
+LU_WORDS = 10
+WORDS_PER_METAPHOR = 60
+DOMAINS = ("COGNITION", "VISION", "TOUCH", "HEARING", "MOTION", "LIGHT", "CONTAINER")
+METAPHOR_TYPES = ("Conventional", "Novel", "Dead")
+GRAMMAR = ("Noun", "Verb", "Adjective", "Participle")
+CREATED = "2023-02-06T18:20:23Z"
+
+
+class SyntheticCode:
+    """A code of the synthetic codebook.
+
+    Attributes:
+        name: a name of the code
+        guid: a guid of the code
+        children: a list of SyntheticCode objects
+    """
+
+    def __init__(self, name, guid, parent=None):
+        self.name = name
+        self.guid = guid
+        self.children = []
+        if parent:
+            parent.children.append(self)
+
+    def to_xml(self):
+        inner = "".join(child.to_xml() for child in self.children)
+        return (f'\n<Code guid="{self.guid}" name={quoteattr(self.name)} isCodable="true" color="#808080">'
+                f'{inner}</Code>')
+
+
+class SyntheticCodebook:
+    """Codebook of a synthetic project in the shape expected by Project.
+
+    Attributes:
+        roots: top-level codes
+        unit: the `Unit` code marking metaphors
+        lus, elements, sub_elements, grammar, domains, types, fragments: lists of codes under the respective parents
+    """
+
+    def __init__(self, rng, lu_code_name, f_code_name, g_code_name, fragments):
+        def code(name, parent=None):
+            c = SyntheticCode(name, make_guid(rng), parent)
+            if parent is None:
+                self.roots.append(c)
+            return c
+        self.roots = []
+        self.unit = code("Unit")
+        lu_parent = code(lu_code_name)
+        self.lus = [code(f"LU_{word}", lu_parent) for word in WORDS[:LU_WORDS]]
+        frame = code(f_code_name)
+        self.elements = [code(f"FE_{n}", frame) for n in range(8)]
+        self.sub_elements = [code(f"{element.name}_sub", element) for element in self.elements[:3]]
+        grammar = code(g_code_name)
+        self.grammar = [code(name, grammar) for name in GRAMMAR]
+        domain = code("Domain")
+        self.domains = [code(name, domain) for name in DOMAINS]
+        metaphor_type = code("Metaphor type")
+        self.types = [code(name, metaphor_type) for name in METAPHOR_TYPES]
+        fragment = code("Fragment")
+        self.fragments = [code(f"Fragment_{n}", fragment) for n in range(1, fragments + 1)]
+
+    def to_xml(self):
+        return "\n<CodeBook>\n<Codes>" + "".join(c.to_xml() for c in self.roots) + "\n</Codes>\n</CodeBook>"
+
+
+def make_guid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128))).upper()
+
+
+def make_text(rng, metaphors):
+    """Returns a text made of `metaphors` units, each a header followed by a paragraph, and the spans of the units."""
+    text = ""
+    units = []
+    for _ in range(metaphors):
+        start = len(text)
+        body = " ".join(rng.choice(WORDS) for _ in range(WORDS_PER_METAPHOR)) + ".\n\n"
+        text += header + body
+        units.append((start, len(text)))
+    return text, units
+
+
+def word_spans(text, start, end):
+    spans = []
+    position = start
+    for word in text[start:end].split(" "):
+        word = word.rstrip(".\n")
+        if word:
+            spans.append((position, position + len(word)))
+        position += len(word) + 1
+    return spans
+
+
+def make_synthetic_qdpx(output, sources=5, metaphors=3, lus=4, elements=3, fragments=2, seed=0,
+                        coder=0, agreement=0.8, lu_code_name="LexicalUnit", f_code_name="Frame",
+                        g_code_name="Grammar", compresslevel=6):
+    """Writes a synthetic QDPX archive shaped like the MAXQDA exports of the project.
+
+    Every source consists of units coded with `Unit`, each starting with the header whose
+    `TARGET DOMAIN`, `SOURCE DOMAIN` and `METAPHOR TYPE` lines are coded with domains and a type,
+    followed by a paragraph of Greek words, some of which are coded as lexical units together
+    with frame elements (and grammar codes). Every unit is also coded as one of the fragments.
+
+    Archives with the same `seed` share the codebook, the sources and their texts, so archives of
+    different coders (`coder`) can be compared; their codings agree with probability `agreement`.
+
+    Args:
+        output: path or file-like object for the archive
+        sources: number of sources
+        metaphors: number of metaphors (units) per source
+        lus: number of lexical units per metaphor
+        elements: maximal number of frame elements per lexical unit
+        fragments: number of children of the `Fragment` code
+        seed: seed of the codebook, the texts and the codings
+        coder: number of the coder (0 codes exactly as seeded)
+        agreement: probability that a coding decision of the coder is the seeded one
+        lu_code_name, f_code_name, g_code_name: names of the parents of LU, frame element and grammar codes
+        compresslevel: None to store entries uncompressed, 0-9 to deflate them with a given level
+    Returns:
+        A dictionary with numbers of sources, metaphors, lexical units and selections written
+    """
+    rng = random.Random(seed)
+    coder_rng = random.Random(f"{seed}-{coder}")
+    codebook = SyntheticCodebook(rng, lu_code_name, f_code_name, g_code_name, fragments)
+
+    def decide(choose):
+        # Both generators are always advanced, so that the seeded stream stays the same for every coder
+        seeded = choose(rng)
+        own = choose(coder_rng)
+        return seeded if coder == 0 or coder_rng.random() < agreement else own
+
+    counts = {"sources": sources, "metaphors": 0, "lus": 0, "selections": 0}
+    documents = []
+    files = []
+    for n in range(sources):
+        source_guid = make_guid(rng)
+        text, units = make_text(rng, metaphors)
+        selections = []
+        for start, end in units:
+            selections.append((start, end, [codebook.unit]))
+            for label, codes in (("TARGET DOMAIN", codebook.domains), ("SOURCE DOMAIN", codebook.domains),
+                                 ("METAPHOR TYPE", codebook.types)):
+                label_start = text.index(label, start)
+                selections.append((label_start, label_start + len(label), [decide(lambda r: r.choice(codes))]))
+            body_start = start + len(header)
+            if codebook.fragments:
+                selections.append((body_start, end, [decide(lambda r: r.choice(codebook.fragments))]))
+            words = word_spans(text, body_start, end)
+            for s_pos, e_pos in decide(lambda r: r.sample(words, min(lus, len(words)))):
+                codes = [decide(lambda r: r.choice(codebook.lus))]
+                codes += decide(lambda r: r.sample(codebook.elements + codebook.sub_elements,
+                                                   r.randint(0, elements)))
+                if rng.random() < 0.5:
+                    codes.append(decide(lambda r: r.choice(codebook.grammar)))
+                selections.append((s_pos, e_pos, codes))
+            counts["metaphors"] += 1
+            counts["lus"] += min(lus, len(words))
+        counts["selections"] += len(selections)
+        xml = [f'\n<TextSource guid="{source_guid}" name="Source {n}" creatingUser="{user_guid}" '
+               f'creationDateTime="{CREATED}" plainTextPath="internal://{source_guid}.txt">']
+        for s_pos, e_pos, codes in selections:
+            codings = "".join(coding_template.format(guid=make_guid(coder_rng), user_guid=user_guid,
+                                                     created=CREATED, code_guid=c.guid) for c in codes)
+            xml.append(selection_template.format(guid=make_guid(coder_rng), start_pos=s_pos, end_pos=e_pos,
+                                                 user_guid=user_guid, created=CREATED, codings=codings))
+        xml.append("\n</TextSource>")
+        documents.append("".join(xml))
+        files.append((source_guid + ".txt", text))
+
+    with QDPXWriter(output, compresslevel) as writer:
+        writer.write_project(documents, [], f"coder{coder}", codebook=codebook.to_xml())
+        for filename, text in files:
+            writer.write_source(filename, text)
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='Synthetic QDPX',
+        description='Writes a synthetic QPDX archive with metaphors, lexical units\
+             and frame elements for testing and benchmarks')
+    parser.add_argument('output')
+    parser.add_argument('--sources', '-s', type=int, default=5)
+    parser.add_argument('--metaphors', '-m', type=int, default=3)
+    parser.add_argument('--lus', '-u', type=int, default=4)
+    parser.add_argument('--elements', '-e', type=int, default=3)
+    parser.add_argument('--fragments', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--coder', type=int, default=0)
+    parser.add_argument('--agreement', type=float, default=0.8)
+    parser.add_argument('--lu_code_name', '-l', default="LexicalUnit")
+    parser.add_argument('--f_code_name', '-f', default="Frame")
+    args = parser.parse_args()
+
+    print(make_synthetic_qdpx(args.output, args.sources, args.metaphors, args.lus, args.elements,
+                              args.fragments, args.seed, args.coder, args.agreement,
+                              args.lu_code_name, args.f_code_name))
@@ -0,0 +1,36 @@
+import pytest
+from agreement import cohens_kappa, coincidences, krippendorffs_alpha, percent_agreement, pooled_coincidences
+
+
+def labelled(counts):
+    return [labels for labels, n in counts.items() for _ in range(n)]
+
+
+def test_cohens_kappa_textbook():
+    # 50 proposals read by two reviewers (Wikipedia, "Cohen's kappa"): p_o = 0.7, p_e = 0.5
+    pairs = labelled({("yes", "yes"): 20, ("yes", "no"): 5, ("no", "yes"): 10, ("no", "no"): 15})
+    assert percent_agreement(pairs) == pytest.approx(0.7)
+    assert cohens_kappa(pairs) == pytest.approx(0.4)
+
+
+def test_cohens_kappa_undefined():
+    assert cohens_kappa([]) is None
+    assert cohens_kappa([("a", "a"), ("a", "a")]) is None
+
+
+def test_krippendorffs_alpha_textbook():
+    # Two observers, ten units of binary data (Krippendorff, "Computing Krippendorff's alpha-reliability", 2011)
+    first = [0, 1, 0, 0, 0, 0, 0, 0, 1, 0]
+    second = [1, 1, 1, 0, 0, 1, 0, 0, 0, 0]
+    matrix = coincidences(list(zip(first, second)))
+    assert matrix[(0, 0)] == 10 and matrix[(0, 1)] == 4 and matrix[(1, 1)] == 2
+    assert krippendorffs_alpha(matrix) == pytest.approx(0.095, abs=0.0005)
+
+
+def test_krippendorffs_alpha_pooled():
+    # Three coders agreeing on every unit, the pooled matrix counts every value once
+    pairs = [("a", "a"), ("b", "b"), ("a", "a")]
+    pooled = pooled_coincidences([coincidences(pairs)] * 3, 3)
+    assert sum(pooled.values()) == pytest.approx(9)
+    assert krippendorffs_alpha(pooled) == pytest.approx(1)
+    assert krippendorffs_alpha(coincidences([("a", "a")])) is None
@@ -0,0 +1,53 @@
+import csv
+import io
+from zipfile import ZipFile
+import pytest
+from parseQDPX import read_qdpx_file, Project
+from export_tables import TABLES, EXTENSIONS, ExportIds, source_rows, stream_tables_zip
+from synthetic_qdpx import make_synthetic_qdpx
+
+
+@pytest.fixture
+def project(tmp_path):
+    path = tmp_path / "synthetic.qdpx"
+    make_synthetic_qdpx(str(path), sources=3, metaphors=4)
+    return Project(*read_qdpx_file(str(path), "stream"), "LexicalUnit", "Frame", "Grammar")
+
+
+def expected_rows(project):
+    ids = ExportIds()
+    rows = {table: [] for table in TABLES}
+    for source in project.sources:
+        for table, source_table in source_rows(source, "synthetic.qdpx", ids).items():
+            rows[table].extend(source_table)
+    return rows
+
+
+def zip_entries(chunks):
+    # The archive is only ever written forwards, as it is for a streamed response
+    with ZipFile(io.BytesIO(b"".join(chunks))) as archive:
+        return {name: archive.read(name) for name in archive.namelist()}
+
+
+def test_csv_tables_zip(project):
+    entries = zip_entries(stream_tables_zip([(project, "synthetic.qdpx")], "csv"))
+    for table, rows in expected_rows(project).items():
+        read = list(csv.reader(io.StringIO(entries[table + ".csv"].decode("utf-8"))))
+        assert read[0] == [name for name, _ in TABLES[table]]
+        assert read[1:] == [["" if value is None else str(value) for value in row] for row in rows]
+
+
+@pytest.mark.parametrize("format", ["parquet", "arrow"])
+def test_arrow_tables_zip(project, format):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.ipc
+    import pyarrow.parquet
+    entries = zip_entries(stream_tables_zip([(project, "synthetic.qdpx")], format))
+    for table, rows in expected_rows(project).items():
+        data = pa.BufferReader(entries[table + EXTENSIONS[format]])
+        if format == "parquet":
+            read = pyarrow.parquet.read_table(data)
+        else:
+            read = pyarrow.ipc.open_file(data).read_all()
+        assert read.column_names == [name for name, _ in TABLES[table]]
+        assert [tuple(row.values()) for row in read.to_pylist()] == rows
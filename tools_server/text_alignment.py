@@ -0,0 +1,137 @@
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from difflib import SequenceMatcher
+
+WORD = re.compile(r"\S+")
+# Gaps without unique items are diffed by difflib (quadratic in the worst case) only up to this number of items
+GAP_DIFF_LIMIT = 1000
+
+
+def unique_anchors(a, alo, ahi, b, blo, bhi):
+    """Returns the longest increasing run of pairs of items occurring exactly once in both a[alo:ahi] and b[blo:bhi].
+
+    Returns:
+        A list of (index in a, index in b) touples, increasing in both
+    """
+    counts_a = Counter(a[alo:ahi])
+    counts_b = Counter(b[blo:bhi])
+    positions_b = {b[j]: j for j in range(blo, bhi) if counts_b[b[j]] == 1}
+    candidates = [(i, positions_b[a[i]]) for i in range(alo, ahi)
+                  if counts_a[a[i]] == 1 and a[i] in positions_b]
+    # Patience sorting: tails[k] is the smallest end (in b) of an increasing run of length k + 1
+    tails = []
+    tail_indices = []
+    previous = []
+    for n, (_, j) in enumerate(candidates):
+        k = bisect_left(tails, j)
+        if k == len(tails):
+            tails.append(j)
+            tail_indices.append(n)
+        else:
+            tails[k] = j
+            tail_indices[k] = n
+        previous.append(tail_indices[k - 1] if k else None)
+    anchors = []
+    n = tail_indices[-1] if tail_indices else None
+    while n is not None:
+        anchors.append(candidates[n])
+        n = previous[n]
+    anchors.reverse()
+    return anchors
+
+
+def match_sequences(a, b):
+    """Pairs equal items of two sequences in order (a patience diff).
+
+    Equal prefixes and suffixes are paired first, then items unique in both sequences serve as anchors
+    and the gaps between them are matched in the same way. Every item is counted a bounded number of
+    times for typical revisions, so the time stays near-linear in the length of the sequences.
+    Short gaps without unique items are left to difflib, longer ones stay unmatched.
+
+    Returns:
+        A list of (index in a, index in b) touples, increasing in both
+    """
+    pairs = []
+    gaps = [(0, len(a), 0, len(b))]
+    while gaps:
+        alo, ahi, blo, bhi = gaps.pop()
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            pairs.append((alo, blo))
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            pairs.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+        anchors = unique_anchors(a, alo, ahi, b, blo, bhi)
+        if not anchors:
+            if ahi - alo <= GAP_DIFF_LIMIT and bhi - blo <= GAP_DIFF_LIMIT:
+                blocks = SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk=False).get_matching_blocks()
+                pairs.extend((alo + i + k, blo + j + k) for i, j, size in blocks for k in range(size))
+            continue
+        start_a, start_b = alo, blo
+        for i, j in anchors:
+            pairs.append((i, j))
+            gaps.append((start_a, i, start_b, j))
+            start_a, start_b = i + 1, j + 1
+        gaps.append((start_a, ahi, start_b, bhi))
+    pairs.sort()
+    return pairs
+
+
+class TextOffsetMap:
+    """Maps offsets in a text to offsets in its revision (e.g. the same source in the archive of another coder).
+
+    The texts are diffed once word by word (see match_sequences). Offsets within matched words move
+    with the words, offsets between them keep their distance from the nearer of the matched words around them.
+
+    Attributes:
+        identical: whether the texts are identical (offsets are not changed)
+        starts_first, ends_first: offsets of matched words in the first text
+        starts_second, ends_second: offsets of the same words in the second text
+    """
+
+    def __init__(self, text_first, text_second):
+        self.identical = text_first == text_second
+        self.starts_first = array("i")
+        self.ends_first = array("i")
+        self.starts_second = array("i")
+        self.ends_second = array("i")
+        if self.identical:
+            return
+        spans_first = [m.span() for m in WORD.finditer(text_first)]
+        spans_second = [m.span() for m in WORD.finditer(text_second)]
+        words_first = [text_first[s:e] for s, e in spans_first]
+        words_second = [text_second[s:e] for s, e in spans_second]
+        for i, j in match_sequences(words_first, words_second):
+            self.starts_first.append(spans_first[i][0])
+            self.ends_first.append(spans_first[i][1])
+            self.starts_second.append(spans_second[j][0])
+            self.ends_second.append(spans_second[j][1])
+
+    def map(self, position):
+        """Returns the offset in the second text corresponding to an offset in the first one."""
+        if self.identical or not self.starts_first:
+            return position
+        i = bisect_right(self.starts_first, position) - 1
+        if i < 0:
+            return max(0, position - self.starts_first[0] + self.starts_second[0])
+        if position <= self.ends_first[i]:
+            return self.starts_second[i] + position - self.starts_first[i]
+        mapped = self.ends_second[i] + position - self.ends_first[i]
+        if i + 1 < len(self.starts_first):
+            if self.starts_first[i + 1] - position < position - self.ends_first[i]:
+                mapped = self.starts_second[i + 1] - (self.starts_first[i + 1] - position)
+            # A gap that shrank never reaches past the matched words around it
+            mapped = max(self.ends_second[i], min(mapped, self.starts_second[i + 1]))
+        return mapped
+
+    def map_span(self, start, end):
+        return self.map(start), self.map(end)
+
+    def __repr__(self):
+        return f'TextOffsetMap(identical={self.identical}, words={len(self.starts_first)})'
@@ -0,0 +1,261 @@
+import argparse
+from bisect import bisect_left, bisect_right
+from markupsafe import Markup, escape
+from parseQDPX import read_qdpx_file, Project, BACKENDS
+from greek_text import normalize_with_offsets, fold, original_span
+from instrumentation import phase, count
+
+# Length of the n-grams indexed to find texts containing a query
+NGRAM = 3
+# Number of characters shown on both sides of a hit
+CONTEXT = 80
+
+
+class SpanIndex:
+    """Spans (of metaphors or LUs) of a source sorted by their start, to find the ones overlapping a span.
+
+    Attributes:
+        items: a list of (start, end, object) touples sorted by start
+        starts: start offsets of the items
+        longest: length of the longest span
+    """
+
+    def __init__(self, items):
+        self.items = sorted(items, key=lambda item: item[0])
+        self.starts = [item[0] for item in self.items]
+        self.longest = max((end - start for start, end, _ in self.items), default=0)
+
+    def overlapping(self, start, end):
+        """Returns objects whose spans overlap a span, in document order."""
+        lo = bisect_left(self.starts, start - self.longest)
+        hi = bisect_left(self.starts, end)
+        return [item for s, e, item in self.items[lo:hi] if e > start]
+
+
+class IndexedText:
+    """Folded text of a source (see greek_text.normalize_with_offsets) with its metaphors, LUs and frame elements.
+
+    Attributes:
+        source: a Source object
+        folded: the text stripped of diacritics and case
+        starts, ends: offsets in the original text of every character of the folded text
+        metaphors: SpanIndex of Metaphor objects
+        lus: SpanIndex of LexicalUnit objects
+        elements: SpanIndex of TextSelection objects coded with frame elements
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.folded, self.starts, self.ends = normalize_with_offsets(source.full_text, fold=True)
+        self.metaphors = SpanIndex([(*metaphor.span, metaphor) for metaphor in source.metaphors])
+        self.lus = SpanIndex([(lu.start_pos, lu.end_pos, lu) for metaphor in source.metaphors
+                              for lu in metaphor.lus])
+        frame_guids = {code.guid for code in source.project.frame_codes}
+        self.elements = SpanIndex([(selection.start_pos, selection.end_pos, selection)
+                                   for selection in source.selections.coded
+                                   if not frame_guids.isdisjoint(selection.code_guids)])
+
+    def find(self, needle, limit=None):
+        """Returns SearchHit objects of a folded needle in the text (at most `limit` of them)."""
+        hits = []
+        position = self.folded.find(needle)
+        while position >= 0 and (not limit or len(hits) < limit):
+            start, end = original_span(self.starts, self.ends, position, position + len(needle))
+            hits.append(SearchHit(start, end, self.metaphors.overlapping(start, end),
+                                  self.lus.overlapping(start, end), self.elements.overlapping(start, end)))
+            position = self.folded.find(needle, position + 1)
+        return hits
+
+
+class SearchHit:
+    """An occurrence of a query in the text of a source.
+
+    Attributes:
+        start: start offset of the hit in the original text
+        end: end offset of the hit in the original text
+        metaphors: Metaphor objects (units) overlapping the hit
+        lus: LexicalUnit objects overlapping the hit (their frame elements are in `Elements`)
+        elements: TextSelection objects coded with frame elements overlapping the hit
+    """
+
+    def __init__(self, start, end, metaphors, lus, elements=()):
+        self.start = start
+        self.end = end
+        self.metaphors = metaphors
+        self.lus = lus
+        self.elements = elements
+
+    def __repr__(self):
+        return f'SearchHit(span=({self.start}, {self.end}), metaphors={len(self.metaphors)}, lus={self.lus})'
+
+
+class TextIndex:
+    """Accent- and case-insensitive index of the texts of all sources of a project.
+
+    Texts are folded once (keeping a map to the original offsets) and every NGRAM of them is
+    mapped to the texts containing it, so a query is only looked for in the texts containing all of its n-grams.
+
+    Attributes:
+        texts: a list of IndexedText objects in the order of the sources
+        by_guid: dictionary with GUIDs of sources as keys and IndexedText objects as values
+        postings: dictionary with n-grams as keys and sets of positions in `texts` as values
+    """
+
+    @phase("index_texts")
+    def __init__(self, project):
+        self.texts = []
+        self.by_guid = {}
+        self.postings = {}
+        for i, source in enumerate(project.sources):
+            text = IndexedText(source)
+            self.texts.append(text)
+            self.by_guid[source.guid] = text
+            folded = text.folded
+            for ngram in {folded[j:j + NGRAM] for j in range(len(folded) - NGRAM + 1)}:
+                self.postings.setdefault(ngram, set()).add(i)
+
+    def candidates(self, needle):
+        if len(needle) < NGRAM:
+            return range(len(self.texts))
+        found = None
+        for ngram in {needle[j:j + NGRAM] for j in range(len(needle) - NGRAM + 1)}:
+            texts = self.postings.get(ngram, set())
+            found = texts if found is None else found & texts
+            if not found:
+                return []
+        return sorted(found)
+
+    @phase("search_texts")
+    def search(self, query, limit=None):
+        """Finds a phrase in texts of all sources regardless of accents, breathings and case.
+
+        Args:
+            query: a phrase to find
+            limit: maximal number of hits returned (all by default)
+        Returns:
+            A list of (Source, list of SearchHit objects) touples, sources with most hits first
+        """
+        needle = fold(query).strip()
+        if not needle:
+            return []
+        results = []
+        total = 0
+        for i in self.candidates(needle):
+            if limit and total >= limit:
+                break
+            text = self.texts[i]
+            hits = text.find(needle, limit - total if limit else None)
+            total += len(hits)
+            if hits:
+                results.append((text.source, hits))
+        count("search_hits", total)
+        # Sorting is stable, so sources with as many hits stay in document order
+        results.sort(key=lambda result: -len(result[1]))
+        return results
+
+    def search_source(self, guid, query, limit=None):
+        """Finds a phrase in the text of a single source (see search).
+
+        Returns:
+            A touple containing the Source object and a list of SearchHit objects, or None if there is no such source
+        """
+        text = self.by_guid.get(guid)
+        if text is None:
+            return None
+        needle = fold(query).strip()
+        return text.source, text.find(needle, limit) if needle else []
+
+
+class Highlighter:
+    """Marks spans in a text, rendering any number of its parts without sorting the spans again.
+
+    Overlapping spans are marked together: every piece of the text between two boundaries of spans
+    is wrapped once in `<mark>` with the classes of all spans covering it. Line breaks become `<br>`.
+    Boundaries are sorted once, a part of the text is then found among them with a binary search.
+
+    Attributes:
+        text: an original text
+        boundaries: sorted offsets at which the classes of the text change
+        classes: classes (separated by spaces) of the text from every boundary to the next one
+    """
+
+    def __init__(self, text, spans):
+        self.text = text
+        events = []
+        for s, e, name in spans:
+            if s < e:
+                events.append((s, 1, name))
+                events.append((e, -1, name))
+        events.sort()
+        active = {}
+        self.boundaries = []
+        self.classes = []
+        for i, (offset, change, name) in enumerate(events):
+            active[name] = active.get(name, 0) + change
+            if i + 1 == len(events) or events[i + 1][0] > offset:
+                self.boundaries.append(offset)
+                self.classes.append(" ".join(sorted(name for name, n in active.items() if n > 0)))
+
+    def render(self, start=0, end=None):
+        """Returns escaped HTML of a part of the text (the whole text by default) as a Markup object."""
+        end = len(self.text) if end is None else min(end, len(self.text))
+        i = bisect_right(self.boundaries, start) - 1
+        html = []
+        position = start
+        while position < end:
+            stop = self.boundaries[i + 1] if i + 1 < len(self.boundaries) else end
+            piece = escape(self.text[position:min(stop, end)]).replace("\n", Markup("<br>\n"))
+            classes = self.classes[i] if i >= 0 else ""
+            html.append(Markup('<mark class="{}">{}</mark>').format(classes, piece) if classes else piece)
+            position = stop
+            i += 1
+        return Markup("").join(html)
+
+
+def highlight(text, spans, start=0, end=None):
+    """Returns escaped HTML of a part of a text with spans marked (see Highlighter).
+
+    Args:
+        text: an original text
+        spans: a list of (start, end, class) touples
+        start, end: the part of the text to render (the whole text by default)
+    Returns:
+        A Markup object
+    """
+    return Highlighter(text, spans).render(start, end)
+
+
+def hit_spans(source, hits):
+    """Returns spans of hits and of the units, LUs and frame elements overlapping them in a source (for highlight)."""
+    spans = [(hit.start, hit.end, "hit") for hit in hits]
+    metaphors = {id(metaphor): metaphor for hit in hits for metaphor in hit.metaphors}
+    spans += [(*metaphor.span, "unit") for metaphor in metaphors.values()]
+    lus = {id(lu): lu for hit in hits for lu in hit.lus}
+    spans += [(lu.start_pos, lu.end_pos, "lu") for lu in lus.values()]
+    elements = {id(selection): selection for hit in hits for selection in hit.elements}
+    spans += [(selection.start_pos, selection.end_pos, "element") for selection in elements.values()]
+    return spans
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='QDPX search',
+        description='Finds a phrase in sources of a QPDX archive regardless of accents\
+             and prints the hits with the LUs overlapping them')
+    parser.add_argument('path')
+    parser.add_argument('query')
+    parser.add_argument('--lu_code_name', '-l')
+    parser.add_argument('--f_code_name', '-f')
+    parser.add_argument('--g_code_name', '-g', default="Grammar")
+    parser.add_argument('--backend', '-b', choices=BACKENDS, default="stream")
+    parser.add_argument('--limit', type=int)
+    args = parser.parse_args()
+
+    project = Project(*read_qdpx_file(args.path, args.backend), args.lu_code_name,
+                      args.f_code_name, args.g_code_name)
+    for source, hits in TextIndex(project).search(args.query, args.limit):
+        print(source.name, len(hits))
+        for hit in hits:
+            text = source.full_text
+            print("\t", hit.start, repr(text[max(0, hit.start - 30):hit.end + 30]),
+                  [(lu.code.name, [element.name for element in lu.Elements]) for lu in hit.lus])
@@ -0,0 +1,114 @@
+import os
+import os.path
+import pickle
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class TieredCache:
+    """Cache of objects by keys (strings with the on-disk tier), with an in-memory LRU tier and an optional on-disk tier.
+
+    Objects put into the cache are also pickled into the directory of the on-disk tier (if set),
+    so they survive restarts; objects loaded from disk are remembered in memory again.
+
+    Attributes:
+        max_entries: maximal number of objects kept in memory
+        directory: directory of the on-disk tier (None if disabled)
+        hits: number of objects found in memory
+        disk_hits: number of objects loaded from the on-disk tier
+        misses: number of keys found in neither tier
+    """
+
+    # Keys are made into paths of pickles, and they come from query strings, so with the on-disk tier
+    # only keys of this format are looked up (subclasses narrow it to the format of their keys)
+    KEY_PATTERN = re.compile(r"[0-9A-Za-z_-]+")
+
+    def __init__(self, max_entries=16, directory=None):
+        self.max_entries = max_entries
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns a cached object (or None), looking into memory first and then on disk.
+
+        With the on-disk tier, keys not matching KEY_PATTERN are never found (nor loaded).
+        """
+        if self.directory and not self.valid_key(key):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        value = self.load(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+        if value is not None:
+            self.remember(key, value)
+        return value
+
+    def remember(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def put(self, key, value):
+        self.remember(key, value)
+        self.dump(key, value)
+
+    def valid_key(self, key):
+        return isinstance(key, str) and self.KEY_PATTERN.fullmatch(key) is not None
+
+    def path(self, key):
+        if not self.valid_key(key):
+            raise ValueError(f"Invalid cache key: {key!r}")
+        return os.path.join(self.directory, key + ".pickle")
+
+    def load(self, key):
+        if not self.directory or not os.path.exists(self.path(key)):
+            return None
+        try:
+            with open(self.path(key), "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+
+    def dump(self, key, value):
+        if not self.directory:
+            return
+        # Written to a temporary file first, so that a half-written pickle is never loaded
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries),
+                    "max_entries": self.max_entries,
+                    "hits": self.hits,
+                    "disk_hits": self.disk_hits,
+                    "misses": self.misses,
+                    "disk": bool(self.directory)}
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.stats()})'